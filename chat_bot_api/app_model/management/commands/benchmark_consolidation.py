@@ -0,0 +1,121 @@
+import re
+import time
+
+import pandas as pd
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app_model.services import ShardDownloadService, FetchDataService, DataConsolidationService
+
+
+TRAIN_DATA_URL = "https://huggingface.co/api/datasets/tyson0420/stackexchange-overflow-fil-python/parquet/default/train"
+
+
+def reference_group_question_answer(batch_df: pd.DataFrame) -> pd.DataFrame:
+    '''Previous implementation of DataConsolidationService._group_question_answer, kept as the baseline.'''
+
+    def join_texts(series):
+        return "\n\n---\n\n".join(series.dropna().astype(str).unique())
+
+    consolidated_df = batch_df.groupby('qid').agg(
+        question = ('question', 'first'),
+        metadata = ('metadata', 'first'),
+        response_j = ('response_j', join_texts),
+        response_k = ('response_k', join_texts)
+    ).reset_index()
+
+    consolidated_df['consolidated_answers'] = consolidated_df['response_j'] + "\n\n---\n\n" + consolidated_df['response_k']
+    consolidated_df.drop(columns = ['response_j', 'response_k'], inplace = True)
+
+    return consolidated_df
+
+
+def reference_classify_relevant_sentences(consolidated_df: pd.DataFrame) -> pd.DataFrame:
+    '''Previous implementation of DataConsolidationService._classify_relevant_sentences, kept as the baseline.'''
+
+    consolidated_df_processed = consolidated_df.copy()
+
+    consolidated_df_processed['full_text_lower'] = (
+        consolidated_df_processed['question'].str.lower() + " " + consolidated_df_processed['consolidated_answers'].str.lower()
+    )
+
+    python_keywords_regex = r'python|pandas|numpy|django|flask|\bdef\b|\bclass\b|\bimport\b|\bself\b'
+    other_lang_keywords_regex = r'php|objective-c|java|c\#|swift|javascript'
+
+    consolidated_df_processed['python_signal_count'] = consolidated_df_processed['full_text_lower'].str.findall(python_keywords_regex, flags = re.IGNORECASE).str.len()
+
+    consolidated_df_processed['is_other_lang'] = consolidated_df_processed['full_text_lower'].str.contains(other_lang_keywords_regex, na = False, case = False)
+    consolidated_df_processed['has_code_block'] = consolidated_df_processed['consolidated_answers'].str.contains('```', na = False)
+
+    return consolidated_df_processed
+
+
+class Command(BaseCommand):
+    help = 'Measure the rows/sec of the consolidation stages against their previous implementation on StackOverflow answers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('parquet', nargs = '*', help = 'Parquet shards to read; defaults to the first train shard of the dataset cache.')
+        parser.add_argument('--rows', type = int, default = 50000, help = 'Maximum number of dataset rows to use.')
+        parser.add_argument('--repeat', type = int, default = 3, help = 'Runs per implementation; the best one is reported.')
+
+    def _load_rows(self, parquet_paths: list[str], rows: int) -> pd.DataFrame:
+        ''''''
+
+        if not parquet_paths:
+            downloader = ShardDownloadService(
+                cache_dir = settings.DATASET_CACHE_DIR,
+                mirror_dir = settings.DATASET_MIRROR_DIR,
+                offline = settings.DATASET_OFFLINE
+            )
+            parquet_paths = [downloader.fetch(downloader.get_json(TRAIN_DATA_URL)[0])]
+
+        batch_df = pd.concat(
+            [pd.read_parquet(path, columns = FetchDataService.CONSOLIDATION_COLUMNS) for path in parquet_paths],
+            ignore_index = True
+        ).head(rows)
+        batch_df['metadata'] = batch_df['metadata'].str[0]
+
+        return batch_df
+
+    def _best_time(self, function, repeat: int) -> tuple:
+        ''''''
+
+        best_seconds, result = None, None
+
+        for _ in range(repeat):
+            started_at = time.perf_counter()
+            result = function()
+            elapsed = time.perf_counter() - started_at
+
+            best_seconds = elapsed if best_seconds is None else min(best_seconds, elapsed)
+
+        return best_seconds, result
+
+    def _report(self, stage: str, total_rows: int, reference_seconds: float, current_seconds: float, identical: bool) -> None:
+        ''''''
+
+        self.stdout.write(
+            f'{stage}: reference {total_rows / reference_seconds:,.0f} rows/s, '
+            f'current {total_rows / current_seconds:,.0f} rows/s '
+            f'({reference_seconds / current_seconds:.1f}x), identical output: {identical}'
+        )
+
+    def handle(self, *args, **options):
+        batch_df = self._load_rows(options['parquet'], options['rows'])
+        consolidation = DataConsolidationService(batch_df)
+
+        reference_seconds, reference_df = self._best_time(lambda: reference_group_question_answer(batch_df), options['repeat'])
+        current_seconds, consolidated_df = self._best_time(consolidation._group_question_answer, options['repeat'])
+
+        self.stdout.write(f'{len(batch_df)} dataset rows, {len(consolidated_df)} consolidated questions')
+        self._report('group', len(batch_df), reference_seconds, current_seconds, reference_df.equals(consolidated_df))
+
+        total_rows = len(consolidated_df)
+
+        reference_seconds, reference_df = self._best_time(lambda: reference_classify_relevant_sentences(consolidated_df), options['repeat'])
+        current_seconds, current_df = self._best_time(lambda: consolidation._classify_relevant_sentences(consolidated_df), options['repeat'])
+
+        flag_columns = ['python_signal_count', 'is_other_lang', 'has_code_block']
+        identical = (reference_df[flag_columns].fillna(0).astype(int) == current_df[flag_columns].astype(int)).all().all()
+
+        self._report('classify', total_rows, reference_seconds, current_seconds, bool(identical))
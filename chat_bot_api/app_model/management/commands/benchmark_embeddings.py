@@ -0,0 +1,72 @@
+import time
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+from app_model.services import DataConsolidationService, CreateFaissTreeService, EmbeddingBackend
+from .benchmark_consolidation import Command as ConsolidationBenchmarkCommand
+
+
+class Command(ConsolidationBenchmarkCommand):
+    help = 'Measure the chunk embedding throughput, query latency and agreement with torch of each embedding backend.'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--chunks', type = int, default = 5000, help = 'Chunks embedded per backend.')
+        parser.add_argument('--queries', type = int, default = 200, help = 'Questions embedded one at a time per backend.')
+        parser.add_argument('--model', default = 'all-MiniLM-L6-v2', help = 'sentence-transformers model to embed with.')
+        parser.add_argument(
+            '--onnx-dir', default = settings.EMBEDDING_ONNX_DIR, help = 'Directory of the exported ONNX model.'
+        )
+
+    def _load_texts(self, options) -> tuple[list[str], list[str]]:
+        '''Cleaned chunks and questions of the StackOverflow answers, as the index and the chat embed them.'''
+
+        batch_df = self._load_rows(options['parquet'], options['rows'])
+        documents_df = DataConsolidationService(batch_df)._group_question_answer()
+        documents_df['parent_index'] = documents_df['qid']
+        chunks_df = CreateFaissTreeService()._create_chunks_batch(documents_df.copy())
+
+        return (
+            chunks_df['cleaned_text_chunk'].head(options['chunks']).tolist(),
+            documents_df['question'].head(options['queries']).tolist()
+        )
+
+    def handle(self, *args, **options):
+        chunks, questions = self._load_texts(options)
+        self.stdout.write(f'{len(chunks)} chunks, {len(questions)} questions')
+
+        model_name, onnx_dir = options['model'], options['onnx_dir']
+        backends = {
+            'torch': EmbeddingBackend(EmbeddingBackend.TORCH, model_name),
+            'onnx': EmbeddingBackend(EmbeddingBackend.ONNX, model_name, onnx_dir),
+            'onnx int8': EmbeddingBackend(EmbeddingBackend.ONNX, model_name, onnx_dir, quantized = True),
+        }
+        chunks_df = pd.DataFrame({'cleaned_text_chunk': chunks, 'raw_text_chunk': chunks, 'parent_index': 0, 'metadata': ''})
+        reference = None
+
+        for label, backend in backends.items():
+            embedding_model = backend.load(device = 'cpu')
+            indexer = CreateFaissTreeService(embedding_backend = backend)
+            embedding_model.embed_query(questions[0])
+
+            started_at = time.perf_counter()
+            embeddings, _ = indexer._process_embeddings_batch(chunks_df, embedding_model)
+            embed_seconds = time.perf_counter() - started_at
+
+            latencies = []
+
+            for question in questions:
+                started_at = time.perf_counter()
+                embedding_model.embed_query(question)
+                latencies.append(time.perf_counter() - started_at)
+
+            normalized = embeddings / np.linalg.norm(embeddings, axis = 1, keepdims = True)
+            reference = normalized if reference is None else reference
+            cosine = (normalized * reference).sum(axis = 1)
+
+            self.stdout.write(
+                f'{label}: {len(chunks) / embed_seconds:,.0f} chunks/s, query p50 {np.percentile(latencies, 50) * 1000:.1f} ms, '
+                f'p99 {np.percentile(latencies, 99) * 1000:.1f} ms, cosine to torch mean {cosine.mean():.5f} min {cosine.min():.5f}'
+            )
@@ -0,0 +1,53 @@
+import os
+
+import faiss
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from app_model.services import FaissIndexBuilder, IndexVersionStore
+
+
+class Command(BaseCommand):
+    help = 'Compare the recall@k, latency and size of approximate index types against the exact index of a training run.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--faiss-dir', default = os.path.join(settings.MEDIA_ROOT, 'faiss_index'),
+            help = 'Directory of an index built with the flat (exact) index type.'
+        )
+        parser.add_argument(
+            '--spec', action = 'append',
+            help = 'Preset or index_factory string to evaluate; repeat for several. Defaults to every approximate preset.'
+        )
+        parser.add_argument('--queries', type = int, default = 200, help = 'Held-out query vectors.')
+        parser.add_argument('--k', type = int, default = 10, help = 'Neighbours compared per query.')
+        parser.add_argument('--train-size', type = int, default = settings.FAISS_INDEX_TRAIN_SIZE, help = 'Training sample size.')
+
+    def handle(self, *args, **options):
+        index_path = IndexVersionStore(options['faiss_dir']).current_path()
+
+        if index_path is None:
+            raise CommandError(f"No FAISS index in {options['faiss_dir']}.")
+
+        flat_index = faiss.read_index(os.path.join(index_path, 'index.faiss'))
+        exact_index = faiss.downcast_index(flat_index.index) if isinstance(flat_index, faiss.IndexIDMap2) else flat_index
+
+        if not isinstance(exact_index, faiss.IndexFlat):
+            raise CommandError('The index must have been built with the flat index type, to serve as the exact baseline.')
+
+        self.stdout.write(f'{flat_index.ntotal} vectors of {flat_index.d} dimensions, {flat_index.ntotal * flat_index.d * 4 / 1024 ** 2:,.1f} MB exact')
+
+        specs = options['spec'] or [spec for spec in FaissIndexBuilder.PRESETS if spec != 'flat']
+
+        for spec in specs:
+            builder = FaissIndexBuilder(
+                spec = spec, train_size = options['train_size'], report_queries = options['queries'], k = options['k']
+            )
+            index, params = builder.build(flat_index)
+
+            self.stdout.write(
+                f"{spec}: {FaissIndexBuilder.summary(params)}, {faiss.serialize_index(index).nbytes / 1024 ** 2:,.1f} MB, "
+                f"trained in {params['train_seconds']:.1f} s"
+            )
+
+            del index
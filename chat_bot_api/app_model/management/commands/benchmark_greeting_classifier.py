@@ -0,0 +1,91 @@
+import time
+from collections import Counter
+
+import numpy as np
+
+from app_model.services import DataConsolidationService, EmbeddingBackend, GreetingClassifier, GetResponseFromGeminiService
+from .benchmark_consolidation import Command as ConsolidationBenchmarkCommand
+
+
+# Messages labelled by hand: True for greetings only, False for anything the chat has to search an answer for
+LABELED_MESSAGES = [
+    ('Olá!', True), ('oi', True), ('oiii tudo bem?', True), ('Bom dia!', True), ('boa tarde pessoal', True),
+    ('Boa noite, tudo bem?', True), ('eae', True), ('e aí, beleza?', True), ('salve galera', True), ('opa', True),
+    ('Olá, bom dia!', True), ('hello', True), ('Hi there!', True), ('hey', True), ('Good morning', True),
+    ('good evening everyone', True), ('how are you?', True), ('hola', True), ('¡Buenos días!', True), ('buenas', True),
+    ('bonjour', True), ('salut à tous', True), ('ciao', True), ('buongiorno', True), ('hallo', True),
+    ('Guten Morgen', True), ('eae mano', True), ('hiya buddy', True), ('saudações', True), ('oi bot', True),
+    ('Oi, como faço para ordenar uma lista em Python?', False), ('Bom dia, como leio um arquivo CSV com pandas?', False),
+    ('hello world em python', False), ('o que é um decorator?', False), ('lambda', False), ('list comprehension', False),
+    ('obrigado', False), ('valeu!', False), ('tchau', False), ('hi, how do I reverse a string in python?', False),
+    ('what is a generator', False), ('erro ModuleNotFoundError', False), ('numpy', False), ('como instalar o django', False),
+    ('help', False), ('teste', False), ('?', False), ('def f(x): return x', False),
+]
+
+
+class Command(ConsolidationBenchmarkCommand):
+    help = 'Measure the decisions and latency of the local greeting classifier, against hand labels and the LLM classifier.'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--questions', type = int, default = 500, help = 'StackOverflow questions added as non-greetings.')
+        parser.add_argument('--model', default = None, help = 'sentence-transformers model to embed with; defaults to the settings.')
+        parser.add_argument('--llm', action = 'store_true', help = 'Also classify every message with the LLM (one request each).')
+
+    def handle(self, *args, **options):
+        messages = list(LABELED_MESSAGES)
+
+        if options['questions']:
+            batch_df = self._load_rows(options['parquet'], options['rows'])
+            questions = DataConsolidationService(batch_df)._group_question_answer()['question'].head(options['questions'])
+            messages += [(question, False) for question in questions]
+
+        embedding_backend = EmbeddingBackend.from_settings()
+        if options['model']:
+            embedding_backend = EmbeddingBackend(embedding_backend.name, options['model'])
+
+        classifier = GreetingClassifier(embedding_backend.load(device = 'cpu'))
+        classifier.classify('olá tudo bem')
+        classifier.decisions.clear()
+
+        decisions, latencies = [], []
+
+        for message, _ in messages:
+            started_at = time.perf_counter()
+            decisions.append(classifier.classify(message)[0])
+            latencies.append(time.perf_counter() - started_at)
+
+        greetings = sum(is_greeting for _, is_greeting in messages)
+        settled = [(decision, is_greeting) for decision, (_, is_greeting) in zip(decisions, messages) if decision != GreetingClassifier.AMBIGUOUS]
+        wrong_greetings = sum(decision == GreetingClassifier.GREETING and not is_greeting for decision, is_greeting in settled)
+        missed_greetings = sum(decision == GreetingClassifier.OTHER and is_greeting for decision, is_greeting in settled)
+
+        self.stdout.write(f'{len(messages)} messages, {greetings} greetings')
+        self.stdout.write(f'decisions: {dict(Counter(decisions))}, by source: {dict(classifier.decisions)}')
+        self.stdout.write(
+            f'local: {len(settled) / len(messages):.1%} settled without the LLM, {wrong_greetings} questions taken for '
+            f'greetings, {missed_greetings} greetings taken for questions, p50 {np.percentile(latencies, 50) * 1000:.2f} ms, '
+            f'p99 {np.percentile(latencies, 99) * 1000:.2f} ms'
+        )
+
+        if not options['llm']:
+            return
+
+        llm_decisions, llm_latencies = [], []
+
+        for message, _ in messages:
+            started_at = time.perf_counter()
+            llm_decisions.append(GetResponseFromGeminiService.classify_greeting_with_llm(message) != 'other')
+            llm_latencies.append(time.perf_counter() - started_at)
+
+        agreement = [
+            llm_is_greeting == (decision == GreetingClassifier.GREETING)
+            for decision, llm_is_greeting in zip(decisions, llm_decisions) if decision != GreetingClassifier.AMBIGUOUS
+        ]
+        llm_correct = sum(llm_is_greeting == is_greeting for llm_is_greeting, (_, is_greeting) in zip(llm_decisions, messages))
+
+        self.stdout.write(
+            f'llm: {llm_correct / len(messages):.1%} agree with the labels, local decisions agree with it on '
+            f'{sum(agreement) / max(len(agreement), 1):.1%}, p50 {np.percentile(llm_latencies, 50) * 1000:.0f} ms, '
+            f'p99 {np.percentile(llm_latencies, 99) * 1000:.0f} ms'
+        )
@@ -0,0 +1,100 @@
+import re
+
+import pandas as pd
+from bs4 import BeautifulSoup
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from app_model.services import DataConsolidationService, CreateFaissTreeService, TextCleaner
+from .benchmark_consolidation import Command as ConsolidationBenchmarkCommand
+
+
+def reference_clean_text(text: str) -> str:
+    '''Previous implementation of CreateFaissTreeService._clean_text, kept as the baseline.'''
+
+    if not isinstance(text, str):
+        return ""
+
+    try:
+        soup = BeautifulSoup(text, "lxml")
+        text = soup.get_text()
+
+    except Exception:
+        pass
+
+    text = re.sub(r'http\S+|www\S+|https\S+', '', text, flags = re.MULTILINE)
+    text = re.sub(r'\[([^\]]*)\]\([^\)]*\)?', r'\1', text)
+    text = re.sub(r'```[a-zA-Z]*\n', '', text)
+    text = text.replace('```', '')
+    text = text.replace('`', '')
+    text = re.sub(r'\s+', ' ', text).strip()
+
+    return text
+
+
+def reference_create_chunks_batch(documents_df: pd.DataFrame) -> pd.DataFrame:
+    '''Previous implementation of CreateFaissTreeService._create_chunks_batch, kept as the baseline.'''
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size = 2000,
+        chunk_overlap = 400,
+        separators = ["\n\n", "\n", " ", ""],
+        length_function = len
+    )
+
+    documents_df = documents_df.copy()
+    documents_df['text_for_chunking'] = documents_df['question'] + "\n\nAnswers:\n" + documents_df['consolidated_answers']
+    documents_df['raw_chunks'] = documents_df['text_for_chunking'].apply(lambda text: text_splitter.split_text(text))
+
+    chunks_df = documents_df[['parent_index', 'metadata', 'raw_chunks']].explode('raw_chunks')
+    chunks_df = chunks_df.rename(columns = {'raw_chunks': 'raw_text_chunk'})
+    chunks_df['cleaned_text_chunk'] = chunks_df['raw_text_chunk'].apply(reference_clean_text)
+    chunks_df = chunks_df[chunks_df['cleaned_text_chunk'].str.strip().astype(bool)].reset_index(drop = True)
+
+    return chunks_df
+
+
+class Command(ConsolidationBenchmarkCommand):
+    help = 'Measure the throughput of the chunk text cleaner and chunker against their previous implementation on StackOverflow answers.'
+
+    def handle(self, *args, **options):
+        batch_df = self._load_rows(options['parquet'], options['rows'])
+        documents_df = DataConsolidationService(batch_df)._group_question_answer()
+        documents_df['parent_index'] = documents_df['qid']
+
+        reference_chunks_df = reference_create_chunks_batch(documents_df)
+        raw_chunks = reference_chunks_df['raw_text_chunk'].tolist()
+        html_chunks = sum('<' in chunk for chunk in raw_chunks)
+        cleaner = TextCleaner()
+
+        self.stdout.write(
+            f'{len(documents_df)} documents, {len(raw_chunks)} chunks, '
+            f'{html_chunks / max(len(raw_chunks), 1):.1%} of the chunks with a "<"'
+        )
+
+        reference_seconds, reference_texts = self._best_time(
+            lambda: [reference_clean_text(chunk) for chunk in raw_chunks], options['repeat']
+        )
+        current_seconds, current_texts = self._best_time(lambda: [cleaner.clean(chunk) for chunk in raw_chunks], options['repeat'])
+
+        self._report('clean (chunks)', len(raw_chunks), reference_seconds, current_seconds, reference_texts == current_texts)
+
+        documents = documents_df['question'] + "\n\nAnswers:\n" + documents_df['consolidated_answers']
+        documents = documents.tolist()
+        with_offsets = [cleaner.clean_with_offsets(document) for document in documents]
+        identical = all(cleaned == cleaner.clean(document) for document, (cleaned, _) in zip(documents, with_offsets))
+        unmapped = sum(offsets is None for _, offsets in with_offsets)
+
+        self.stdout.write(f'clean once per document: identical to clean: {identical}, documents split raw (unmapped HTML): {unmapped}')
+
+        service = CreateFaissTreeService()
+
+        reference_seconds, _ = self._best_time(lambda: reference_create_chunks_batch(documents_df), options['repeat'])
+        current_seconds, chunks_df = self._best_time(lambda: service._create_chunks_batch(documents_df.copy()), options['repeat'])
+
+        total_rows = len(documents_df)
+
+        self.stdout.write(
+            f'chunk: reference {total_rows / reference_seconds:,.0f} documents/s, '
+            f'current {total_rows / current_seconds:,.0f} documents/s ({reference_seconds / current_seconds:.1f}x), '
+            f'chunks: reference {len(reference_chunks_df)}, current {len(chunks_df)}'
+        )
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from app_model.services import EmbeddingBackend, EmbeddingCache
+
+
+class Command(BaseCommand):
+    help = 'Evict the least recently used chunk embeddings until the embedding cache fits its size limit.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model', default = EmbeddingBackend.from_settings().cache_name,
+            help = 'Embedding cache to compact; defaults to the one of EMBEDDING_BACKEND.'
+        )
+        parser.add_argument(
+            '--max-mb', type = int, default = settings.EMBEDDING_CACHE_MAX_MB,
+            help = 'Size limit of the cache in megabytes; defaults to EMBEDDING_CACHE_MAX_MB.'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            embedding_cache = EmbeddingCache(settings.EMBEDDING_CACHE_DIR, options['model'])
+
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        try:
+            size_before = embedding_cache.size_bytes
+            evicted = embedding_cache.compact(options['max_mb'] * 1024 * 1024)
+
+        finally:
+            embedding_cache.close()
+
+        self.stdout.write(
+            f'{evicted} embeddings evicted, {embedding_cache.rows} kept '
+            f'({size_before / 1024 ** 2:,.1f} MB -> {embedding_cache.size_bytes / 1024 ** 2:,.1f} MB)'
+        )
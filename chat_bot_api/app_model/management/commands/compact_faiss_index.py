@@ -0,0 +1,40 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from app_model.services import EmbeddingBackend, IncrementalIndexService, IndexVersionStore
+
+
+class Command(BaseCommand):
+    help = 'Remove the vectors of deleted or replaced documents from the FAISS index, whatever their share of the index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--faiss-dir', default = os.path.join(settings.MEDIA_ROOT, 'faiss_index'), help = 'Directory of the index.'
+        )
+
+    def handle(self, *args, **options):
+        version_store = IndexVersionStore.from_settings(options['faiss_dir'])
+
+        if not version_store.accepts_updates():
+            raise CommandError('The FAISS index predates the current index format, train the model again to rebuild it.')
+
+        version_path = version_store.create_from_current()
+
+        try:
+            index_service = IncrementalIndexService(version_path)
+            vectorstore = index_service.load(EmbeddingBackend.from_settings().load())
+
+            compacted = index_service.compact(vectorstore)
+
+            if compacted:
+                index_service.save(vectorstore)
+                version_store.publish(version_path, compacted_chunks = compacted)
+
+        finally:
+            version_store.discard(version_path)
+
+        self.stdout.write(
+            f'{compacted} tombstoned chunks removed, {vectorstore.index.ntotal} left, serving version {version_store.current()}'
+        )
@@ -0,0 +1,50 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from app_model.services import IndexVersionStore
+
+
+class Command(BaseCommand):
+    help = 'List the published versions of the FAISS index, verify their checksums, roll back to one or collect old ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--faiss-dir', default = os.path.join(settings.MEDIA_ROOT, 'faiss_index'), help = 'Directory of the index.'
+        )
+        parser.add_argument('--verify', action = 'store_true', help = 'Check every file against the sha256 of its manifest.')
+        parser.add_argument('--rollback', metavar = 'VERSION', help = 'Serve this published version again.')
+        parser.add_argument('--gc', action = 'store_true', help = 'Remove the versions past the retention policy.')
+
+    def handle(self, *args, **options):
+        version_store = IndexVersionStore.from_settings(options['faiss_dir'])
+
+        if options['rollback']:
+            try:
+                version_store.rollback(options['rollback'])
+
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        if options['gc']:
+            removed = version_store.gc()
+            self.stdout.write(f'{len(removed)} removed: {", ".join(removed) or "-"}')
+
+        current = version_store.current()
+
+        for version in version_store.versions():
+            manifest = version_store.manifest(version)
+            size = sum(file['size'] for file in manifest['files'].values())
+            line = (
+                f"{'*' if version == current else ' '} {version}  "
+                f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(manifest['created_at']))}  "
+                f"{size / 1024 ** 2:,.1f} MB  documents {manifest.get('documents', '-')}  parent {manifest.get('parent') or '-'}"
+            )
+
+            if options['verify']:
+                problems = version_store.verify(version)
+                line += f"  {'ok' if not problems else 'CORRUPT: ' + ', '.join(problems)}"
+
+            self.stdout.write(line)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_model', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskstatus',
+            name='checkpoint',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_model', '0003_taskstatus_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='content_hash',
+            field=models.CharField(db_default='', default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='is_indexed',
+            field=models.BooleanField(db_default=False, db_index=True, default=False),
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='qid',
+            field=models.PositiveIntegerField(db_index=True),
+        ),
+    ]
@@ -6,10 +6,12 @@ class Document(models.Model):
     ''''''
 
     parent_index = models.PositiveIntegerField(db_index = True)
-    qid = models.PositiveIntegerField()
+    qid = models.PositiveIntegerField(db_index = True)
     question = models.TextField()
     metadata = models.CharField(max_length = 80)
     consolidated_answers = models.TextField()
+    content_hash = models.CharField(max_length = 64, default = '', db_default = '')
+    is_indexed = models.BooleanField(default = False, db_default = False, db_index = True)
 
 
 class Chat(models.Model):
@@ -51,6 +53,7 @@ class TaskStatus(models.Model):
     task_id = models.CharField(max_length = 255, unique = True)
     status = models.CharField(max_length = 50)
     result = models.TextField(null = True, blank = True)
+    checkpoint = models.JSONField(null = True, blank = True)
     created_at = models.DateTimeField(auto_now_add = True)
     updated_at = models.DateTimeField(auto_now = True)
 
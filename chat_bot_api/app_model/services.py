@@ -1,362 +1,4355 @@
 import os
 import re
+import csv
 import gc
 import json
+import fcntl
+import time
+import logging
+import queue
+import threading
+import shutil
+import sqlite3
+import tempfile
+import uuid
+import warnings
+import hashlib
+import zlib
+import unicodedata
+import multiprocessing
 import requests
-from io import BytesIO
+import redis
+from collections import Counter, OrderedDict, deque
+from datetime import timedelta
+from io import StringIO
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+import faiss
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from decouple import config
 from bs4 import BeautifulSoup
 import torch
 
 from rest_framework.request import Request
 from rest_framework.exceptions import ValidationError
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
 from django.shortcuts import get_object_or_404
 from celery import states
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.prompts import PromptTemplate
 from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.documents import Document as ChunkDocument
+from langchain_core.embeddings import Embeddings
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
 from langchain_google_genai import ChatGoogleGenerativeAI
 
 from .models import Document, Chat, Message, TaskStatus
 
 
+logger = logging.getLogger(__name__)
+
+
+class ShardDownloadService:
+    '''
+    Downloads the dataset files into a local content-addressed cache. Requests share a pooled HTTP session, run
+    a bounded number at a time, resume from partial files and are skipped when the cached copy still matches the
+    remote size/ETag. In offline mode only the cache and the local mirror directory are used.
+    '''
+
+    def __init__(
+        self, cache_dir: str, mirror_dir: str = None, offline: bool = False, max_workers: int = 4,
+        verify_hash: bool = False, timeout: int = 60
+    ) -> object:
+        self._cache_dir = cache_dir
+        self._objects_dir = os.path.join(cache_dir, 'objects')
+        self._partial_dir = os.path.join(cache_dir, 'partial')
+        self._manifest_path = os.path.join(cache_dir, 'manifest.json')
+        self._mirror_dir = mirror_dir
+        self._offline = offline
+        self._max_workers = max_workers
+        self._verify_hash = verify_hash
+        self._timeout = timeout
+        self._manifest = None
+        self._manifest_lock = threading.Lock()
+        self._session = None
+
+        os.makedirs(self._objects_dir, exist_ok = True)
+        os.makedirs(self._partial_dir, exist_ok = True)
+
+    @property
+    def session(self) -> requests.Session:
+        ''''''
+
+        if self._session is None:
+            retries = Retry(
+                total = 5,
+                backoff_factor = 1,
+                status_forcelist = (429, 500, 502, 503, 504),
+                allowed_methods = ('GET', 'HEAD')
+            )
+            adapter = HTTPAdapter(pool_connections = self._max_workers, pool_maxsize = self._max_workers, max_retries = retries)
+
+            self._session = requests.Session()
+            self._session.mount('https://', adapter)
+            self._session.mount('http://', adapter)
+
+        return self._session
+
+    def _read_manifest(self) -> dict:
+        ''''''
+
+        try:
+            with open(self._manifest_path) as manifest_file:
+                return json.load(manifest_file)
+
+        except (OSError, json.JSONDecodeError):
+            return {'files': {}, 'listings': {}}
+
+    def _get_manifest(self) -> dict:
+        ''''''
+
+        if self._manifest is None:
+            self._manifest = self._read_manifest()
+
+        return self._manifest
+
+    def _update_manifest(self, section: str, key: str, value) -> None:
+        '''
+        Set one manifest entry. Other processes (Celery workers, retried shard tasks) share the cache, so the manifest
+        is re-read from disk under a file lock, changed and written back through a temporary file and a rename.
+        '''
+
+        with self._manifest_lock, open(f'{self._manifest_path}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            manifest = self._read_manifest()
+            manifest[section][key] = value
+
+            tmp_path = f'{self._manifest_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+
+            with open(tmp_path, 'w') as manifest_file:
+                json.dump(manifest, manifest_file)
+                manifest_file.flush()
+                os.fsync(manifest_file.fileno())
+
+            os.replace(tmp_path, self._manifest_path)
+            self._manifest = manifest
+
+    def _mirror_path(self, url: str) -> str:
+        '''Path of the url inside the mirror directory, which follows the url path layout.'''
+
+        if not self._mirror_dir:
+            return None
+
+        return os.path.join(self._mirror_dir, urlparse(url).path.lstrip('/'))
+
+    @staticmethod
+    def _file_sha256(path: str) -> str:
+        ''''''
+
+        digest = hashlib.sha256()
+
+        with open(path, 'rb') as cached_file:
+            for block in iter(lambda: cached_file.read(1024 * 1024), b''):
+                digest.update(block)
+
+        return digest.hexdigest()
+
+    def _object_path(self, sha256: str) -> str:
+        ''''''
+
+        return os.path.join(self._objects_dir, sha256[:2], f'{sha256}.parquet')
+
+    def _cached_path(self, url: str) -> str:
+        '''Return the cached copy of url if it exists and is intact, None otherwise.'''
+
+        with self._manifest_lock:
+            entry = self._get_manifest()['files'].get(url)
+
+        if entry is None:
+            return None
+
+        object_path = self._object_path(entry['sha256'])
+
+        if not os.path.exists(object_path) or os.path.getsize(object_path) != entry['size']:
+            return None
+
+        if self._verify_hash and self._file_sha256(object_path) != entry['sha256']:
+            return None
+
+        return object_path
+
+    def get_json(self, url: str) -> list:
+        '''Fetch a JSON listing (e.g. the parquet shards of a split), answering from the cache or mirror when offline.'''
+
+        if self._offline:
+            mirror_path = self._mirror_path(url)
+
+            if mirror_path and os.path.isdir(mirror_path):
+                return [f'{url}/{file_name}' for file_name in sorted(os.listdir(mirror_path)) if file_name.endswith('.parquet')]
+
+            with self._manifest_lock:
+                listing = self._get_manifest()['listings'].get(url)
+
+            if listing is None:
+                raise FileNotFoundError(f'{url} is not available in the local cache or mirror (offline mode)')
+
+            return listing
+
+        response = self.session.get(url, timeout = self._timeout)
+        response.raise_for_status()
+
+        listing = response.json()
+        self._update_manifest('listings', url, listing)
+
+        return listing
+
+    @staticmethod
+    def _write_response(response, partial_path: str) -> None:
+        '''Append a 206 (partial content) response to the partial file, or write any other response over it.'''
+
+        mode = 'ab' if response.status_code == 206 else 'wb'
+
+        with open(partial_path, mode) as partial_file:
+            for chunk in response.iter_content(chunk_size = 1024 * 1024):
+                partial_file.write(chunk)
+
+    def _download(self, url: str, etag: str, expected_size: int) -> str:
+        '''
+        Download url into the cache, resuming a previous partial download when the server supports ranges. The partial
+        file is locked, so a process downloading the same url waits and then uses the copy the first one stored.
+        '''
+
+        partial_path = os.path.join(self._partial_dir, hashlib.sha1(url.encode()).hexdigest() + '.part')
+
+        with open(f'{partial_path}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            with self._manifest_lock:
+                self._manifest = None
+
+            object_path = self._cached_path(url)
+
+            if object_path is not None and self._is_current(url, etag, expected_size):
+                return object_path
+
+            return self._download_locked(url, partial_path, etag, expected_size)
+
+    def _download_locked(self, url: str, partial_path: str, etag: str, expected_size: int) -> str:
+        ''''''
+
+        downloaded = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+
+        if expected_size is not None and downloaded > expected_size:
+            downloaded = 0
+
+        # An earlier attempt wrote the whole file but stopped before moving it into place
+        if expected_size is not None and downloaded and downloaded == expected_size:
+            return self._store(url, partial_path, etag)
+
+        headers = {}
+
+        if downloaded:
+            headers['Range'] = f'bytes={downloaded}-'
+
+            if etag:
+                headers['If-Range'] = etag
+
+        restart = False
+
+        with self.session.get(url, headers = headers, stream = True, timeout = self._timeout) as response:
+            # The server cannot serve the rest of the partial file, the file is downloaded again from the start
+            if response.status_code == 416 and downloaded:
+                restart = True
+
+            else:
+                response.raise_for_status()
+                self._write_response(response, partial_path)
+
+        if restart:
+            with self.session.get(url, stream = True, timeout = self._timeout) as response:
+                response.raise_for_status()
+                self._write_response(response, partial_path)
+
+        size = os.path.getsize(partial_path)
+
+        if expected_size is not None and size != expected_size:
+            raise requests.HTTPError(f'Incomplete download of {url}: {size} of {expected_size} bytes')
+
+        return self._store(url, partial_path, etag)
+
+    def _store(self, url: str, partial_path: str, etag: str) -> str:
+        '''Move a complete download into the content-addressed cache and record it in the manifest.'''
+
+        size = os.path.getsize(partial_path)
+        sha256 = self._file_sha256(partial_path)
+        object_path = self._object_path(sha256)
+
+        os.makedirs(os.path.dirname(object_path), exist_ok = True)
+        os.replace(partial_path, object_path)
+
+        self._update_manifest('files', url, {'sha256': sha256, 'size': size, 'etag': etag})
+
+        return object_path
+
+    def _is_current(self, url: str, etag: str, expected_size: int) -> bool:
+        '''Whether the cached copy of url still matches the remote ETag, or its size when there is no ETag.'''
+
+        with self._manifest_lock:
+            entry = self._get_manifest()['files'][url]
+
+        return (etag and entry.get('etag') == etag) or (not etag and entry['size'] == expected_size)
+
+    def fetch(self, url: str) -> str:
+        '''Return a local path holding the content of url, downloading it only when no valid copy is available.'''
+
+        mirror_path = self._mirror_path(url)
+
+        if mirror_path and os.path.isfile(mirror_path):
+            return mirror_path
+
+        cached_path = self._cached_path(url)
+
+        if self._offline:
+            if cached_path is None:
+                raise FileNotFoundError(f'{url} is not available in the local cache or mirror (offline mode)')
+
+            return cached_path
+
+        head = self.session.head(url, allow_redirects = True, timeout = self._timeout)
+        head.raise_for_status()
+
+        etag = head.headers.get('ETag')
+        content_length = head.headers.get('Content-Length')
+        expected_size = int(content_length) if content_length else None
+
+        if cached_path is not None and self._is_current(url, etag, expected_size):
+            return cached_path
+
+        return self._download(url, etag, expected_size)
+
+    def fetch_all(self, urls: list[str]) -> list[str]:
+        '''Fetch several urls concurrently, at most max_workers at a time, keeping the order of urls.'''
+
+        with ThreadPoolExecutor(max_workers = self._max_workers) as executor:
+            return list(executor.map(self.fetch, urls))
+
+
+
 class FetchDataService:
     ''''''
+
+    CONSOLIDATION_COLUMNS = ['qid', 'question', 'metadata', 'response_j', 'response_k']
     
-    def __init__(self, train_data_url: str, test_data_url: str, qids_per_batch: int = 20000) -> object:
+    def __init__(
+        self, train_data_url: str, test_data_url: str, qids_per_batch: int = 20000,
+        rows_per_partition: int = 200000, record_batch_size: int = 10000, work_dir: str = None,
+        downloader: ShardDownloadService = None
+    ) -> object:
         self._train_data_url = train_data_url
         self._test_data_url = test_data_url
         self._qids_per_batch = qids_per_batch
+        self._rows_per_partition = rows_per_partition
+        self._record_batch_size = record_batch_size
+        self._work_dir = work_dir
+        self._downloader = downloader or ShardDownloadService(os.path.join(tempfile.gettempdir(), 'chat_bot_dataset_cache'))
+        self._shard_paths = None
         self._full_df = None
+        self._unique_qids = None
+        self._qid_row_starts = None
+
+    def _get_url_data_from_huggingface(self, url: str) -> list[str]:
+        ''''''
+        
+        return self._downloader.get_json(url)
+
+    def _get_shard_urls(self) -> list[str]:
+        ''''''
+
+        urls = self._get_url_data_from_huggingface(self._train_data_url)
+        test_urls = self._get_url_data_from_huggingface(self._test_data_url)
+        urls.extend(test_urls)
+
+        return urls
+
+    def _get_shard_paths(self) -> list[str]:
+        ''''''
+
+        if self._shard_paths is None:
+            self._shard_paths = self._downloader.fetch_all(self._get_shard_urls())
+
+        return self._shard_paths
+
+    def get_dataset_fingerprint(self) -> str:
+        '''
+        Identifies the shards and the batching parameters, so batch numbers recorded by a previous run can be
+        trusted only while the same data is split the same way.
+        '''
+
+        digest = hashlib.sha256(f'{self._qids_per_batch}:{self._rows_per_partition}'.encode())
+
+        for shard_path in self._get_shard_paths():
+            digest.update(f'\n{os.path.basename(shard_path)}:{os.path.getsize(shard_path)}'.encode())
+
+        return digest.hexdigest()
+
+    def _ensure_data_loaded(self) -> None:
+        ''''''
+
+        if self._full_df is not None:
+            return
+            
+        shard_paths = self._get_shard_paths()
+
+        dfs = []
+        
+        for shard_path in shard_paths:
+            df = pd.read_parquet(shard_path, columns = self.CONSOLIDATION_COLUMNS)
+            dfs.append(df)
+
+        full_df = pd.concat(dfs, ignore_index = True)
+        full_df['metadata'] = full_df['metadata'].str[0]
+
+        del dfs
+        gc.collect()
+
+        self._full_df, self._unique_qids, self._qid_row_starts = self._group_rows_by_qid(full_df)
+
+    @staticmethod
+    def _group_rows_by_qid(df: pd.DataFrame) -> tuple:
+        '''
+        Reorder the rows so the rows of each qid are contiguous, keeping the qids in order of first appearance and
+        the rows of a qid in their original order. Returns the reordered frame, the unique qids and the offsets where
+        the rows of each qid start (with the total row count appended), so any run of qids is a plain row slice.
+        '''
+
+        codes, unique_qids = pd.factorize(df['qid'])
+        row_order = np.argsort(codes, kind = 'stable')
+
+        grouped_df = df.take(row_order).reset_index(drop = True)
+        qid_row_starts = np.concatenate(([0], np.cumsum(np.bincount(codes, minlength = len(unique_qids)))))
+
+        return grouped_df, unique_qids, qid_row_starts
+
+    def _plan_row_ranges(self, qid_row_starts: np.ndarray) -> list[tuple[int, int]]:
+        ''''''
+
+        total_qids = len(qid_row_starts) - 1
+
+        return [
+            (int(qid_row_starts[i]), int(qid_row_starts[min(i + self._qids_per_batch, total_qids)]))
+            for i in range(0, total_qids, self._qids_per_batch)
+        ]
+
+    def _iter_record_batches(self, shard_paths: list[str]):
+        '''Yield the consolidation columns of every shard as small DataFrames, one Arrow record batch at a time.'''
+
+        for shard_path in shard_paths:
+            parquet_file = pq.ParquetFile(shard_path)
+
+            for record_batch in parquet_file.iter_batches(batch_size = self._record_batch_size, columns = self.CONSOLIDATION_COLUMNS):
+                batch_df = record_batch.to_pandas()
+                batch_df['metadata'] = batch_df['metadata'].str[0]
+
+                yield batch_df
+
+    def _partition_shards(self, shard_paths: list[str], partitions_dir: str) -> list[str]:
+        '''
+        Spill the rows of every shard into qid hash partitions on disk, so all the rows of a qid end up in the
+        same partition file and each partition fits comfortably in memory.
+        '''
+
+        if not shard_paths:
+            return []
+
+        total_rows = sum(pq.ParquetFile(shard_path).metadata.num_rows for shard_path in shard_paths)
+        total_partitions = max(1, -(-total_rows // self._rows_per_partition))
+
+        partition_paths = [os.path.join(partitions_dir, f'partition_{i:05d}.parquet') for i in range(total_partitions)]
+        writers = {}
+
+        shard_schema = pq.ParquetFile(shard_paths[0]).schema_arrow
+        schema = pa.schema([
+            pa.field('metadata', pa.string()) if column == 'metadata' else shard_schema.field(column)
+            for column in self.CONSOLIDATION_COLUMNS
+        ])
+
+        try:
+            for batch_df in self._iter_record_batches(shard_paths):
+                partition_ids = pd.util.hash_pandas_object(batch_df['qid'], index = False).to_numpy() % total_partitions
+
+                for partition_id, partition_df in batch_df.groupby(partition_ids, sort = False):
+                    table = pa.Table.from_pandas(partition_df, schema = schema, preserve_index = False)
+
+                    if partition_id not in writers:
+                        writers[partition_id] = pq.ParquetWriter(partition_paths[partition_id], schema)
+
+                    writers[partition_id].write_table(table)
+
+                del batch_df
+                gc.collect()
+
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        return [partition_paths[partition_id] for partition_id in sorted(writers)]
+
+    def iter_qid_batches(self):
+        '''
+        Streaming alternative to get_qid_batches + fetch_data_by_qids: yield DataFrames holding every row of at most
+        qids_per_batch qids, while only one shard record batch or one qid partition is in memory at a time.
+        '''
+
+        shard_paths = self._get_shard_paths()
+
+        with tempfile.TemporaryDirectory(dir = self._work_dir) as work_dir:
+            partition_paths = self._partition_shards(shard_paths, work_dir)
+
+            for partition_path in partition_paths:
+                partition_df = pd.read_parquet(partition_path)
+                os.remove(partition_path)
+
+                partition_df, _, qid_row_starts = self._group_rows_by_qid(partition_df)
+
+                for start, stop in self._plan_row_ranges(qid_row_starts):
+                    yield partition_df.iloc[start:stop]
+
+                del partition_df
+                gc.collect()
+
+    def get_qid_batches(self) -> list[list[str]]:
+        ''''''
+
+        self._ensure_data_loaded()
+        
+        batches = []
+        
+        for i in range(0, len(self._unique_qids), self._qids_per_batch):
+            batch = self._unique_qids[i:i + self._qids_per_batch].tolist()
+            batches.append(batch)
+        
+        return batches
+
+    def get_batch_plan(self) -> list[tuple[int, int]]:
+        '''
+        Row ranges (start, stop) of the loaded data, one per batch of qids_per_batch qids in the same order as
+        get_qid_batches. The ranges are cheap to hand to other workers and are read back with fetch_batch.
+        '''
+
+        self._ensure_data_loaded()
+
+        return self._plan_row_ranges(self._qid_row_starts)
+
+    def fetch_batch(self, row_range: tuple[int, int]) -> pd.DataFrame:
+        '''Return the rows of a batch from get_batch_plan as a slice of the loaded data, without copying it.'''
+
+        self._ensure_data_loaded()
+
+        start, stop = row_range
+
+        return self._full_df.iloc[start:stop]
+    
+    def fetch_data_by_qids(self, qid_batch: list[str]) -> pd.DataFrame:
+        ''''''
+
+        self._ensure_data_loaded()
+
+        qid_codes = pd.Index(self._unique_qids).get_indexer(qid_batch)
+        qid_codes = np.sort(qid_codes[qid_codes >= 0])
+
+        if len(qid_codes) == 0:
+            return self._full_df.iloc[0:0]
+
+        if qid_codes[-1] - qid_codes[0] + 1 == len(qid_codes):
+            return self.fetch_batch((self._qid_row_starts[qid_codes[0]], self._qid_row_starts[qid_codes[-1] + 1]))
+
+        row_positions = np.concatenate([
+            np.arange(self._qid_row_starts[code], self._qid_row_starts[code + 1]) for code in qid_codes
+        ])
+        
+        return self._full_df.take(row_positions)
+    
+    def clear_cache(self) -> None:
+        ''''''
+
+        if self._full_df is not None:
+            del self._full_df
+            self._full_df = None
+            self._unique_qids = None
+            self._qid_row_starts = None
+            gc.collect()
+
+
+
+class DocumentBulkLoader:
+    '''
+    Saves consolidated document frames. On PostgreSQL the rows are streamed with COPY ... FROM STDIN in CSV chunks
+    written straight from the DataFrame, without creating model instances; other databases (SQLite in tests) use
+    bulk_create in batches. Loaded rows and time are accumulated to report the load throughput. upsert and
+    delete_missing keep the table in step with a new consolidation by qid and content_hash, touching only the
+    documents that are new, changed or gone.
+    '''
+
+    COLUMNS = ['parent_index', 'qid', 'question', 'metadata', 'consolidated_answers', 'content_hash']
+    LOOKUP_CHUNK = 900
+
+    def __init__(self, chunk_rows: int = 20000, using: str = 'default') -> object:
+        self._chunk_rows = chunk_rows
+        self._using = using
+        self.rows_loaded = 0
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        ''''''
+
+        return self.rows_loaded / self.seconds if self.seconds else 0.0
+
+    def _copy_sql(self, connection) -> str:
+        ''''''
+
+        columns = ', '.join(connection.ops.quote_name(Document._meta.get_field(name).column) for name in self.COLUMNS)
+
+        return f"COPY {connection.ops.quote_name(Document._meta.db_table)} ({columns}) FROM STDIN WITH (FORMAT csv)"
+
+    def _copy_chunks(self, documents_df: pd.DataFrame, connection) -> None:
+        ''''''
+
+        copy_sql = self._copy_sql(connection)
+
+        with connection.cursor() as cursor:
+            for start in range(0, len(documents_df), self._chunk_rows):
+                buffer = StringIO()
+
+                # Quoting every string keeps empty strings apart from NULL, which is an unquoted empty field in COPY csv
+                documents_df.iloc[start:start + self._chunk_rows].to_csv(
+                    buffer, columns = self.COLUMNS, header = False, index = False, quoting = csv.QUOTE_NONNUMERIC
+                )
+                buffer.seek(0)
+
+                if hasattr(cursor.cursor, 'copy_expert'):
+                    cursor.copy_expert(copy_sql, buffer)
+
+                else:
+                    with cursor.copy(copy_sql) as copy:
+                        copy.write(buffer.getvalue())
+
+                del buffer
+
+    def _bulk_create_chunks(self, documents_df: pd.DataFrame) -> None:
+        ''''''
+
+        for start in range(0, len(documents_df), self._chunk_rows):
+            documents = [
+                Document(
+                    parent_index = row.parent_index,
+                    qid = row.qid,
+                    question = row.question,
+                    metadata = row.metadata,
+                    consolidated_answers = row.consolidated_answers,
+                    content_hash = row.content_hash
+                )
+                for row in documents_df.iloc[start:start + self._chunk_rows][self.COLUMNS].itertuples(index = False)
+            ]
+
+            Document.objects.using(self._using).bulk_create(documents, batch_size = 1000)
+
+            del documents
+
+    def load(self, documents_df: pd.DataFrame) -> int:
+        '''Save every row of documents_df in one transaction and return how many rows were saved.'''
+
+        if documents_df.empty:
+            return 0
+
+        started_at = time.perf_counter()
+        connection = connections[self._using]
+
+        with transaction.atomic(using = self._using):
+            if connection.vendor == 'postgresql':
+                self._copy_chunks(documents_df, connection)
+
+            else:
+                self._bulk_create_chunks(documents_df)
+
+        self.rows_loaded += len(documents_df)
+        self.seconds += time.perf_counter() - started_at
+
+        return len(documents_df)
+
+    def _stored_hashes(self, qids: np.ndarray) -> dict:
+        ''''''
+
+        stored_hashes = {}
+
+        for start in range(0, len(qids), self.LOOKUP_CHUNK):
+            stored_hashes.update(
+                Document.objects.using(self._using)
+                .filter(qid__in = qids[start:start + self.LOOKUP_CHUNK].tolist())
+                .values_list('qid', 'content_hash')
+            )
+
+        return stored_hashes
+
+    def _delete_qids(self, qids: np.ndarray) -> None:
+        ''''''
+
+        for start in range(0, len(qids), self.LOOKUP_CHUNK):
+            Document.objects.using(self._using).filter(qid__in = qids[start:start + self.LOOKUP_CHUNK].tolist()).delete()
+
+    def upsert(self, documents_df: pd.DataFrame) -> int:
+        '''
+        Save the documents whose qid is new or whose content_hash changed, replacing the stored version, and leave the
+        unchanged ones alone. Returns how many documents were written; these are left with is_indexed false.
+        '''
+
+        if documents_df.empty:
+            return 0
+
+        with transaction.atomic(using = self._using):
+            stored_hashes = documents_df['qid'].map(self._stored_hashes(documents_df['qid'].to_numpy()))
+            changed_mask = stored_hashes.notna() & (stored_hashes != documents_df['content_hash'])
+
+            self._delete_qids(documents_df.loc[changed_mask, 'qid'].to_numpy())
+
+            return self.load(documents_df[stored_hashes.isna() | changed_mask])
+
+    def delete_missing(self, kept_qids: np.ndarray) -> np.ndarray:
+        '''Delete the stored documents whose qid is not in kept_qids, returning the deleted qids.'''
+
+        stored_qids = np.fromiter(
+            Document.objects.using(self._using).values_list('qid', flat = True).iterator(chunk_size = 10000),
+            dtype = np.int64
+        )
+        removed_qids = np.setdiff1d(stored_qids, kept_qids)
+
+        self._delete_qids(removed_qids)
+
+        return removed_qids
+
+
+
+class LanguageSignalClassifier:
+    '''
+    Computes the Python signal count, the other-language flag and the code block flag of a question and its answers
+    with a single regex traversal per text. All the keywords are compiled into one prefix-tree shaped pattern, word
+    boundaries are checked once a keyword matched, and the text is lowercased instead of matched with IGNORECASE.
+    Texts where a Python keyword and another-language keyword overlap (e.g. "pandaswift") could be counted differently
+    by one combined scan, so the scan reports them and they are recounted with the separate patterns.
+    '''
+
+    PYTHON_KEYWORDS = ('python', 'pandas', 'numpy', 'django', 'flask')
+    PYTHON_WORDS = ('def', 'class', 'import', 'self')
+    OTHER_LANGUAGE_KEYWORDS = ('php', 'objective-c', 'java', 'c#', 'swift', 'javascript')
+    CODE_FENCE = '```'
+
+    def __init__(self) -> object:
+        python_terms = self.PYTHON_KEYWORDS + self.PYTHON_WORDS
+
+        self._junctions = frozenset(
+            self._overlap_junctions(python_terms, self.OTHER_LANGUAGE_KEYWORDS) +
+            self._overlap_junctions(self.OTHER_LANGUAGE_KEYWORDS, python_terms)
+        )
+        self._other_keywords = frozenset(self.OTHER_LANGUAGE_KEYWORDS)
+
+        terms = {junction: False for junction in self._junctions}
+        terms.update({keyword: False for keyword in self.PYTHON_KEYWORDS + self.OTHER_LANGUAGE_KEYWORDS + (self.CODE_FENCE,)})
+        terms.update({word: True for word in self.PYTHON_WORDS})
+
+        self._scanner = re.compile(self._trie_pattern(terms))
+
+        self._python_pattern = re.compile('|'.join(
+            [re.escape(keyword) for keyword in self.PYTHON_KEYWORDS] + [f'\\b{re.escape(word)}\\b' for word in self.PYTHON_WORDS]
+        ))
+        self._other_language_pattern = re.compile('|'.join(re.escape(keyword) for keyword in self.OTHER_LANGUAGE_KEYWORDS))
+
+    @staticmethod
+    def _overlap_junctions(left_terms: tuple, right_terms: tuple) -> list[str]:
+        '''Shortest texts in which a left term and a right term starting inside it share characters.'''
+
+        junctions = []
+
+        for left in left_terms:
+            for right in right_terms:
+                for offset in range(len(left)):
+                    overlap = left[offset:offset + len(right)]
+
+                    if right.startswith(overlap):
+                        junctions.append(left[:offset] + right if len(right) > len(overlap) else left)
+
+        return junctions
+
+    @classmethod
+    def _trie_pattern(cls, terms: dict, prefix: str = '') -> str:
+        '''
+        Compile terms ({text: must be a whole word}) into a regex shaped like a prefix tree, so each position is tested
+        against one branch per distinct character instead of every term. Longer terms win over their prefixes, which is
+        what makes overlapping keywords show up as one of the junction terms.
+        '''
+
+        branches = {}
+
+        for term, whole_word in terms.items():
+            if term:
+                branches.setdefault(term[0], {})[term[1:]] = whole_word
+
+        alternatives = [
+            re.escape(character) + cls._trie_pattern(suffixes, prefix + character)
+            for character, suffixes in sorted(branches.items())
+        ]
+
+        if '' in terms:
+            alternatives.append(f'(?<=\\b{re.escape(prefix)})\\b' if terms[''] else '')
+
+        return alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+
+    def _scan(self, text: str) -> tuple:
+        '''Return (python signal count, other language flag, code block flag, needs exact recount) for one text.'''
+
+        matches = self._scanner.findall(text.lower())
+
+        if not matches:
+            return 0, False, False, False
+
+        if not self._junctions.isdisjoint(matches):
+            return 0, False, self.CODE_FENCE in matches, True
+
+        is_other_lang = not self._other_keywords.isdisjoint(matches)
+        has_code_block = self.CODE_FENCE in matches
+
+        python_signal_count = len(matches)
+
+        if is_other_lang:
+            python_signal_count -= sum(matches.count(keyword) for keyword in self.OTHER_LANGUAGE_KEYWORDS)
+
+        if has_code_block:
+            python_signal_count -= matches.count(self.CODE_FENCE)
+
+        return python_signal_count, is_other_lang, has_code_block, False
+
+    def _exact_count(self, question: str, answers: str) -> tuple:
+        ''''''
+
+        full_text_lower = question.lower() + " " + answers.lower()
+
+        return len(self._python_pattern.findall(full_text_lower)), self._other_language_pattern.search(full_text_lower) is not None
+
+    def classify(self, questions, answers) -> tuple[list, list, list]:
+        '''Return the python_signal_count, is_other_lang and has_code_block values for each question/answers pair.'''
+
+        python_signal_counts, other_lang_flags, code_block_flags = [], [], []
+
+        for question, answer in zip(questions, answers):
+            if not isinstance(question, str) or not isinstance(answer, str):
+                python_signal_counts.append(0)
+                other_lang_flags.append(False)
+                code_block_flags.append(isinstance(answer, str) and self.CODE_FENCE in answer)
+                continue
+
+            question_count, question_other, _, question_overlap = self._scan(question)
+            answer_count, answer_other, has_code_block, answer_overlap = self._scan(answer)
+
+            if question_overlap or answer_overlap:
+                python_signal_count, is_other_lang = self._exact_count(question, answer)
+
+            else:
+                python_signal_count, is_other_lang = question_count + answer_count, question_other or answer_other
+
+            python_signal_counts.append(python_signal_count)
+            other_lang_flags.append(is_other_lang)
+            code_block_flags.append(has_code_block)
+
+        return python_signal_counts, other_lang_flags, code_block_flags
+
+
+
+class DataConsolidationService:
+    ''''''
+
+    _language_classifier = LanguageSignalClassifier()
+
+    def __init__(self, batch_df: pd.DataFrame) -> object:
+        self._batch_df = batch_df
+
+    ANSWERS_SEPARATOR = "\n\n---\n\n"
+
+    def _join_unique_texts(self, qids: pd.Series, column: str) -> np.ndarray:
+        '''
+        Join the distinct non-null values of column for each qid with ANSWERS_SEPARATOR, in order of first appearance.
+        The (qid, value) pairs are deduplicated and stably sorted by qid, then joined per qid segment with a single
+        Arrow binary_join over a list array built from the segment offsets.
+        '''
+
+        pairs_df = self._batch_df[['qid', column]].dropna()
+        pairs_df[column] = pairs_df[column].astype(str)
+        pairs_df = pairs_df.drop_duplicates(keep = 'first')
+
+        qid_codes = pd.Index(qids).get_indexer(pairs_df['qid'])
+        row_order = np.argsort(qid_codes, kind = 'stable')
+
+        values = pa.array(pairs_df[column].to_numpy()[row_order], type = pa.large_string())
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(qid_codes, minlength = len(qids)))))
+
+        texts_per_qid = pa.LargeListArray.from_arrays(pa.array(offsets, type = pa.int64()), values)
+
+        separator = pa.scalar(self.ANSWERS_SEPARATOR, type = pa.large_string())
+
+        return pc.binary_join(texts_per_qid, separator).to_numpy(zero_copy_only = False)
+
+    def _group_question_answer(self) -> pd.DataFrame:
+        ''''''
+        
+        consolidated_df = self._batch_df.groupby('qid').agg(
+            question = ('question', 'first'),
+            metadata = ('metadata', 'first')
+        ).reset_index()
+
+        response_j = self._join_unique_texts(consolidated_df['qid'], 'response_j')
+        response_k = self._join_unique_texts(consolidated_df['qid'], 'response_k')
+
+        consolidated_df['consolidated_answers'] = pd.Series(response_j, dtype = object) + self.ANSWERS_SEPARATOR + pd.Series(response_k, dtype = object)
+
+        return consolidated_df
+
+    def _classify_relevant_sentences(self, consolidated_df: pd.DataFrame) -> pd.DataFrame:
+        ''''''
+        
+        consolidated_df_processed = consolidated_df.copy()
+
+        python_signal_counts, other_lang_flags, code_block_flags = self._language_classifier.classify(
+            consolidated_df_processed['question'], consolidated_df_processed['consolidated_answers']
+        )
+
+        consolidated_df_processed['python_signal_count'] = python_signal_counts
+        consolidated_df_processed['is_other_lang'] = other_lang_flags
+        consolidated_df_processed['has_code_block'] = code_block_flags
+
+        return consolidated_df_processed
+    
+    def _filter_by_flags(self, consolidated_df: pd.DataFrame) -> pd.DataFrame:
+        ''''''
+
+        final_mask = (
+            (consolidated_df['python_signal_count'] >= 3) & 
+            (~consolidated_df['is_other_lang']) & 
+            (consolidated_df['has_code_block'])
+        )
+
+        focused_df = consolidated_df[final_mask].copy()
+        focused_df.drop(columns = ['python_signal_count', 'is_other_lang', 'has_code_block'], inplace = True)
+
+        return focused_df
+
+    def consolidate(self) -> pd.DataFrame:
+        '''Group, classify and filter the batch, returning the documents to save with their parent_index and content_hash.'''
+
+        consolidated_df = self._group_question_answer()
+        
+        del self._batch_df
+        gc.collect()
+
+        consolidated_df_processed = self._classify_relevant_sentences(consolidated_df)
+        
+        del consolidated_df
+        gc.collect()
+
+        focused_df = self._filter_by_flags(consolidated_df_processed)
+        
+        del consolidated_df_processed
+        gc.collect()
+
+        # The qid identifies a document across batches and runs, so index entries keep pointing at the same document
+        focused_df = focused_df.reset_index(drop = True)
+        focused_df.insert(0, 'parent_index', focused_df['qid'])
+        focused_df['content_hash'] = [
+            hashlib.sha256(f'{question}\0{answers}'.encode()).hexdigest()
+            for question, answers in zip(focused_df['question'], focused_df['consolidated_answers'])
+        ]
+
+        return focused_df
+
+    @staticmethod
+    def persist_documents(focused_df: pd.DataFrame, loader: DocumentBulkLoader = None) -> int:
+        ''''''
+
+        if focused_df.empty:
+            return 0
+
+        loader = loader or DocumentBulkLoader()
+        docs_count = loader.upsert(focused_df)
+        
+        del focused_df
+        gc.collect()
+        
+        return docs_count
+
+    def consolidate_batch(self) -> int:
+        ''''''
+
+        return self.persist_documents(self.consolidate())
+
+
+
+class TrainingInProgressError(RuntimeError):
+    '''Raised when a training run starts while another one still owns the checkpoint.'''
+
+    def __init__(self, task_id: str) -> object:
+        super().__init__(f'Treinamento já em andamento pela tarefa {task_id}')
+        self.task_id = task_id
+
+
+
+class TrainingCheckpoint:
+    '''
+    Progress of a training run kept in TaskStatus.checkpoint, so a restarted or retried run continues where the last
+    one stopped instead of starting over. The consolidation stage records the documents written per batch number (and
+    the batch qids in the work directory, to find the documents that are gone), and the embedding stage the qids removed
+    from the table and the partial index shards written, each with the last document id it covers, or for a build
+    sharded across workers the document id range of each shard task and its progress.
+    '''
+
+    CONSOLIDATION = 'consolidation'
+    EMBEDDING = 'embedding'
+
+    def __init__(self, task_id: str, state: dict = None) -> object:
+        self._task_id = task_id
+        self.state = state or {}
+
+    @staticmethod
+    def live_runs(heartbeat_timeout: int = None):
+        '''Training runs still pending whose heartbeat is younger than heartbeat_timeout seconds.'''
+
+        if heartbeat_timeout is None:
+            heartbeat_timeout = settings.TRAINING_HEARTBEAT_TIMEOUT
+
+        return TaskStatus.objects.filter(
+            status = states.PENDING,
+            updated_at__gt = timezone.now() - timedelta(seconds = heartbeat_timeout)
+        )
+
+    @classmethod
+    def resume(cls, task_id: str, heartbeat_timeout: int = None) -> 'TrainingCheckpoint':
+        '''
+        Load the checkpoint of task_id. A task without one takes over the checkpoint of the latest run that did not
+        finish, which is then marked as failed so only one run owns it. Only a run that failed or stopped saving its
+        checkpoint for heartbeat_timeout seconds is taken over; while another run is alive TrainingInProgressError is
+        raised, since both would share its work directory.
+        '''
+
+        with transaction.atomic():
+            task_status = TaskStatus.objects.select_for_update().get(task_id = task_id)
+
+            if task_status.checkpoint is None:
+                unfinished_runs = (
+                    TaskStatus.objects.select_for_update()
+                    .exclude(task_id = task_id)
+                    .exclude(status = states.SUCCESS)
+                    .filter(checkpoint__isnull = False)
+                )
+
+                live_run = cls.live_runs(heartbeat_timeout).exclude(task_id = task_id).filter(checkpoint__isnull = False).first()
+
+                if live_run is not None:
+                    raise TrainingInProgressError(live_run.task_id)
+
+                previous_run = unfinished_runs.order_by('-updated_at').first()
+
+                if previous_run is not None:
+                    task_status.checkpoint = previous_run.checkpoint
+                    task_status.save(update_fields = ['checkpoint'])
+
+                    previous_run.checkpoint = None
+                    previous_run.status = states.FAILURE
+                    previous_run.result = f'Retomado pela tarefa {task_id}'
+                    previous_run.save(update_fields = ['checkpoint', 'status', 'result', 'updated_at'])
+
+        return cls(task_id, task_status.checkpoint)
+
+    def _save(self) -> None:
+        '''Save the checkpoint, which is also the heartbeat of the run.'''
+
+        TaskStatus.objects.filter(task_id = self._task_id).update(checkpoint = self.state, updated_at = timezone.now())
+
+    @property
+    def stage(self) -> str:
+        ''''''
+
+        return self.state.get('stage')
+
+    def matches(self, fingerprint: str) -> bool:
+        ''''''
+
+        return self.state.get('fingerprint') == fingerprint
+
+    def start(self, fingerprint: str, work_dir: str) -> None:
+        '''Start the consolidation stage over for the data identified by fingerprint, in an empty work_dir.'''
+
+        if os.path.exists(work_dir):
+            shutil.rmtree(work_dir)
+
+        os.makedirs(os.path.join(work_dir, 'qids'))
+
+        self.state = {'stage': self.CONSOLIDATION, 'fingerprint': fingerprint, 'work_dir': work_dir, 'batches': {}}
+        self._save()
+
+    @property
+    def work_dir(self) -> str:
+        ''''''
+
+        return self.state.get('work_dir')
+
+    @property
+    def completed_batches(self) -> set[int]:
+        ''''''
+
+        return {int(batch_idx) for batch_idx in self.state.get('batches', {})}
+
+    @property
+    def documents_saved(self) -> int:
+        ''''''
+
+        return sum(self.state.get('batches', {}).values())
+
+    def mark_batch_saved(self, batch_idx: int, docs_saved: int, qids: np.ndarray) -> None:
+        '''Record a saved batch; called inside the transaction that saves its documents, so both commit together.'''
+
+        np.save(os.path.join(self.work_dir, 'qids', f'batch_{batch_idx:05d}.npy'), qids)
+
+        self.state['batches'][str(batch_idx)] = docs_saved
+        self._save()
+
+    def consolidated_qids(self) -> np.ndarray:
+        '''Qids of every document consolidated by the saved batches.'''
+
+        qids_dir = os.path.join(self.work_dir, 'qids')
+        qids = [np.load(os.path.join(qids_dir, name)) for name in sorted(os.listdir(qids_dir))]
+
+        return np.concatenate(qids) if qids else np.array([], dtype = np.int64)
+
+    @property
+    def build_dir(self) -> str:
+        '''Directory of the partial index shards.'''
+
+        return os.path.join(self.work_dir, 'shards')
+
+    @property
+    def removed_qids(self) -> list[int]:
+        ''''''
+
+        return self.state.get('removed_qids', [])
+
+    def start_embedding(self, removed_qids: np.ndarray = None) -> None:
+        '''Move to the embedding stage, recording the qids deleted from the table for the indexer.'''
+
+        if os.path.exists(self.build_dir):
+            shutil.rmtree(self.build_dir)
+
+        os.makedirs(self.build_dir)
+
+        self.state.update({
+            'stage': self.EMBEDDING,
+            'removed_qids': [] if removed_qids is None else [int(qid) for qid in removed_qids],
+            'shards': [],
+            'index_shards': []
+        })
+        self._save()
+
+    @property
+    def shards(self) -> list[dict]:
+        ''''''
+
+        return self.state.get('shards', [])
+
+    @property
+    def last_embedded_id(self) -> int:
+        ''''''
+
+        return self.shards[-1]['last_id'] if self.shards else 0
+
+    @property
+    def documents_embedded(self) -> int:
+        ''''''
+
+        return sum(shard['documents'] for shard in self.shards)
+
+    def mark_shard_saved(self, path: str, last_id: int, documents: int) -> None:
+        ''''''
+
+        self.state.setdefault('shards', []).append({'path': path, 'last_id': last_id, 'documents': documents})
+        self._save()
+
+    @classmethod
+    def load(cls, task_id: str) -> 'TrainingCheckpoint':
+        '''The checkpoint of task_id as saved, for the tasks that build the index shards of its run.'''
+
+        return cls(task_id, TaskStatus.objects.get(task_id = task_id).checkpoint)
+
+    @property
+    def index_shards(self) -> list[dict]:
+        '''Document id ranges of a sharded index build, with the progress each shard task reported.'''
+
+        return self.state.get('index_shards', [])
+
+    def plan_index_shards(self, id_ranges: list[tuple[int, int]]) -> None:
+        '''Record the id ranges of a sharded build; a resumed run keeps the plan, and the shards already built.'''
+
+        if self.index_shards:
+            return
+
+        self.state['index_shards'] = [
+            {'after_id': after_id, 'up_to_id': up_to_id, 'documents': 0, 'path': None, 'done': False}
+            for after_id, up_to_id in id_ranges
+        ]
+        self._save()
+
+    def update_index_shard(self, shard: int, progress_message = None, **fields) -> list[dict]:
+        '''
+        Update the progress of a shard of a sharded build. The shard tasks report from several workers at once, so the
+        checkpoint is re-read under a row lock and only this shard is changed; progress_message, given the shards,
+        sets the result of the run in the same transaction.
+        '''
+
+        with transaction.atomic():
+            task_status = TaskStatus.objects.select_for_update().get(task_id = self._task_id)
+            task_status.checkpoint['index_shards'][shard].update(fields)
+            update_fields = ['checkpoint', 'updated_at']
+
+            if progress_message is not None:
+                task_status.result = progress_message(task_status.checkpoint['index_shards'])
+                update_fields.append('result')
+
+            task_status.save(update_fields = update_fields)
+
+        self.state = task_status.checkpoint
+
+        return self.index_shards
+
+    def finish(self) -> None:
+        '''Drop the checkpoint and its work directory once the final index is saved.'''
+
+        if self.work_dir and os.path.exists(self.work_dir):
+            shutil.rmtree(self.work_dir)
+
+        self.state = {}
+        TaskStatus.objects.filter(task_id = self._task_id).update(checkpoint = None)
+
+
+
+class TrainingHeartbeat:
+    '''
+    Refreshes the heartbeat (TaskStatus.updated_at) of a pending run from a background thread every interval seconds,
+    so stages that save no checkpoint for a long time, such as downloads, an incremental update, a shard merge or the
+    training of the index, are not taken for a dead run.
+    '''
+
+    def __init__(self, task_id: str, interval: float = None) -> object:
+        self._task_id = task_id
+        self._interval = interval if interval is not None else settings.TRAINING_HEARTBEAT_TIMEOUT / 4
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def beat(self) -> None:
+        ''''''
+
+        TaskStatus.objects.filter(task_id = self._task_id, status = states.PENDING).update(updated_at = timezone.now())
+
+    def _run(self) -> None:
+        ''''''
+
+        try:
+            while not self._stopped.wait(self._interval):
+                try:
+                    self.beat()
+
+                except Exception as e:
+                    logger.warning('Could not refresh the heartbeat of %s: %s', self._task_id, e)
+
+        finally:
+            connections.close_all()
+
+    def start(self) -> 'TrainingHeartbeat':
+        ''''''
+
+        self._thread = threading.Thread(target = self._run, name = f'heartbeat-{self._task_id}', daemon = True)
+        self._thread.start()
+
+        return self
+
+    def stop(self) -> None:
+        ''''''
+
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+
+
+_consolidation_worker_fetch_data = None
+
+
+def _init_consolidation_worker(fetch_data: FetchDataService) -> None:
+    '''Keep the FetchDataService inherited from the parent through fork, so batches can be sent as row ranges.'''
+
+    global _consolidation_worker_fetch_data
+    _consolidation_worker_fetch_data = fetch_data
+
+
+def _consolidate_in_worker(batch) -> pd.DataFrame:
+    ''''''
+
+    if isinstance(batch, tuple):
+        batch = _consolidation_worker_fetch_data.fetch_batch(batch)
+
+    return DataConsolidationService(batch).consolidate()
+
+
+
+class ParallelConsolidationService:
+    '''
+    Consolidates qid batches on a pool of forked worker processes and saves the results from the calling process,
+    in batch order. Batches are either DataFrames or row ranges from FetchDataService.get_batch_plan, which the
+    workers read from the data inherited from the parent without copying it through the pool.
+    '''
+
+    def __init__(
+        self, workers: int = 1, worker_memory_mb: int = None, batches_per_child: int = 10,
+        fetch_data: FetchDataService = None, loader: DocumentBulkLoader = None, on_batch_saved = None
+    ) -> object:
+        self._workers = workers
+        self._worker_memory_mb = worker_memory_mb
+        self._batches_per_child = batches_per_child
+        self.loader = loader or DocumentBulkLoader()
+        self._fetch_data = fetch_data
+        self._on_batch_saved = on_batch_saved
+
+    @staticmethod
+    def _available_memory_bytes() -> int:
+        ''''''
+
+        try:
+            with open('/proc/meminfo') as meminfo:
+                for line in meminfo:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+
+        except (OSError, ValueError, IndexError):
+            pass
+
+        return None
+
+    def get_worker_count(self) -> int:
+        '''Configured workers (0 means one per CPU), reduced so that every worker fits its memory budget.'''
+
+        workers = self._workers or os.cpu_count() or 1
+
+        if self._worker_memory_mb:
+            available_memory = self._available_memory_bytes()
+
+            if available_memory is not None:
+                workers = min(workers, max(1, available_memory // (self._worker_memory_mb * 1024 * 1024)))
+
+        return workers
+
+    def _consolidate_in_process(self, batch) -> pd.DataFrame:
+        ''''''
+
+        if isinstance(batch, tuple):
+            batch = self._fetch_data.fetch_batch(batch)
+
+        return DataConsolidationService(batch).consolidate()
+
+    def _persist(self, batch_idx: int, focused_df: pd.DataFrame) -> tuple[int, int]:
+        '''Save a consolidated batch and report it with its qids to on_batch_saved in the same transaction.'''
+
+        qids = focused_df['qid'].to_numpy()
+
+        with transaction.atomic():
+            docs_saved = DataConsolidationService.persist_documents(focused_df, self.loader)
+
+            if self._on_batch_saved:
+                self._on_batch_saved(batch_idx, docs_saved, qids)
+
+        return batch_idx, docs_saved
+
+    def consolidate_batches(self, batches, skip_batches: set[int] = None):
+        '''
+        Consolidate and save every batch, yielding (batch number, documents written) in batch order. Batches whose
+        number is in skip_batches were saved by an earlier run and are passed over.
+        '''
+
+        skip_batches = skip_batches or set()
+        workers = self.get_worker_count()
+
+        if workers == 1:
+            for batch_idx, batch in enumerate(batches):
+                if batch_idx not in skip_batches:
+                    yield self._persist(batch_idx, self._consolidate_in_process(batch))
+
+            return
+
+        # The workers never use the database, close the parent connections so none is shared through fork
+        for connection in connections.all():
+            if not connection.in_atomic_block:
+                connection.close()
+
+        pool = multiprocessing.get_context('fork').Pool(
+            processes = workers,
+            initializer = _init_consolidation_worker,
+            initargs = (self._fetch_data,),
+            maxtasksperchild = self._batches_per_child
+        )
+
+        pending = deque()
+
+        try:
+            for batch_idx, batch in enumerate(batches):
+                if batch_idx in skip_batches:
+                    continue
+
+                pending.append((batch_idx, pool.apply_async(_consolidate_in_worker, (batch,))))
+                del batch
+
+                # Bound the batches in flight so a streaming source is not read ahead of the workers
+                while len(pending) > workers * 2:
+                    batch_idx, result = pending.popleft()
+                    yield self._persist(batch_idx, result.get())
+
+            while pending:
+                batch_idx, result = pending.popleft()
+                yield self._persist(batch_idx, result.get())
+
+            pool.close()
+
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+
+class OnnxEmbeddings(Embeddings):
+    '''
+    A sentence-transformers model run with ONNX Runtime on CPU, optionally with int8 weights. Texts are tokenized once,
+    sorted by token count and embedded in batches of neighbouring lengths, each padded only to its longest text and
+    capped at max_batch_tokens, then pooled and normalized as the sentence-transformers pipeline does.
+    '''
+
+    CONFIG_FILE = 'embedding_config.json'
+    MODEL_FILE = 'model.onnx'
+    INT8_MODEL_FILE = 'model.int8.onnx'
+
+    def __init__(
+        self, model_dir: str, quantized: bool = False, batch_size: int = 32, max_batch_tokens: int = 4096,
+        threads: int = 0
+    ) -> object:
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(model_dir, self.CONFIG_FILE)) as config_file:
+            model_config = json.load(config_file)
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = threads
+
+        self._session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, self.INT8_MODEL_FILE if quantized else self.MODEL_FILE),
+            session_options, providers = ['CPUExecutionProvider']
+        )
+        self._input_names = [model_input.name for model_input in self._session.get_inputs()]
+        self._tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self._max_length = model_config['max_length']
+        self._normalize = model_config['normalize']
+        self._batch_size = batch_size
+        self._max_batch_tokens = max_batch_tokens
+        self.padding_ratio = 0.0
+
+    @classmethod
+    def export(cls, model_name: str, model_dir: str, quantized: bool = False) -> None:
+        '''
+        Export the transformer of a sentence-transformers model to model_dir as ONNX, with its tokenizer and pooling
+        settings, and with quantized an int8 copy whose weights are quantized dynamically.
+        '''
+
+        from sentence_transformers import SentenceTransformer
+
+        os.makedirs(model_dir, exist_ok = True)
+
+        model = SentenceTransformer(model_name, device = 'cpu')
+        transformer = model[0].auto_model
+        # Two texts of different lengths, so the traced graph applies the padding mask
+        sample = model.tokenizer(['export sample text', 'export'], padding = True, return_tensors = 'pt')
+        input_names = list(sample.keys())
+
+        class Encoder(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.transformer = transformer
+
+            def forward(self, *inputs):
+                return self.transformer(**dict(zip(input_names, inputs))).last_hidden_state
+
+        model_path = os.path.join(model_dir, cls.MODEL_FILE)
+
+        # The tracer warns about the mask checks of the attention, which are constant for an encoder given a mask
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+
+            torch.onnx.export(
+                Encoder().eval(), tuple(sample[name] for name in input_names), model_path,
+                input_names = input_names, output_names = ['last_hidden_state'],
+                dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names + ['last_hidden_state']},
+                opset_version = 17, dynamo = False
+            )
+
+        if quantized:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            quantize_dynamic(model_path, os.path.join(model_dir, cls.INT8_MODEL_FILE), weight_type = QuantType.QInt8)
+
+        model.tokenizer.save_pretrained(model_dir)
+
+        with open(os.path.join(model_dir, cls.CONFIG_FILE), 'w') as config_file:
+            json.dump({
+                'model_name': model_name,
+                'max_length': model.max_seq_length,
+                'normalize': any(type(module).__name__ == 'Normalize' for module in model)
+            }, config_file)
+
+    @classmethod
+    def is_exported(cls, model_dir: str, quantized: bool = False) -> bool:
+        ''''''
+
+        model_file = cls.INT8_MODEL_FILE if quantized else cls.MODEL_FILE
+
+        return all(os.path.exists(os.path.join(model_dir, file_name)) for file_name in (cls.CONFIG_FILE, model_file))
+
+    def _batches(self, lengths: np.ndarray):
+        '''Rows of each batch, in increasing token count, each within batch_size rows and max_batch_tokens tokens.'''
+
+        order = np.argsort(lengths, kind = 'stable')
+        start = 0
+
+        while start < len(order):
+            end = start + 1
+
+            while end < len(order) and end - start < self._batch_size and (end - start + 1) * lengths[order[end]] <= self._max_batch_tokens:
+                end += 1
+
+            yield order[start:end]
+            start = end
+
+    def _embed(self, texts: list[str]) -> np.ndarray:
+        ''''''
+
+        encoded = self._tokenizer(texts, truncation = True, max_length = self._max_length)
+        lengths = np.array([len(input_ids) for input_ids in encoded['input_ids']])
+        embeddings = None
+        padded_tokens = 0
+
+        for rows in self._batches(lengths):
+            width = int(lengths[rows].max())
+            feed = {name: np.zeros((len(rows), width), dtype = np.int64) for name in self._input_names}
+
+            for position, row in enumerate(rows):
+                for name in self._input_names:
+                    feed[name][position, :lengths[row]] = encoded[name][row]
+
+            hidden = self._session.run(['last_hidden_state'], feed)[0]
+            mask = feed['attention_mask'][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis = 1) / np.maximum(mask.sum(axis = 1), 1e-9)
+
+            if self._normalize:
+                pooled /= np.maximum(np.linalg.norm(pooled, axis = 1, keepdims = True), 1e-12)
+
+            if embeddings is None:
+                embeddings = np.empty((len(texts), pooled.shape[1]), dtype = np.float32)
+
+            embeddings[rows] = pooled
+            padded_tokens += len(rows) * width
+
+        self.padding_ratio = 1 - lengths.sum() / padded_tokens if padded_tokens else 0.0
+
+        return embeddings
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        ''''''
+
+        if not texts:
+            return []
+
+        return self._embed(texts).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        ''''''
+
+        return self._embed([text])[0].tolist()
+
+
+
+class EmbeddingBackend:
+    '''
+    Which implementation embeds the chunks and the queries: 'torch' runs the sentence-transformers model through
+    HuggingFaceEmbeddings, 'onnx' runs it with ONNX Runtime (int8 with quantized), exporting it to onnx_dir the first
+    time. The float32 ONNX model gives the torch vectors up to rounding, so both share an index and its embedding
+    cache; int8 vectors are only close to them, and are cached apart.
+    '''
+
+    TORCH = 'torch'
+    ONNX = 'onnx'
+
+    def __init__(
+        self, name: str = TORCH, model_name: str = 'all-MiniLM-L6-v2', onnx_dir: str = None, quantized: bool = False,
+        batch_size: int = 32, max_batch_tokens: int = 4096, threads: int = 0
+    ) -> object:
+        if name not in (self.TORCH, self.ONNX):
+            raise ValueError(f'Unknown embedding backend: {name}')
+
+        if name == self.ONNX and not onnx_dir:
+            raise ValueError('The onnx embedding backend needs onnx_dir')
+
+        self.name = name
+        self.model_name = model_name
+        self._onnx_dir = onnx_dir
+        self._quantized = quantized
+        self._batch_size = batch_size
+        self._max_batch_tokens = max_batch_tokens
+        self._threads = threads
+
+    @classmethod
+    def from_settings(cls) -> 'EmbeddingBackend':
+        ''''''
+
+        return cls(
+            name = settings.EMBEDDING_BACKEND,
+            onnx_dir = settings.EMBEDDING_ONNX_DIR,
+            quantized = settings.EMBEDDING_ONNX_INT8,
+            batch_size = settings.EMBEDDING_ONNX_BATCH_SIZE,
+            max_batch_tokens = settings.EMBEDDING_ONNX_MAX_BATCH_TOKENS,
+            threads = settings.EMBEDDING_ONNX_THREADS
+        )
+
+    @property
+    def cache_name(self) -> str:
+        ''''''
+
+        return f'{self.model_name}-int8' if self.name == self.ONNX and self._quantized else self.model_name
+
+    def export(self) -> None:
+        '''Export the model for the onnx backend unless it already is, one process at a time.'''
+
+        os.makedirs(self._onnx_dir, exist_ok = True)
+
+        with open(os.path.join(self._onnx_dir, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            if not OnnxEmbeddings.is_exported(self._onnx_dir, self._quantized):
+                OnnxEmbeddings.export(self.model_name, self._onnx_dir, self._quantized)
+
+    def load(self, device: str = None) -> Embeddings:
+        '''The embedding model; the torch backend runs on device, CUDA when available by default.'''
+
+        if self.name == self.TORCH:
+            return HuggingFaceEmbeddings(
+                model_name = self.model_name,
+                model_kwargs = {'device': device or ('cuda' if torch.cuda.is_available() else 'cpu')}
+            )
+
+        self.export()
+
+        return OnnxEmbeddings(
+            self._onnx_dir, quantized = self._quantized, batch_size = self._batch_size,
+            max_batch_tokens = self._max_batch_tokens, threads = self._threads
+        )
+
+
+
+class EmbeddingCache:
+    '''
+    On-disk cache of chunk embeddings for one model, keyed by a 64-bit hash of the cleaned chunk text. Vectors are
+    appended to a float32 file read through a memory map, row i of the vectors belonging to key i of a parallel
+    uint64 key file; a sorted copy of the keys answers lookups with a binary search. Each row also records the last
+    run (generation) that used it, which compact uses to evict the least recently used rows. The cache directory is
+    locked while the cache is open, so a compaction never runs under a training run.
+    '''
+
+    def __init__(self, cache_dir: str, model_name: str) -> object:
+        self.model_name = model_name
+        self.path = os.path.join(cache_dir, re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name))
+        os.makedirs(self.path, exist_ok = True)
+
+        self._lock_file = open(os.path.join(self.path, '.lock'), 'w')
+
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        except BlockingIOError:
+            self._lock_file.close()
+            raise RuntimeError(f'Cache de embeddings em uso por outro processo: {self.path}')
+
+        meta = {}
+
+        if os.path.exists(self._file('meta.json')):
+            with open(self._file('meta.json')) as meta_file:
+                meta = json.load(meta_file)
+
+        self.dimension = meta.get('dimension')
+        self._generation = meta.get('generation', 0) + 1
+
+        keys = np.fromfile(self._file('keys.u64'), dtype = np.uint64) if os.path.exists(self._file('keys.u64')) else np.array([], dtype = np.uint64)
+        vector_rows = os.path.getsize(self._file('vectors.f32')) // (self.dimension * 4) if self.dimension and os.path.exists(self._file('vectors.f32')) else 0
+
+        # A run stopped between writing vectors and keys leaves rows without a key, which are dropped
+        self.rows = min(len(keys), vector_rows)
+        self._keys = keys[:self.rows]
+        self._truncate_files()
+
+        stamps = np.fromfile(self._file('stamps.u32'), dtype = np.uint32) if os.path.exists(self._file('stamps.u32')) else np.array([], dtype = np.uint32)
+        self._stamps = np.zeros(self.rows, dtype = np.uint32)
+        self._stamps[:min(len(stamps), self.rows)] = stamps[:self.rows]
+
+        self._sorted_rows = np.argsort(self._keys, kind = 'stable')
+        self._sorted_keys = self._keys[self._sorted_rows]
+        self._vectors = None
+        self.hits = 0
+        self.misses = 0
+
+    def _file(self, name: str) -> str:
+        ''''''
+
+        return os.path.join(self.path, name)
+
+    def _truncate_files(self) -> None:
+        ''''''
+
+        if os.path.exists(self._file('keys.u64')):
+            os.truncate(self._file('keys.u64'), self.rows * 8)
+
+        if os.path.exists(self._file('vectors.f32')):
+            os.truncate(self._file('vectors.f32'), self.rows * (self.dimension or 0) * 4)
+
+    @staticmethod
+    def text_keys(texts: list[str]) -> np.ndarray:
+        ''''''
+
+        return np.array(
+            [int.from_bytes(hashlib.blake2b(text.encode(), digest_size = 8).digest(), 'little') for text in texts],
+            dtype = np.uint64
+        )
+
+    @property
+    def hit_rate(self) -> float:
+        ''''''
+
+        lookups = self.hits + self.misses
+
+        return self.hits / lookups if lookups else 0.0
+
+    @property
+    def size_bytes(self) -> int:
+        ''''''
+
+        return self.rows * ((self.dimension or 0) * 4 + 8 + 4)
+
+    def _vector_map(self) -> np.ndarray:
+        ''''''
+
+        if self._vectors is None:
+            self._vectors = np.memmap(self._file('vectors.f32'), dtype = np.float32, mode = 'r', shape = (self.rows, self.dimension))
+
+        return self._vectors
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        '''Rows holding the vectors of keys, -1 for the keys not in the cache.'''
+
+        rows = np.full(len(keys), -1, dtype = np.int64)
+
+        if self.rows:
+            positions = np.minimum(np.searchsorted(self._sorted_keys, keys), self.rows - 1)
+            found = self._sorted_keys[positions] == keys
+            rows[found] = self._sorted_rows[positions[found]]
+            self._stamps[rows[found]] = self._generation
+
+        self.hits += int((rows >= 0).sum())
+        self.misses += int((rows < 0).sum())
+
+        return rows
+
+    def vectors(self, rows: np.ndarray) -> np.ndarray:
+        ''''''
+
+        return np.asarray(self._vector_map()[rows], dtype = np.float32)
+
+    def add(self, keys: np.ndarray, vectors: np.ndarray) -> None:
+        '''Append the vectors of keys that are not cached yet; keys must be unique.'''
+
+        vectors = np.ascontiguousarray(vectors, dtype = np.float32)
+
+        if self.dimension is None:
+            self.dimension = vectors.shape[1]
+            self.flush()
+
+        # Vectors go first, so keys never point past the end of the vector file
+        with open(self._file('vectors.f32'), 'ab') as vectors_file:
+            vectors_file.write(vectors.tobytes())
+
+        with open(self._file('keys.u64'), 'ab') as keys_file:
+            keys_file.write(keys.astype(np.uint64).tobytes())
+
+        new_rows = np.arange(self.rows, self.rows + len(keys))
+        order = np.argsort(keys, kind = 'stable')
+        positions = np.searchsorted(self._sorted_keys, keys[order])
+
+        self._sorted_keys = np.insert(self._sorted_keys, positions, keys[order])
+        self._sorted_rows = np.insert(self._sorted_rows, positions, new_rows[order])
+        self._keys = np.concatenate((self._keys, keys.astype(np.uint64)))
+        self._stamps = np.concatenate((self._stamps, np.full(len(keys), self._generation, dtype = np.uint32)))
+        self.rows += len(keys)
+        self._vectors = None
+
+    def embed(self, texts: list[str], embedding_model) -> np.ndarray:
+        '''Embeddings of texts as a float32 matrix, computing with embedding_model only the texts not cached.'''
+
+        keys = self.text_keys(texts)
+        rows = self.lookup(keys)
+        missing = np.flatnonzero(rows < 0)
+
+        if len(missing):
+            missing_keys, first_positions, inverse = np.unique(keys[missing], return_index = True, return_inverse = True)
+            computed = np.asarray(
+                embedding_model.embed_documents([texts[missing[position]] for position in first_positions]), dtype = np.float32
+            )
+            self.add(missing_keys, computed)
+
+        embeddings = np.empty((len(texts), self.dimension), dtype = np.float32)
+        found = rows >= 0
+        embeddings[found] = self.vectors(rows[found])
+
+        if len(missing):
+            embeddings[missing] = computed[inverse.reshape(-1)]
+
+        return embeddings
+
+    def flush(self) -> None:
+        '''Save the row generations and the metadata.'''
+
+        self._stamps.tofile(self._file('stamps.u32'))
+
+        with open(self._file('meta.json'), 'w') as meta_file:
+            json.dump({'model_name': self.model_name, 'dimension': self.dimension, 'generation': self._generation}, meta_file)
+
+    def compact(self, max_bytes: int) -> int:
+        '''
+        Keep the most recently used rows that fit in max_bytes, rewriting the files without the others. Returns the
+        number of rows evicted.
+        '''
+
+        row_bytes = (self.dimension or 0) * 4 + 8 + 4
+
+        if not self.rows or self.size_bytes <= max_bytes:
+            return 0
+
+        keep_rows = max_bytes // row_bytes
+        # Newest generation first, and the rows added last first within a generation
+        by_recency = np.lexsort((-np.arange(self.rows), -self._stamps.astype(np.int64)))
+        kept = np.sort(by_recency[:keep_rows])
+
+        kept_vectors = self.vectors(kept)
+        self._vectors = None
+
+        for name, data in (('vectors.f32', kept_vectors), ('keys.u64', self._keys[kept]), ('stamps.u32', self._stamps[kept])):
+            data.tofile(self._file(f'{name}.tmp'))
+            os.replace(self._file(f'{name}.tmp'), self._file(name))
+
+        evicted = self.rows - len(kept)
+
+        self._keys = self._keys[kept]
+        self._stamps = self._stamps[kept]
+        self.rows = len(kept)
+        self._sorted_rows = np.argsort(self._keys, kind = 'stable')
+        self._sorted_keys = self._keys[self._sorted_rows]
+        self.flush()
+
+        return evicted
+
+    def close(self) -> None:
+        ''''''
+
+        self.flush()
+        self._vectors = None
+        self._lock_file.close()
+
+
+
+class PipelineStageStats:
+    '''Items and busy seconds per pipeline stage, updated from any thread, to report the throughput of each stage.'''
+
+    def __init__(self) -> object:
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def add(self, stage: str, items: int, seconds: float) -> None:
+        ''''''
+
+        with self._lock:
+            stage_items, stage_seconds = self._stages.get(stage, (0, 0.0))
+            self._stages[stage] = (stage_items + items, stage_seconds + seconds)
+
+    def throughput(self) -> dict[str, float]:
+        '''Items per busy second of each stage, in the order the stages first reported.'''
+
+        with self._lock:
+            return {stage: items / seconds if seconds else 0.0 for stage, (items, seconds) in self._stages.items()}
+
+    def summary(self) -> str:
+        ''''''
+
+        return ', '.join(f'{stage} {rate:,.0f}/s' for stage, rate in self.throughput().items())
+
+
+
+class FaissIndexBuilder:
+    '''
+    Turns the exact flat index built from the embeddings into the index described by spec, a preset name or a FAISS
+    index_factory string. Quantizers are trained on a random sample of the vectors, and the build is checked against
+    exact search on held-out query vectors: recall@k and p50/p99 single-query latency of both indexes. The factory
+    string, search parameters and report are saved next to the index in index_params.json and the search parameters
+    are applied again when the index is loaded.
+    '''
+
+    PARAMS_FILE = 'index_params.json'
+    PRESETS = {
+        'flat': 'Flat',
+        'ivf-flat': 'IVF{nlist},Flat',
+        'ivf-pq': 'IVF{nlist},PQ{pq_m}',
+        'hnsw': 'HNSW32',
+        'sq8': 'SQ8',
+    }
+
+    def __init__(
+        self, spec: str = 'flat', train_size: int = 100000, nprobe: int = 16, ef_search: int = 64,
+        report_queries: int = 200, k: int = 10, seed: int = 0
+    ) -> object:
+        self.spec = spec
+        self._train_size = train_size
+        self._nprobe = nprobe
+        self._ef_search = ef_search
+        self._report_queries = report_queries
+        self._k = k
+        self._seed = seed
+
+    @property
+    def is_exact(self) -> bool:
+        ''''''
+
+        return self.PRESETS.get(self.spec, self.spec) == 'Flat'
+
+    def factory_string(self, dimension: int, train_vectors: int) -> str:
+        '''The index_factory string of spec, with the IVF list count sized to the training vectors and PQ to the dimension.'''
+
+        # About 4 * sqrt(n) lists, with the 39 training points per list FAISS asks for
+        nlist = max(1, min(int(4 * np.sqrt(train_vectors)), train_vectors // 39))
+        pq_m = next(m for m in range(max(1, dimension // 8), 0, -1) if dimension % m == 0)
+
+        return self.PRESETS.get(self.spec, self.spec).format(nlist = nlist, pq_m = pq_m)
+
+    def search_parameters(self, factory: str) -> str:
+        ''''''
+
+        parameters = []
+
+        if 'IVF' in factory:
+            parameters.append(f'nprobe={self._nprobe}')
+
+        if 'HNSW' in factory:
+            parameters.append(f'efSearch={self._ef_search}')
+
+        return ','.join(parameters)
+
+    @staticmethod
+    def _flat_vectors(flat_index) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        The vectors of an IndexFlat (bare or in an IndexIDMap2) as an array over its storage, without copying them,
+        and the id of each row.
+        '''
+
+        if isinstance(flat_index, faiss.IndexIDMap2):
+            ids = faiss.vector_to_array(flat_index.id_map)
+            flat_index = faiss.downcast_index(flat_index.index)
+
+        else:
+            ids = np.arange(flat_index.ntotal, dtype = np.int64)
+
+        vectors = faiss.rev_swig_ptr(flat_index.get_xb(), flat_index.ntotal * flat_index.d).reshape(flat_index.ntotal, flat_index.d)
+
+        return vectors, ids
+
+    def build(self, flat_index) -> tuple:
+        '''Return the index of spec, in an IndexIDMap2, holding the vectors of flat_index with the same ids, and its parameters.'''
+
+        vectors, ids = self._flat_vectors(flat_index)
+        total_vectors, dimension = vectors.shape
+        rng = np.random.default_rng(self._seed)
+
+        query_rows = rng.choice(total_vectors, size = min(self._report_queries, total_vectors), replace = False)
+        train_rows = np.setdiff1d(np.arange(total_vectors), query_rows)
+
+        if len(train_rows) > self._train_size:
+            train_rows = np.sort(rng.choice(train_rows, size = self._train_size, replace = False))
+
+        factory = self.factory_string(dimension, max(len(train_rows), 1))
+        index = faiss.IndexIDMap2(faiss.index_factory(dimension, factory))
+
+        started_at = time.perf_counter()
+        if not index.is_trained:
+            index.train(np.ascontiguousarray(vectors[train_rows] if len(train_rows) else vectors))
+        train_seconds = time.perf_counter() - started_at
+
+        for start in range(0, total_vectors, 100000):
+            index.add_with_ids(vectors[start:start + 100000], ids[start:start + 100000])
+
+        search_parameters = self.search_parameters(factory)
+        self.apply_search_parameters(index, search_parameters)
+
+        params = {
+            'spec': self.spec,
+            'factory': factory,
+            'search_parameters': search_parameters,
+            'dimension': dimension,
+            'total_vectors': total_vectors,
+            'train_vectors': int(len(train_rows)),
+            'train_seconds': round(train_seconds, 3),
+            'report': self.report(flat_index, index, query_rows),
+        }
+
+        return index, params
+
+    @staticmethod
+    def _latencies_ms(index, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        ''''''
+
+        latencies, labels = [], []
+
+        for query in queries:
+            started_at = time.perf_counter()
+            _, query_labels = index.search(query.reshape(1, -1), k)
+            latencies.append((time.perf_counter() - started_at) * 1000)
+            labels.append(query_labels[0])
+
+        return np.array(latencies), np.array(labels)
+
+    def report(self, flat_index, index, query_rows: np.ndarray) -> dict:
+        '''
+        Recall@k of index against exact search on flat_index for the vectors at query_rows, and the p50/p99
+        latency of both. The query vectors are in both indexes, so each query's own row is left out of its results.
+        '''
+
+        vectors, ids = self._flat_vectors(flat_index)
+        queries = np.ascontiguousarray(vectors[query_rows])
+        query_ids = ids[query_rows]
+        k = min(self._k, flat_index.ntotal - 1)
+
+        if k < 1:
+            return {}
+
+        exact_latencies, exact_labels = self._latencies_ms(flat_index, queries, k + 1)
+        approximate_latencies, approximate_labels = self._latencies_ms(index, queries, k + 1)
+
+        recalls = []
+
+        for query_id, exact, approximate in zip(query_ids, exact_labels, approximate_labels):
+            exact_neighbours = [label for label in exact if label != query_id][:k]
+            approximate_neighbours = {label for label in approximate if label != query_id and label >= 0}
+            recalls.append(len(approximate_neighbours.intersection(exact_neighbours)) / len(exact_neighbours))
+
+        return {
+            'k': k,
+            'queries': int(len(query_rows)),
+            'recall_at_k': round(float(np.mean(recalls)), 4),
+            'exact_p50_ms': round(float(np.percentile(exact_latencies, 50)), 4),
+            'exact_p99_ms': round(float(np.percentile(exact_latencies, 99)), 4),
+            'p50_ms': round(float(np.percentile(approximate_latencies, 50)), 4),
+            'p99_ms': round(float(np.percentile(approximate_latencies, 99)), 4),
+        }
+
+    @staticmethod
+    def summary(params: dict) -> str:
+        ''''''
+
+        report = params.get('report')
+
+        if not report:
+            return params['factory']
+
+        return (
+            f"{params['factory']}: recall@{report['k']} {report['recall_at_k']:.3f}, "
+            f"p50 {report['p50_ms']:.2f} ms / p99 {report['p99_ms']:.2f} ms "
+            f"(busca exata {report['exact_p50_ms']:.2f} / {report['exact_p99_ms']:.2f} ms)"
+        )
+
+    @staticmethod
+    def apply_search_parameters(index, search_parameters: str) -> None:
+        ''''''
+
+        if search_parameters:
+            faiss.ParameterSpace().set_index_parameters(index, search_parameters)
+
+    @classmethod
+    def save_params(cls, faiss_path: str, params: dict) -> None:
+        ''''''
+
+        with open(os.path.join(faiss_path, cls.PARAMS_FILE), 'w') as params_file:
+            json.dump(params, params_file, indent = 2)
+
+    @classmethod
+    def load_params(cls, faiss_path: str) -> dict:
+        '''Parameters saved with the index at faiss_path, None for an index saved without them.'''
+
+        params_path = os.path.join(faiss_path, cls.PARAMS_FILE)
+
+        if not os.path.exists(params_path):
+            return None
+
+        with open(params_path) as params_file:
+            return json.load(params_file)
+
+
+
+class TextCleaner:
+    '''
+    Cleans the chunk text for embedding. Text without a '<' or a '&' holds neither tags nor entities, so it skips the
+    parser and goes straight to the precompiled substitutions. clean_with_offsets also maps every cleaned character back to the raw character it
+    came from, so a document is cleaned once and the raw text of each chunk of the cleaned text can still be stored.
+    '''
+
+    URL_PATTERN = re.compile(r'http\S+|www\S+|https\S+', re.MULTILINE)
+    LINK_PATTERN = re.compile(r'\[([^\]]*)\]\([^\)]*\)?')
+    FENCE_PATTERN = re.compile(r'```[a-zA-Z]*\n')
+    WHITESPACE_PATTERN = re.compile(r'\s+')
+    BACKTICK = ord('`')
+    SPACE = ord(' ')
+    WHITESPACE_CODES = np.array([code for code in range(0x3001) if chr(code).isspace()], dtype = np.uint32)
+
+    @staticmethod
+    def _has_html(text: str) -> bool:
+        '''Whether the parser could change text: it holds a tag or an entity to decode.'''
+
+        return '<' in text or '&' in text
+
+    def _html_strings(self, text: str) -> list[str]:
+        '''The text nodes of the parsed HTML, in order, which joined are its text.'''
+
+        try:
+            return list(BeautifulSoup(text, "lxml").strings)
+
+        except Exception:
+            return [text]
+
+    def clean(self, text: str) -> str:
+        ''''''
+
+        if not isinstance(text, str):
+            return ""
+
+        if self._has_html(text):
+            text = ''.join(self._html_strings(text))
+
+        text = self.URL_PATTERN.sub('', text)
+        text = self.LINK_PATTERN.sub(r'\1', text)
+        text = self.FENCE_PATTERN.sub('', text)
+        text = text.replace('`', '')
+        text = self.WHITESPACE_PATTERN.sub(' ', text).strip()
+
+        return text
+
+    def clean_with_offsets(self, text: str) -> tuple[str, np.ndarray]:
+        '''
+        Clean text as clean does and return the raw position of each cleaned character. The offsets are None when the
+        text had HTML the parser rewrote in a way that can't be lined up with the raw text.
+        '''
+
+        if not isinstance(text, str):
+            return "", np.zeros(0, dtype = np.int64)
+
+        offsets = np.arange(len(text), dtype = np.int64)
+
+        if self._has_html(text):
+            html_strings = self._html_strings(text)
+            offsets = self._align(html_strings, text)
+
+            if offsets is None:
+                return self.clean(text), None
+
+            text = ''.join(html_strings)
+
+        codes = self._codes(text)
+        codes, offsets = self._drop_matches(self.URL_PATTERN, text, codes, offsets)
+        codes, offsets = self._drop_matches(self.LINK_PATTERN, self._text(codes), codes, offsets, keep_group = 1)
+        codes, offsets = self._drop_matches(self.FENCE_PATTERN, self._text(codes), codes, offsets)
+
+        kept = codes != self.BACKTICK
+        codes, offsets = codes[kept], offsets[kept]
+
+        whitespace = np.isin(codes, self.WHITESPACE_CODES)
+        run_start = whitespace.copy()
+        run_start[1:] &= ~whitespace[:-1]
+        kept = ~whitespace | run_start
+        codes = codes.copy()
+        codes[run_start] = self.SPACE
+        codes, offsets = codes[kept], offsets[kept]
+
+        start, end = 0, len(codes)
+
+        if end and codes[0] == self.SPACE:
+            start = 1
+
+        if end > start and codes[end - 1] == self.SPACE:
+            end -= 1
+
+        return self._text(codes[start:end]), offsets[start:end]
+
+    @staticmethod
+    def _codes(text: str) -> np.ndarray:
+        ''''''
+
+        return np.frombuffer(text.encode('utf-32-le'), dtype = np.uint32)
+
+    @staticmethod
+    def _text(codes: np.ndarray) -> str:
+        ''''''
+
+        return codes.tobytes().decode('utf-32-le')
+
+    @staticmethod
+    def _drop_matches(
+        pattern: re.Pattern, text: str, codes: np.ndarray, offsets: np.ndarray, keep_group: int = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        '''Remove the characters of every match of pattern, except the ones of keep_group.'''
+
+        kept = None
+
+        for match in pattern.finditer(text):
+            if kept is None:
+                kept = np.ones(len(codes), dtype = bool)
+
+            start, end = match.span()
+
+            if keep_group is None:
+                kept[start:end] = False
+
+            else:
+                kept[start:match.start(keep_group)] = False
+                kept[match.end(keep_group):end] = False
+
+        if kept is None:
+            return codes, offsets
+
+        return codes[kept], offsets[kept]
+
+    @staticmethod
+    def _align(html_strings: list[str], text: str) -> np.ndarray:
+        '''
+        Position in text of each character of the parser text nodes, which come in the order of the raw text. A node
+        is found whole; one with decoded entities is lined up run by run between the '&' and '<' of the raw text, an
+        entity mapping to its '&'. None when a character can't be found.
+        '''
+
+        offsets = np.empty(sum(len(string) for string in html_strings), dtype = np.int64)
+        index, position = 0, 0
+
+        for string in html_strings:
+            found = text.find(string, position)
+
+            if found >= 0:
+                offsets[index:index + len(string)] = np.arange(found, found + len(string))
+                index, position = index + len(string), found + len(string)
+                continue
+
+            string_index = 0
+
+            while string_index < len(string):
+                run_end = min(
+                    (found for found in (text.find('&', position), text.find('<', position)) if found >= 0),
+                    default = len(text)
+                )
+                run = text[position:run_end]
+
+                if run and string.startswith(run, string_index):
+                    offsets[index:index + len(run)] = np.arange(position, run_end)
+                    index, string_index, position = index + len(run), string_index + len(run), run_end
+                    continue
+
+                character = string[string_index]
+                string_index += 1
+
+                if character != '&' and text.startswith('&', position):
+                    entity_end = text.find(';', position, position + 12)
+
+                    if entity_end > 0:
+                        offsets[index] = position
+                        index, position = index + 1, entity_end + 1
+                        continue
+
+                position = text.find(character, position)
+
+                if position < 0:
+                    return None
+
+                offsets[index] = position
+                index, position = index + 1, position + 1
+
+        return offsets
+
+
+
+class SqliteDocstore(Docstore):
+    '''
+    The chunk texts and metadata of a saved index in a read-only SQLite file, keyed by FAISS id. Rows are read when a
+    search returns them, so nothing is loaded up front; each thread has its own connection.
+    '''
+
+    def __init__(self, path: str) -> object:
+        self._path = path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        ''''''
+
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            # The file is replaced, never written in place, so SQLite can skip locking it
+            connection = sqlite3.connect(f'file:{self._path}?mode=ro&immutable=1', uri = True, check_same_thread = False)
+            self._local.connection = connection
+
+        return connection
+
+    def search(self, search: int):
+        ''''''
+
+        row = self._connection().execute('SELECT page_content, metadata FROM chunks WHERE id = ?', (int(search),)).fetchone()
+
+        if row is None:
+            return f'ID {search} not found.'
+
+        return ChunkDocument(page_content = row[0], metadata = json.loads(row[1]))
+
+    @staticmethod
+    def write(vectorstore: FAISS, path: str, rows_per_insert: int = 10000) -> None:
+        '''Write the chunks of vectorstore to a new SQLite file at path, keyed by their FAISS id.'''
+
+        def metadata_json(metadata: dict) -> str:
+            return json.dumps(metadata, default = lambda value: value.item() if hasattr(value, 'item') else str(value))
+
+        if os.path.exists(path):
+            os.remove(path)
+
+        connection = sqlite3.connect(path)
+
+        try:
+            connection.execute('CREATE TABLE chunks (id INTEGER PRIMARY KEY, page_content TEXT NOT NULL, metadata TEXT NOT NULL)')
+            items = iter(vectorstore.index_to_docstore_id.items())
+
+            while True:
+                rows = []
+
+                for faiss_id, docstore_id in items:
+                    chunk = vectorstore.docstore.search(docstore_id)
+                    rows.append((int(faiss_id), chunk.page_content, metadata_json(chunk.metadata)))
+
+                    if len(rows) == rows_per_insert:
+                        break
+
+                if not rows:
+                    break
+
+                connection.executemany('INSERT INTO chunks VALUES (?, ?, ?)', rows)
+
+            connection.commit()
+
+        finally:
+            connection.close()
+
+
+
+class _FaissIds(dict):
+    '''index_to_docstore_id of a store whose docstore is keyed by FAISS id itself.'''
+
+    def __missing__(self, faiss_id: int) -> int:
+        return faiss_id
+
+
+
+class ServingIndex:
+    '''
+    The format the web workers search: the FAISS index file memory-mapped read-only, so the vectors stay in the page
+    cache shared by every process instead of each one's heap, and the chunks in a SqliteDocstore next to it instead of
+    the pickled docstore. Saved along the index.faiss / index.pkl pair that training loads.
+    '''
+
+    DOCSTORE_FILE = 'docstore.sqlite'
+
+    @classmethod
+    def exists(cls, faiss_path: str) -> bool:
+        ''''''
+
+        return os.path.exists(os.path.join(faiss_path, cls.DOCSTORE_FILE))
+
+    @classmethod
+    def save(cls, vectorstore: FAISS, faiss_path: str) -> None:
+        '''Write the docstore of vectorstore for serving; the index file is the one save_local writes.'''
+
+        path = os.path.join(faiss_path, cls.DOCSTORE_FILE)
+        staging_path = f'{path}.partial'
+
+        SqliteDocstore.write(vectorstore, staging_path)
+        os.replace(staging_path, path)
+
+    @classmethod
+    def load(cls, faiss_path: str, embedding_model: Embeddings) -> FAISS:
+        ''''''
+
+        index = faiss.read_index(os.path.join(faiss_path, 'index.faiss'), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+
+        return FAISS(embedding_model, index, SqliteDocstore(os.path.join(faiss_path, cls.DOCSTORE_FILE)), _FaissIds())
+
+
+
+class IndexVersionStore:
+    '''
+    Versioned layout of an index directory. Every build or update writes a new directory under versions/, and publish
+    makes it the served one: it writes a manifest with the size and sha256 of each file, then points the CURRENT file
+    at the version with a single rename, so readers see the previous version or the new one and never a mix of both.
+    Published versions past the newest keep (the current one included) are garbage collected, once they have been
+    retired (replaced as the current one) for retired_grace_seconds. An index saved directly in the directory, before
+    versions existed, is served as is until the first publish.
+    '''
+
+    VERSIONS_DIR = 'versions'
+    POINTER_FILE = 'CURRENT'
+    MANIFEST_FILE = 'manifest.json'
+    RETIRED_FILE = 'retired.json'
+    # Layout of the published indexes: chunks keyed by document qid in parent_index, vectors in an IndexIDMap2. An index
+    # without it, built before versions existed, is rebuilt from scratch instead of updated in place
+    FORMAT = 2
+    # Files that are only ever replaced, never written over, so a new version can share them with its parent
+    LINKED_FILES = ('index.faiss', 'index.pkl', ServingIndex.DOCSTORE_FILE)
+    COPIED_FILES = (FaissIndexBuilder.PARAMS_FILE,)
+
+    def __init__(self, root: str, keep: int = 3, stale_seconds: int = 24 * 3600, retired_grace_seconds: int = 600) -> object:
+        self.root = root
+        self._versions_dir = os.path.join(root, self.VERSIONS_DIR)
+        self._keep = max(keep, 1)
+        self._stale_seconds = stale_seconds
+        self._retired_grace_seconds = retired_grace_seconds
+
+    @classmethod
+    def from_settings(cls, root: str) -> 'IndexVersionStore':
+        ''''''
+
+        return cls(
+            root,
+            keep = settings.FAISS_INDEX_KEEP_VERSIONS,
+            retired_grace_seconds = settings.FAISS_INDEX_RETIRED_GRACE_SECONDS
+        )
+
+    def path(self, version: str) -> str:
+        ''''''
+
+        return os.path.join(self._versions_dir, version)
+
+    def current(self) -> str:
+        '''Name of the published version, None when nothing was published yet.'''
+
+        try:
+            with open(os.path.join(self.root, self.POINTER_FILE)) as pointer_file:
+                return pointer_file.read().strip() or None
+
+        except FileNotFoundError:
+            return None
+
+    def current_path(self) -> str:
+        '''Directory of the index to serve, None when there is no index.'''
+
+        version = self.current()
+
+        if version is not None:
+            return self.path(version)
+
+        if os.path.exists(os.path.join(self.root, 'index.faiss')):
+            return self.root
+
+        return None
+
+    def versions(self) -> list[str]:
+        '''Published versions, oldest first.'''
+
+        if not os.path.isdir(self._versions_dir):
+            return []
+
+        return sorted(
+            version for version in os.listdir(self._versions_dir)
+            if os.path.exists(os.path.join(self.path(version), self.MANIFEST_FILE))
+        )
+
+    def retired(self) -> dict:
+        '''When each version was last replaced as the current one, by version name.'''
+
+        try:
+            with open(os.path.join(self.root, self.RETIRED_FILE)) as retired_file:
+                return json.load(retired_file)
+
+        except FileNotFoundError:
+            return {}
+
+    def _point_to(self, version: str) -> None:
+        '''Make version the current one and record when the previous one was retired; called under the lock.'''
+
+        previous = self.current()
+
+        if previous is not None and previous != version:
+            retired = self.retired()
+            retired[previous] = time.time()
+            self._write_atomic(os.path.join(self.root, self.RETIRED_FILE), json.dumps(retired, indent = 2))
+
+        self._write_atomic(os.path.join(self.root, self.POINTER_FILE), version)
+
+    def manifest(self, version: str) -> dict:
+        ''''''
+
+        with open(os.path.join(self.path(version), self.MANIFEST_FILE)) as manifest_file:
+            return json.load(manifest_file)
+
+    def accepts_updates(self) -> bool:
+        '''Whether the current index was published in FORMAT, so it can be updated instead of rebuilt.'''
+
+        version = self.current()
+
+        return version is not None and self.manifest(version).get('format') == self.FORMAT
+
+    def create(self) -> str:
+        '''Create the directory of a new, unpublished version and return its path.'''
+
+        # Names sort in creation order
+        created_at = time.time()
+        version = f'{time.strftime("%Y%m%dT%H%M%S", time.gmtime(created_at))}.{int(created_at % 1 * 1e6):06d}-{uuid.uuid4().hex[:8]}'
+        version_path = self.path(version)
+        os.makedirs(version_path)
+
+        return version_path
+
+    def create_from_current(self) -> str:
+        '''Create a new version holding the files of the current one, hard linked when the filesystem allows it.'''
+
+        source_path = self.current_path()
+
+        if source_path is None:
+            raise FileNotFoundError(f'Nenhum índice FAISS publicado em {self.root}')
+
+        version_path = self.create()
+
+        for name in (*self.LINKED_FILES, *self.COPIED_FILES):
+            source = os.path.join(source_path, name)
+
+            if not os.path.exists(source):
+                continue
+
+            try:
+                if name not in self.LINKED_FILES:
+                    raise OSError
+
+                os.link(source, os.path.join(version_path, name))
+
+            except OSError:
+                shutil.copy2(source, os.path.join(version_path, name))
+
+        return version_path
+
+    def discard(self, version_path: str) -> None:
+        '''Remove a version that failed before being published; the published one is never removed.'''
+
+        if version_path and os.path.basename(version_path) != self.current() and os.path.exists(version_path):
+            shutil.rmtree(version_path)
+
+    @staticmethod
+    def _sha256(file_path: str) -> str:
+        ''''''
+
+        digest = hashlib.sha256()
+
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(2 ** 20), b''):
+                digest.update(block)
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def _write_atomic(path: str, content: str) -> None:
+        '''Write content next to path and rename it over path, flushed to disk first.'''
+
+        staging_path = f'{path}.{uuid.uuid4().hex}.partial'
+
+        with open(staging_path, 'w') as staging_file:
+            staging_file.write(content)
+            staging_file.flush()
+            os.fsync(staging_file.fileno())
+
+        os.replace(staging_path, path)
+
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+
+        try:
+            os.fsync(directory)
+
+        finally:
+            os.close(directory)
+
+    def publish(self, version_path: str, **details) -> dict:
+        '''Write the manifest of the version at version_path, make it the current one and collect old versions.'''
+
+        version = os.path.basename(version_path)
+        files = {}
+
+        for name in sorted(os.listdir(version_path)):
+            file_path = os.path.join(version_path, name)
+
+            if name != self.MANIFEST_FILE and os.path.isfile(file_path):
+                files[name] = {'size': os.path.getsize(file_path), 'sha256': self._sha256(file_path)}
+
+        if 'index.faiss' not in files:
+            raise ValueError(f'A versão {version} não contém um índice FAISS.')
+
+        manifest = {
+            'version': version, 'format': self.FORMAT, 'created_at': time.time(), 'parent': self.current(), 'files': files,
+            **details
+        }
+        self._write_atomic(os.path.join(version_path, self.MANIFEST_FILE), json.dumps(manifest, indent = 2))
+
+        with open(os.path.join(self.root, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            self._point_to(version)
+            self.gc()
+
+        return manifest
+
+    def rollback(self, version: str) -> None:
+        '''Serve an earlier published version again.'''
+
+        if version not in self.versions() or self.verify(version, full = False):
+            raise ValueError(f'A versão {version} não está publicada ou está incompleta.')
+
+        with open(os.path.join(self.root, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            self._point_to(version)
+
+    def verify(self, version: str, full: bool = True) -> list[str]:
+        '''Files of version that differ from its manifest, by size and, when full, by checksum.'''
+
+        try:
+            manifest = self.manifest(version)
+
+        except FileNotFoundError:
+            return [self.MANIFEST_FILE]
+
+        problems = []
+
+        for name, expected in manifest['files'].items():
+            file_path = os.path.join(self.path(version), name)
+
+            if not os.path.isfile(file_path) or os.path.getsize(file_path) != expected['size']:
+                problems.append(name)
+
+            elif full and self._sha256(file_path) != expected['sha256']:
+                problems.append(name)
+
+        return problems
+
+    def gc(self) -> list[str]:
+        '''
+        Remove the published versions past the newest keep, the unpublished ones left by failed runs for longer than
+        stale_seconds and an index saved before versions existed. A version retired less than retired_grace_seconds
+        ago, or still served by this process, is kept: web workers open its docstore lazily from their threads until
+        they move to the current version on their next request.
+        '''
+
+        current = self.current()
+
+        if current is None:
+            return []
+
+        published = [version for version in self.versions() if version != current]
+        kept = {current, *published[max(len(published) - self._keep + 1, 0):]} if self._keep > 1 else {current}
+        retired = self.retired()
+        in_use = SearchResourcesRegistry.versions_in_use()
+        removed = []
+
+        for name in os.listdir(self._versions_dir):
+            path = self.path(name)
+
+            if name in kept or name in in_use or time.time() - retired.get(name, 0) < self._retired_grace_seconds:
+                continue
+
+            if name not in published and time.time() - os.path.getmtime(path) < self._stale_seconds:
+                continue
+
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors = True)
+
+            else:
+                os.remove(path)
+
+            removed.append(name)
+
+        if any(name in retired for name in removed):
+            retired = {name: retired_at for name, retired_at in retired.items() if name not in removed}
+            self._write_atomic(os.path.join(self.root, self.RETIRED_FILE), json.dumps(retired, indent = 2))
+
+        for name in (*self.LINKED_FILES, *self.COPIED_FILES):
+            if os.path.exists(os.path.join(self.root, name)):
+                os.remove(os.path.join(self.root, name))
+                removed.append(name)
+
+        return removed
+
+
+
+class CreateFaissTreeService:
+    ''''''
+
+    DOCUMENT_COLUMNS = ['id', 'parent_index', 'metadata', 'question', 'consolidated_answers']
+    CHUNK_SIZE = 2000
+    CHUNK_OVERLAP = 400
+
+    def __init__(
+        self, documents_batch_size: int = 5000, chunk_workers: int = 0, queue_size: int = 2,
+        embedding_cache: EmbeddingCache = None, index_builder: FaissIndexBuilder = None,
+        embedding_backend: EmbeddingBackend = None
+    ) -> object:
+        self._documents_batch_size = documents_batch_size
+        self._embedding_backend = embedding_backend or EmbeddingBackend()
+        self._index_builder = index_builder
+        self.index_params = None
+        self.last_indexed_id = 0
+        self._chunk_workers = chunk_workers
+        self._queue_size = queue_size
+        self._embedding_cache = embedding_cache
+        self._text_cleaner = TextCleaner()
+        self.stats = PipelineStageStats()
+
+    def iter_document_batches(self, after_id: int = 0, pending_only: bool = False, up_to_id: int = None):
+        '''
+        Yield the documents with an id above after_id (and up to up_to_id) in id order (only the ones not indexed yet
+        with pending_only), as DataFrames of up to documents_batch_size rows holding only the columns the chunker needs. Each batch is
+        read with keyset pagination (id > last id read), an index range scan, so reading the table costs the same for
+        the last batch as for the first.
+        '''
+
+        last_id = after_id
+        documents = Document.objects.filter(is_indexed = False) if pending_only else Document.objects.all()
+
+        if up_to_id is not None:
+            documents = documents.filter(id__lte = up_to_id)
+
+        while True:
+            rows = list(
+                documents.filter(id__gt = last_id).order_by('id')
+                .values_list(*self.DOCUMENT_COLUMNS)[:self._documents_batch_size]
+            )
+
+            if not rows:
+                return
+
+            last_id = rows[-1][0]
+
+            yield pd.DataFrame.from_records(rows, columns = self.DOCUMENT_COLUMNS)
+
+            if len(rows) < self._documents_batch_size:
+                return
+
+    @staticmethod
+    def plan_id_ranges(shards: int) -> list[tuple[int, int]]:
+        '''
+        Split the document ids into up to shards disjoint (after_id, up_to_id] ranges of about the same number of
+        documents, for building the index in parallel.
+        '''
+
+        total_documents = Document.objects.count()
+        shards = max(1, min(shards, total_documents))
+        ids = Document.objects.order_by('id').values_list('id', flat = True)
+        bounds = [0] + [ids[total_documents * shard // shards - 1] for shard in range(1, shards + 1)]
+
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _clean_text(self, text: str) -> str:
+        ''''''
+
+        return self._text_cleaner.clean(text)
+
+    def _text_splitter(self) -> RecursiveCharacterTextSplitter:
+        ''''''
+
+        return RecursiveCharacterTextSplitter(
+            chunk_size = self.CHUNK_SIZE,
+            chunk_overlap = self.CHUNK_OVERLAP,
+            separators = ["\n\n", "\n", " ", ""],
+            length_function = len
+        )
+
+    def _split_cleaned_text(self, text: str) -> list[tuple[int, int]]:
+        '''
+        Spans of the chunks of a cleaned text, whose only whitespace is single spaces: windows of up to CHUNK_SIZE
+        characters ending at a space, each starting at the first word of the last CHUNK_OVERLAP characters of the one
+        before. A word longer than a chunk is cut.
+        '''
+
+        spans, start, length = [], 0, len(text)
+
+        while start < length:
+            end = start + self.CHUNK_SIZE
+
+            if end >= length:
+                spans.append((start, length))
+                break
+
+            space = text.rfind(' ', start + 1, end + 1)
+
+            if space > 0:
+                end = space
+
+            spans.append((start, end))
+
+            space = text.find(' ', max(end - self.CHUNK_OVERLAP - 1, start), end)
+            start = space + 1 if space >= 0 else end + (text[end] == ' ')
+
+        return spans
+
+    def _chunk_document(self, text: str, text_splitter: RecursiveCharacterTextSplitter) -> list[tuple[str, str]]:
+        '''
+        Clean a document once, split the cleaned text and return the (raw, cleaned) text of each chunk, the raw text
+        being the span of the document the cleaned chunk came from. A document whose HTML can't be mapped back is
+        split raw and cleaned chunk by chunk instead.
+        '''
+
+        cleaned_text, offsets = self._text_cleaner.clean_with_offsets(text)
+
+        if offsets is None:
+            raw_chunks = text_splitter.split_text(text)
+            return [(raw_chunk, self._clean_text(raw_chunk)) for raw_chunk in raw_chunks]
+
+        return [
+            (text[offsets[start]:offsets[end - 1] + 1], cleaned_text[start:end])
+            for start, end in self._split_cleaned_text(cleaned_text)
+        ]
+
+    def _create_chunks_batch(self, documents_df: pd.DataFrame) -> pd.DataFrame:
+        ''''''
+
+        text_splitter = self._text_splitter()
+        texts_for_chunking = documents_df['question'] + "\n\nAnswers:\n" + documents_df['consolidated_answers']
+        columns = {'parent_index': [], 'metadata': [], 'raw_text_chunk': [], 'cleaned_text_chunk': []}
+
+        for parent_index, metadata, text in zip(documents_df['parent_index'], documents_df['metadata'], texts_for_chunking):
+            for raw_chunk, cleaned_chunk in self._chunk_document(text, text_splitter):
+                if not cleaned_chunk.strip():
+                    continue
+
+                columns['parent_index'].append(parent_index)
+                columns['metadata'].append(metadata)
+                columns['raw_text_chunk'].append(raw_chunk)
+                columns['cleaned_text_chunk'].append(cleaned_chunk)
+
+        return pd.DataFrame(columns)
+
+    def _process_embeddings_batch(self, chunks_df: pd.DataFrame, embedding_model, batch_size: int = 512) -> tuple:
+        '''
+        Embed the cleaned chunks into one preallocated float32 matrix, embedding batch_size chunks at a time in order
+        of length, so each batch pads its texts to about the same length. Returns the matrix and the raw text,
+        parent_index and metadata columns of the chunks, row for row, or None when there is nothing to embed.
+        '''
+
+        texts_to_embed = chunks_df['cleaned_text_chunk'].tolist()
+        total_chunks = len(texts_to_embed)
+
+        if total_chunks == 0:
+            return None
+
+        embeddings = None
+        by_length = np.argsort(chunks_df['cleaned_text_chunk'].str.len().to_numpy(), kind = 'stable')
+
+        for i in range(0, total_chunks, batch_size):
+            rows = by_length[i:i + batch_size]
+            batch_texts = [texts_to_embed[row] for row in rows]
+
+            if self._embedding_cache is not None:
+                batch_embeddings = self._embedding_cache.embed(batch_texts, embedding_model)
+            else:
+                batch_embeddings = embedding_model.embed_documents(batch_texts)
+
+            if embeddings is None:
+                embeddings = np.empty((total_chunks, len(batch_embeddings[0])), dtype = np.float32)
+
+            embeddings[rows] = batch_embeddings
+
+            del batch_embeddings
+
+        return embeddings, chunks_df[['raw_text_chunk', 'parent_index', 'metadata']].reset_index(drop = True)
+
+    @staticmethod
+    def _add_embeddings(vectorstore: FAISS, embedding_model, embeddings: np.ndarray, chunks_df: pd.DataFrame) -> FAISS:
+        '''
+        Add the rows of a float32 embeddings matrix to vectorstore straight from the matrix, with the chunk texts and
+        metadata in the docstore. A new vectorstore holds an exact index wrapped in an IndexIDMap2, so vectors keep
+        their id when others are removed; ids continue after the highest one in use.
+        '''
+
+        if vectorstore is None:
+            vectorstore = FAISS(embedding_model, faiss.IndexIDMap2(faiss.IndexFlatL2(embeddings.shape[1])), InMemoryDocstore(), {})
+
+        ids = [str(uuid.uuid4()) for _ in range(len(chunks_df))]
+
+        if isinstance(vectorstore.index, faiss.IndexIDMap2):
+            starting_len = max(vectorstore.index_to_docstore_id, default = -1) + 1
+            vectorstore.index.add_with_ids(embeddings, np.arange(starting_len, starting_len + len(ids), dtype = np.int64))
+
+        else:
+            starting_len = len(vectorstore.index_to_docstore_id)
+            vectorstore.index.add(embeddings)
+        vectorstore.docstore.add({
+            id_: ChunkDocument(
+                id = id_, page_content = text, metadata = {'parent_index': parent_index, 'metadata_link': metadata_link}
+            )
+            for id_, text, parent_index, metadata_link in zip(
+                ids, chunks_df['raw_text_chunk'], chunks_df['parent_index'].tolist(), chunks_df['metadata']
+            )
+        })
+        vectorstore.index_to_docstore_id.update({starting_len + j: id_ for j, id_ in enumerate(ids)})
+
+        return vectorstore
+
+    @staticmethod
+    def _merge_shards(shard_paths: list[str], embedding_model) -> FAISS:
+        '''Merge the shard indexes in order, shifting the ids of each shard past the ones merged before it.'''
+
+        vectorstore = FAISS.load_local(shard_paths[0], embedding_model, allow_dangerous_deserialization = True)
+
+        for shard_path in shard_paths[1:]:
+            shard = FAISS.load_local(shard_path, embedding_model, allow_dangerous_deserialization = True)
+            id_offset = max(vectorstore.index_to_docstore_id, default = -1) + 1
+
+            vectorstore.index.merge_from(shard.index, id_offset)
+            vectorstore.docstore.add(shard.docstore._dict)
+            vectorstore.index_to_docstore_id.update({id_offset + i: id_ for i, id_ in shard.index_to_docstore_id.items()})
+
+            del shard
+            gc.collect()
+
+        return vectorstore
+
+    def load_embedding_model(self) -> Embeddings:
+        ''''''
+
+        return self._embedding_backend.load()
+
+    def summary(self) -> str:
+        '''Stage throughput and, with an embedding cache, its hit rate, for the progress messages.'''
+
+        if self._embedding_cache is None:
+            return self.stats.summary()
+
+        return f'{self.stats.summary()}, cache de embeddings {self._embedding_cache.hit_rate:.0%} de acertos'
+
+    def _start_chunk_pool(self):
+        ''''''
+
+        if not self._chunk_workers:
+            return None
+
+        # The workers never use the database, close the parent connections so none is shared through fork
+        for connection in connections.all():
+            if not connection.in_atomic_block:
+                connection.close()
+
+        return multiprocessing.get_context('fork').Pool(processes = self._chunk_workers)
+
+    def _iter_embedded_batches(self, document_batches, embedding_model, batch_size: int, chunk_pool):
+        '''
+        Run the read, chunk/clean and embedding stages concurrently and yield (documents, last document id,
+        embedded chunks) per document batch, in batch order. Documents are read here, chunked on chunk_pool (or
+        inline without one) and embedded on a thread; the chunk jobs in flight and the queue between chunking and
+        embedding are bounded, so reading waits for the slower stages instead of filling memory.
+        '''
+
+        chunk_queue = queue.Queue(maxsize = self._queue_size)
+        embedded_queue = queue.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def embed_stage():
+            try:
+                while not stop.is_set():
+                    try:
+                        item = chunk_queue.get(timeout = 0.1)
+
+                    except queue.Empty:
+                        continue
+
+                    if item is done:
+                        break
+
+                    batch_documents, batch_last_id, chunks_df = item
+                    started_at = time.perf_counter()
+                    embedded = self._process_embeddings_batch(chunks_df, embedding_model, batch_size)
+                    self.stats.add('embeddings', len(chunks_df), time.perf_counter() - started_at)
+
+                    del chunks_df
+                    embedded_queue.put((batch_documents, batch_last_id, embedded))
+
+            except Exception as error:
+                embedded_queue.put(error)
+
+            embedded_queue.put(done)
+
+        def take_embedded(block: bool):
+            while True:
+                try:
+                    item = embedded_queue.get(block = block)
+
+                except queue.Empty:
+                    return
+
+                if isinstance(item, Exception):
+                    raise item
+
+                if item is done:
+                    return
+
+                yield item
+
+        def put_chunks(item):
+            while True:
+                try:
+                    chunk_queue.put(item, timeout = 0.1)
+                    return
+
+                except queue.Full:
+                    yield from take_embedded(block = False)
+
+        def finish_chunking(pending_item):
+            batch_documents, batch_last_id, chunk_job = pending_item
+            chunks_df, seconds = chunk_job.get()
+            self.stats.add('limpeza', batch_documents, seconds)
+
+            yield from put_chunks((batch_documents, batch_last_id, chunks_df))
+
+        embed_thread = threading.Thread(target = embed_stage, name = 'faiss-embeddings', daemon = True)
+        embed_thread.start()
+
+        pending = deque()
+        document_batches = iter(document_batches)
+
+        try:
+            while True:
+                started_at = time.perf_counter()
+                documents_df = next(document_batches, None)
+
+                if documents_df is None:
+                    break
+
+                self.stats.add('leitura', len(documents_df), time.perf_counter() - started_at)
+                batch_documents, batch_last_id = len(documents_df), int(documents_df['id'].max())
+
+                if chunk_pool is None:
+                    started_at = time.perf_counter()
+                    chunks_df = self._create_chunks_batch(documents_df)
+                    self.stats.add('limpeza', batch_documents, time.perf_counter() - started_at)
+
+                    del documents_df
+                    yield from put_chunks((batch_documents, batch_last_id, chunks_df))
+
+                else:
+                    pending.append((batch_documents, batch_last_id, chunk_pool.apply_async(_create_chunks_in_worker, (documents_df,))))
+                    del documents_df
+
+                    while len(pending) > self._chunk_workers * 2:
+                        yield from finish_chunking(pending.popleft())
+
+                yield from take_embedded(block = False)
+
+            while pending:
+                yield from finish_chunking(pending.popleft())
+
+            yield from put_chunks(done)
+            yield from take_embedded(block = True)
+
+        finally:
+            stop.set()
+            embed_thread.join()
+
+    def create_faiss_index(
+        self, batch_size: int = 512, faiss_save_path: str = 'faiss_index', task_id: str = None,
+        checkpoint: TrainingCheckpoint = None
+    ) -> None:
+        '''
+        Embed every document and save the FAISS index. With a checkpoint, each document batch is saved as a partial
+        index shard in the checkpoint build directory, documents already in a shard are skipped, and the shards are
+        merged into the final index at the end. With an index_builder the exact index is then converted to its index
+        type, and the parameters and recall/latency report are left in index_params. The last document id read is left
+        in last_indexed_id, for mark_indexed once the index is published. The throughput of each pipeline stage is left
+        in stats.
+        '''
+
+        # Only used for the progress messages, the documents are read until none is left
+        total_documents = Document.objects.count()
+        if total_documents == 0:
+            raise ValueError("Nenhum documento encontrado no banco de dados")
+
+        self.stats = PipelineStageStats()
+        chunk_pool = self._start_chunk_pool()
+        
+        embedding_model = self.load_embedding_model()
+        
+        vectorstore = None
+        processed_docs = checkpoint.documents_embedded if checkpoint else 0
+        self.last_indexed_id = checkpoint.last_embedded_id if checkpoint else 0
+        document_batches = self.iter_document_batches(self.last_indexed_id)
+
+        try:
+            for batch_documents, batch_last_id, embedded in self._iter_embedded_batches(
+                document_batches, embedding_model, batch_size, chunk_pool
+            ):
+                self.last_indexed_id = batch_last_id
+
+                if embedded is None:
+                    continue
+
+                started_at = time.perf_counter()
+                embeddings, chunks_df = embedded
+                
+                vectorstore = self._add_embeddings(None if checkpoint else vectorstore, embedding_model, embeddings, chunks_df)
+
+                if checkpoint:
+                    shard_path = os.path.join(checkpoint.build_dir, f'shard_{len(checkpoint.shards):05d}')
+                    vectorstore.save_local(shard_path)
+                    checkpoint.mark_shard_saved(shard_path, batch_last_id, batch_documents)
+                    vectorstore = None
+
+                self.stats.add('índice', len(embeddings), time.perf_counter() - started_at)
+                
+                del embedded, embeddings, chunks_df
+                gc.collect()
+                
+                processed_docs += batch_documents
+                
+                if task_id:
+                    TaskStatus.objects.filter(task_id = task_id).update(
+                        status = states.PENDING,
+                        updated_at = timezone.now(),
+                        result = f'Embeddings processados: {processed_docs}/{total_documents} documentos ({self.summary()})'
+                    )
+
+        finally:
+            if chunk_pool is not None:
+                chunk_pool.terminate()
+                chunk_pool.join()
+
+            if self._embedding_cache is not None:
+                self._embedding_cache.flush()
+
+        if checkpoint and checkpoint.shards:
+            if task_id:
+                TaskStatus.objects.filter(task_id = task_id).update(
+                    status = states.PENDING,
+                    updated_at = timezone.now(),
+                    result = f'Unindo {len(checkpoint.shards)} partes do índice FAISS...'
+                )
+
+            vectorstore = self._merge_shards([shard['path'] for shard in checkpoint.shards], embedding_model)
+        
+        if vectorstore:
+            self._save_index(vectorstore, faiss_save_path, task_id)
+
+            del vectorstore, embedding_model
+            gc.collect()
+        
+        else:
+            raise ValueError("O vectorstore não foi criado. Nenhum documento foi processado ou adicionado ao índice.")
+
+    def _save_index(self, vectorstore: FAISS, faiss_save_path: str, task_id: str = None) -> None:
+        '''Convert the exact index with the index_builder and save it with its parameters.'''
+
+        if self._index_builder is not None and not self._index_builder.is_exact:
+            if task_id:
+                TaskStatus.objects.filter(task_id = task_id).update(
+                    status = states.PENDING,
+                    updated_at = timezone.now(),
+                    result = f'Treinando índice FAISS {self._index_builder.spec}...'
+                )
+
+            vectorstore.index, self.index_params = self._index_builder.build(vectorstore.index)
+
+        elif self._index_builder is not None:
+            self.index_params = {'spec': self._index_builder.spec, 'factory': 'Flat', 'search_parameters': ''}
+
+        if task_id:
+            TaskStatus.objects.filter(task_id = task_id).update(
+                status = states.PENDING,
+                updated_at = timezone.now(),
+                result = 'Salvando índice FAISS...'
+            )
+
+        vectorstore.save_local(faiss_save_path)
+        ServingIndex.save(vectorstore, faiss_save_path)
+
+        if self.index_params is not None:
+            FaissIndexBuilder.save_params(faiss_save_path, self.index_params)
+
+    def mark_indexed(self) -> int:
+        '''
+        Flag the documents read into the last index built as indexed, once it is published. Documents written after
+        the reader passed them keep is_indexed false, for the next run.
+        '''
+
+        return Document.objects.filter(is_indexed = False, id__lte = self.last_indexed_id).update(is_indexed = True)
+
+    def create_index_shard(
+        self, shard_path: str, after_id: int, up_to_id: int, batch_size: int = 512, on_progress = None
+    ) -> dict:
+        '''
+        Embed the documents with an id in (after_id, up_to_id] and save them as one partial index at shard_path,
+        calling on_progress with the documents embedded so far after each batch. The shard is written next to
+        shard_path and renamed into place, so a shard that exists is complete. Returns the documents and chunks it
+        holds.
+        '''
+
+        self.stats = PipelineStageStats()
+        chunk_pool = self._start_chunk_pool()
+        embedding_model = self.load_embedding_model()
+        vectorstore, documents = None, 0
+
+        try:
+            for batch_documents, _, embedded in self._iter_embedded_batches(
+                self.iter_document_batches(after_id, up_to_id = up_to_id), embedding_model, batch_size, chunk_pool
+            ):
+                documents += batch_documents
+
+                if embedded is not None:
+                    started_at = time.perf_counter()
+                    vectorstore = self._add_embeddings(vectorstore, embedding_model, *embedded)
+                    self.stats.add('índice', len(embedded[0]), time.perf_counter() - started_at)
+
+                del embedded
+
+                if on_progress is not None:
+                    on_progress(documents)
+
+        finally:
+            if chunk_pool is not None:
+                chunk_pool.terminate()
+                chunk_pool.join()
+
+            if self._embedding_cache is not None:
+                self._embedding_cache.flush()
+
+        chunks = vectorstore.index.ntotal if vectorstore is not None else 0
+
+        if vectorstore is not None:
+            staging_path = f'{shard_path}.partial'
+
+            if os.path.exists(staging_path):
+                shutil.rmtree(staging_path)
+
+            vectorstore.save_local(staging_path)
+
+            if os.path.exists(shard_path):
+                shutil.rmtree(shard_path)
+
+            os.replace(staging_path, shard_path)
+
+        return {'path': shard_path if vectorstore is not None else None, 'documents': documents, 'chunks': chunks}
+
+    def merge_index_shards(self, shard_paths: list[str], faiss_save_path: str, up_to_id: int, task_id: str = None) -> None:
+        '''
+        Merge the partial indexes of a sharded build, in order, into the final index and save it; up_to_id is the last
+        document id of the build.
+        '''
+
+        shard_paths = [shard_path for shard_path in shard_paths if shard_path]
+
+        if not shard_paths:
+            raise ValueError("O vectorstore não foi criado. Nenhum documento foi processado ou adicionado ao índice.")
+
+        if task_id:
+            TaskStatus.objects.filter(task_id = task_id).update(
+                status = states.PENDING,
+                updated_at = timezone.now(),
+                result = f'Unindo {len(shard_paths)} partes do índice FAISS...'
+            )
+
+        embedding_model = self.load_embedding_model()
+        vectorstore = self._merge_shards(shard_paths, embedding_model)
+
+        self._save_index(vectorstore, faiss_save_path, task_id)
+        self.last_indexed_id = up_to_id
+
+        del vectorstore, embedding_model
+        gc.collect()
+
+
+
+def _create_chunks_in_worker(documents_df: pd.DataFrame) -> tuple[pd.DataFrame, float]:
+    ''''''
+
+    started_at = time.perf_counter()
+    chunks_df = CreateFaissTreeService()._create_chunks_batch(documents_df)
+
+    return chunks_df, time.perf_counter() - started_at
+
+
+
+class IncrementalIndexService:
+    '''
+    Applies document changes to a saved index instead of rebuilding it. Vectors live in an IndexIDMap2, so each keeps
+    its id whatever is removed around it. The chunks of removed or changed documents are first only tombstoned,
+    flagged deleted in their docstore metadata so searches filtering with is_live skip them, and the new document
+    versions are appended with fresh ids. compact removes the tombstoned vectors, which update does once they pass
+    compact_ratio of the index.
+    '''
+
+    def __init__(self, faiss_path: str, indexer: CreateFaissTreeService = None, compact_ratio: float = 0.2, batch_size: int = 512) -> object:
+        self._faiss_path = faiss_path
+        self._indexer = indexer or CreateFaissTreeService()
+        self._compact_ratio = compact_ratio
+        self._batch_size = batch_size
+
+    @staticmethod
+    def is_live(metadata: dict) -> bool:
+        '''Search filter that leaves out tombstoned chunks.'''
+
+        return not metadata.get('deleted')
+
+    def load(self, embedding_model) -> FAISS:
+        '''
+        Load the saved index. An index saved without ids was built before parent_index held the document qid, so its
+        chunks cannot be matched to the documents and it has to be rebuilt.
+        '''
+
+        vectorstore = FAISS.load_local(self._faiss_path, embedding_model, allow_dangerous_deserialization = True)
+
+        if not isinstance(vectorstore.index, faiss.IndexIDMap2):
+            raise ValueError('O índice FAISS salvo não aceita atualizações incrementais, recrie o índice.')
+
+        return vectorstore
+
+    @staticmethod
+    def tombstone(vectorstore: FAISS, parent_indexes) -> int:
+        '''Flag the chunks of parent_indexes as deleted, returning how many chunks were flagged.'''
+
+        parent_indexes = {int(parent_index) for parent_index in parent_indexes}
+        tombstoned = 0
+
+        if not parent_indexes:
+            return 0
+
+        for document in vectorstore.docstore._dict.values():
+            if document.metadata.get('parent_index') in parent_indexes and not document.metadata.get('deleted'):
+                document.metadata['deleted'] = True
+                tombstoned += 1
+
+        return tombstoned
+
+    @staticmethod
+    def tombstoned_ids(vectorstore: FAISS) -> list[int]:
+        ''''''
+
+        return [
+            vector_id for vector_id, docstore_id in vectorstore.index_to_docstore_id.items()
+            if vectorstore.docstore._dict[docstore_id].metadata.get('deleted')
+        ]
+
+    def append_pending(self, vectorstore: FAISS, embedding_model) -> tuple[int, int]:
+        '''Embed and append the documents not indexed yet, returning how many and the highest document id appended.'''
+
+        appended, last_id = 0, 0
+
+        for documents_df in self._indexer.iter_document_batches(pending_only = True):
+            last_id = int(documents_df['id'].max())
+            appended += len(documents_df)
+
+            embedded = self._indexer._process_embeddings_batch(
+                self._indexer._create_chunks_batch(documents_df), embedding_model, self._batch_size
+            )
+
+            if embedded is not None:
+                self._indexer._add_embeddings(vectorstore, embedding_model, *embedded)
+
+        return appended, last_id
+
+    def compact(self, vectorstore: FAISS) -> int:
+        '''Remove the tombstoned vectors and their docstore entries, returning how many were removed.'''
+
+        dead_ids = self.tombstoned_ids(vectorstore)
+
+        if not dead_ids:
+            return 0
+
+        try:
+            vectorstore.index.remove_ids(np.array(dead_ids, dtype = np.int64))
+
+        except RuntimeError:
+            # Index types without removal (HNSW) are rebuilt from the vectors they keep
+            vectorstore.index = self._rebuild_without(vectorstore.index, set(dead_ids), vectorstore.index_to_docstore_id)
+
+        vectorstore.docstore.delete([vectorstore.index_to_docstore_id.pop(vector_id) for vector_id in dead_ids])
+
+        return len(dead_ids)
+
+    def _rebuild_without(self, index, dead_ids: set[int], index_to_docstore_id: dict):
+        ''''''
+
+        index_params = FaissIndexBuilder.load_params(self._faiss_path) or {}
+        live_ids = np.array([vector_id for vector_id in index_to_docstore_id if vector_id not in dead_ids], dtype = np.int64)
+
+        rebuilt = faiss.IndexIDMap2(faiss.index_factory(index.d, index_params.get('factory', 'Flat')))
+
+        for start in range(0, len(live_ids), 100000):
+            batch_ids = live_ids[start:start + 100000]
+            rebuilt.add_with_ids(index.reconstruct_batch(batch_ids), batch_ids)
+
+        FaissIndexBuilder.apply_search_parameters(rebuilt, index_params.get('search_parameters'))
+
+        return rebuilt
+
+    def save(self, vectorstore: FAISS) -> None:
+        '''Save next to the live index and move the files over it, so readers never see a partly written file.'''
+
+        staging_dir = tempfile.mkdtemp(dir = os.path.dirname(os.path.abspath(self._faiss_path)))
+
+        try:
+            vectorstore.save_local(staging_dir)
+            ServingIndex.save(vectorstore, staging_dir)
+
+            # The web workers map index.faiss, so it is replaced and never written over
+            for name in (ServingIndex.DOCSTORE_FILE, 'index.faiss', 'index.pkl'):
+                os.replace(os.path.join(staging_dir, name), os.path.join(self._faiss_path, name))
+
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors = True)
+
+    def update(self, removed_qids = (), task_id: str = None) -> dict:
+        '''
+        Tombstone the chunks of removed_qids and of the documents not indexed yet (their previous version), append
+        those documents, compact when the tombstones pass compact_ratio, save and flag the appended documents indexed.
+        '''
+
+        embedding_model = self._indexer.load_embedding_model()
+        vectorstore = self.load(embedding_model)
+
+        pending_parent_indexes = Document.objects.filter(is_indexed = False).values_list('parent_index', flat = True)
+        tombstoned = self.tombstone(vectorstore, [*removed_qids, *pending_parent_indexes])
+
+        if task_id:
+            TaskStatus.objects.filter(task_id = task_id).update(
+                status = states.PENDING,
+                updated_at = timezone.now(),
+                result = f'Atualizando índice FAISS: {tombstoned} trechos marcados como removidos, adicionando documentos novos ou alterados'
+            )
+
+        appended, last_id = self.append_pending(vectorstore, embedding_model)
+
+        compacted = 0
+        if vectorstore.index.ntotal and len(self.tombstoned_ids(vectorstore)) / vectorstore.index.ntotal > self._compact_ratio:
+            compacted = self.compact(vectorstore)
+
+        self.save(vectorstore)
+
+        if appended:
+            Document.objects.filter(is_indexed = False, id__lte = last_id).update(is_indexed = True)
+
+        return {'appended_documents': appended, 'tombstoned_chunks': tombstoned, 'compacted_chunks': compacted}
+
+
+
+def _process_rss_bytes() -> int:
+    '''Return the resident set size of the current process in bytes, or 0 when it cannot be read.'''
+
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+
+class GreetingClassifier:
+    '''
+    Tells locally whether a message is only a greeting, so the chat answers it from a template without asking the LLM.
+    A message made only of lexicon greetings and filler words is a greeting, and one with a question mark or more than
+    MAX_SHORT_WORDS other words is a question. Each short message left ("hey bro", "greetz") is compared with the
+    embedding model to greeting and question prototypes, and it is AMBIGUOUS, for the LLM to decide, only when the
+    similarity does not settle it either.
+    '''
+
+    GREETING = 'greeting'
+    OTHER = 'other'
+    AMBIGUOUS = 'ambiguous'
+
+    MAX_SHORT_WORDS = 4
+    MARGIN = 0.1
+
+    # Greeting phrases without accents, by language and the part of the day they refer to; the first language wins
+    LEXICON = {
+        'pt': {
+            'hello': (
+                'ola', 'oi', 'oie', 'opa', 'eai', 'e ai', 'eae', 'salve', 'alo', 'saudacoes', 'tudo bem', 'tudo bom',
+                'como vai', 'beleza'
+            ),
+            'morning': ('bom dia',),
+            'afternoon': ('boa tarde',),
+            'evening': ('boa noite',),
+        },
+        'en': {
+            'hello': ('hello', 'hi', 'hey', 'hiya', 'howdy', 'greetings', 'yo', 'whats up', 'how are you'),
+            'morning': ('good morning', 'morning'),
+            'afternoon': ('good afternoon',),
+            'evening': ('good evening', 'good night'),
+        },
+        'es': {
+            'hello': ('hola', 'que tal', 'como estas', 'buenas', 'saludos'),
+            'morning': ('buenos dias',),
+            'afternoon': ('buenas tardes',),
+            'evening': ('buenas noches',),
+        },
+        'fr': {'hello': ('bonjour', 'salut', 'coucou', 'ca va'), 'evening': ('bonsoir', 'bonne nuit')},
+        'it': {
+            'hello': ('ciao', 'come stai'),
+            'morning': ('buongiorno',),
+            'afternoon': ('buon pomeriggio',),
+            'evening': ('buonasera', 'buonanotte'),
+        },
+        'de': {'hello': ('hallo', 'servus', 'moin', 'guten tag'), 'morning': ('guten morgen',), 'evening': ('guten abend', 'gute nacht')},
+    }
+    # Words that go along with a greeting without making it a question
+    FILLERS = frozenset((
+        'a', 'o', 'e', 'ai', 'ae', 'ne', 'entao', 'tudo', 'bem', 'pessoal', 'galera', 'amigo', 'amiga', 'mano', 'chat',
+        'bot', 'chatbot', 'assistente', 'voce', 'vc', 'todos', 'there', 'everyone', 'all', 'friend', 'buddy', 'again',
+        'and', 'y', 'et', 'und', 'amigos', 'tous', 'tutti', 'zusammen', 'le', 'monde'
+    ))
+    # Messages the embedding check should not mistake for greetings
+    QUESTION_PROTOTYPES = (
+        'como ordenar uma lista', 'o que e um decorator', 'erro ao importar modulo', 'como ler um arquivo csv',
+        'list comprehension', 'how to sort a dictionary', 'what is a generator', 'pandas dataframe groupby',
+        'numpy array shape', 'django model migration', 'tenho uma duvida', 'preciso de ajuda com python', 'obrigado',
+        'thanks', 'valeu', 'tchau', 'bye'
+    )
+    SALUTATIONS = {
+        'pt': {'hello': 'Olá!', 'morning': 'Bom dia!', 'afternoon': 'Boa tarde!', 'evening': 'Boa noite!'},
+        'en': {'hello': 'Hello!', 'morning': 'Good morning!', 'afternoon': 'Good afternoon!', 'evening': 'Good evening!'},
+        'es': {'hello': '¡Hola!', 'morning': '¡Buenos días!', 'afternoon': '¡Buenas tardes!', 'evening': '¡Buenas noches!'},
+        'fr': {'hello': 'Bonjour !', 'evening': 'Bonsoir !'},
+        'it': {'hello': 'Ciao!', 'morning': 'Buongiorno!', 'afternoon': 'Buon pomeriggio!', 'evening': 'Buonasera!'},
+        'de': {'hello': 'Hallo!', 'morning': 'Guten Morgen!', 'evening': 'Guten Abend!'},
+    }
+    OFFERS = {
+        'pt': 'Como posso ajudar com sua dúvida de Python?',
+        'en': 'How can I help with your Python question?',
+        'es': '¿En qué puedo ayudarte con Python?',
+        'fr': 'Comment puis-je vous aider avec Python ?',
+        'it': 'Come posso aiutarti con Python?',
+        'de': 'Wie kann ich dir bei Python helfen?',
+    }
+
+    _REPEATED_LETTERS_PATTERN = re.compile(r'(\w)\1{2,}')
+    _NON_WORD_PATTERN = re.compile(r'[^a-z0-9]+')
+
+    def __init__(self, embedding_model: Embeddings = None, match_similarity: float = 0.8, reject_similarity: float = 0.5) -> object:
+        self._embedding_model = embedding_model
+        self._match_similarity = match_similarity
+        self._reject_similarity = reject_similarity
+        self._prototypes = None
+        self._lock = threading.Lock()
+        self.decisions = Counter()
+
+        self._phrases = {}
+
+        for language, kinds in self.LEXICON.items():
+            for kind, phrases in kinds.items():
+                for phrase in phrases:
+                    self._phrases.setdefault(tuple(phrase.split()), (language, kind))
+
+        self._longest_phrase = max(len(phrase) for phrase in self._phrases)
+
+    @classmethod
+    def normalize(cls, text: str) -> str:
+        '''Lowercase text without accents, punctuation or letters repeated for emphasis ("oiii" is "oi").'''
+
+        text = unicodedata.normalize('NFKD', text.lower())
+        text = ''.join(character for character in text if not unicodedata.combining(character))
+        text = cls._REPEATED_LETTERS_PATTERN.sub(r'\1', text)
+
+        return cls._NON_WORD_PATTERN.sub(' ', text).strip()
+
+    def answer(self, language: str, kind: str) -> str:
+        '''Template answer to a greeting of kind in language.'''
+
+        salutations = self.SALUTATIONS[language]
+
+        return f'{salutations.get(kind, salutations["hello"])} {self.OFFERS[language]}'
+
+    def _match_lexicon(self, words: list[str]) -> tuple[list, list[str]]:
+        '''The (language, kind) of the lexicon phrases in words, longest first, and the other words but fillers.'''
+
+        matches, others, position = [], [], 0
+
+        while position < len(words):
+            for length in range(min(self._longest_phrase, len(words) - position), 0, -1):
+                match = self._phrases.get(tuple(words[position:position + length]))
+
+                if match is not None:
+                    matches.append(match)
+                    position += length
+                    break
+
+            else:
+                if words[position] not in self.FILLERS:
+                    others.append(words[position])
+
+                position += 1
+
+        return matches, others
+
+    def _prototype_embeddings(self) -> tuple[np.ndarray, list, np.ndarray]:
+        '''Normalized embeddings of the lexicon greetings, with their (language, kind), and of the question prototypes.'''
+
+        if self._prototypes is None:
+            with self._lock:
+                if self._prototypes is None:
+                    phrases = list(self._phrases)
+                    embeddings = np.asarray(
+                        self._embedding_model.embed_documents([' '.join(phrase) for phrase in phrases] + list(self.QUESTION_PROTOTYPES)),
+                        dtype = np.float32
+                    )
+                    embeddings /= np.maximum(np.linalg.norm(embeddings, axis = 1, keepdims = True), 1e-12)
+
+                    self._prototypes = (
+                        embeddings[:len(phrases)], [self._phrases[phrase] for phrase in phrases], embeddings[len(phrases):]
+                    )
+
+        return self._prototypes
+
+    def _classify(self, question: str) -> tuple[str, str, str]:
+        ''''''
+
+        words = self.normalize(question).split()
+
+        if not words:
+            return self.AMBIGUOUS, None, 'lexicon'
+
+        matches, others = self._match_lexicon(words)
+
+        if matches and not others:
+            # "Olá, bom dia" is answered with the part of the day
+            language, kind = next((match for match in matches if match[1] != 'hello'), matches[0])
+
+            return self.GREETING, self.answer(language, kind), 'lexicon'
+
+        if len(others) > self.MAX_SHORT_WORDS or (not matches and question.rstrip().endswith('?')):
+            return self.OTHER, None, 'lexicon'
+
+        if self._embedding_model is None:
+            return self.AMBIGUOUS, None, 'lexicon'
+
+        greetings, greeting_kinds, questions = self._prototype_embeddings()
+        query = np.asarray(self._embedding_model.embed_query(' '.join(words)), dtype = np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+
+        greeting_similarities = greetings @ query
+        nearest = int(np.argmax(greeting_similarities))
+        greeting_similarity, question_similarity = greeting_similarities[nearest], float(np.max(questions @ query))
+
+        if greeting_similarity >= self._match_similarity and greeting_similarity >= question_similarity + self.MARGIN:
+            return self.GREETING, self.answer(*greeting_kinds[nearest]), 'embedding'
+
+        if greeting_similarity < self._reject_similarity or question_similarity >= greeting_similarity + self.MARGIN:
+            return self.OTHER, None, 'embedding'
+
+        return self.AMBIGUOUS, None, 'embedding'
+
+    def classify(self, question: str) -> tuple[str, str]:
+        '''GREETING with its template answer, OTHER, or AMBIGUOUS when the LLM has to decide; the answer is None then.'''
+
+        label, answer, source = self._classify(question)
+        self.decisions[f'{label}:{source}'] += 1
+
+        return label, answer
+
+
+
+class SemanticAnswerCache:
+    '''
+    In-process cache of final answers by question embedding, so a question asked again in other words skips the search
+    and the LLM. The normalized embeddings live in a small exact inner product index and a question within
+    max_distance (1 - cosine similarity) of a cached one gets its answer. Entries expire after ttl seconds, the least
+    recently used are evicted past max_entries, and everything is dropped when the index version changes.
+    '''
+
+    def __init__(self, max_distance: float = 0.05, ttl: float = 6 * 3600, max_entries: int = 5000) -> object:
+        self._max_distance = max_distance
+        self._ttl = ttl
+        self._max_entries = max(max_entries, 1)
+        self._lock = threading.Lock()
+        self._index = None
+        self._index_version = None
+        # Ids in least recently used first order, with their answer and the time it was stored
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self.metrics = Counter()
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        ''''''
+
+        vector = np.asarray(embedding, dtype = np.float32).reshape(1, -1)
+
+        return vector / max(np.linalg.norm(vector), 1e-12)
+
+    def _check_version(self, index_version: str) -> None:
+        '''Drop every entry when the answers were made from another index version.'''
+
+        if index_version != self._index_version:
+            if self._entries:
+                self.metrics['invalidations'] += 1
+
+            self._index, self._index_version, self._next_id = None, index_version, 0
+            self._entries.clear()
+
+    def _remove(self, ids: list[int]) -> None:
+        ''''''
+
+        if ids:
+            self._index.remove_ids(np.asarray(ids, dtype = np.int64))
+
+            for entry_id in ids:
+                del self._entries[entry_id]
+
+    def get(self, embedding, index_version: str) -> str:
+        '''The cached answer to the nearest question within max_distance, None on a miss.'''
+
+        with self._lock:
+            self._check_version(index_version)
+
+            if not self._entries:
+                self.metrics['misses'] += 1
+                return None
+
+            similarities, ids = self._index.search(self._normalize(embedding), 1)
+            entry_id = int(ids[0, 0])
+
+            if entry_id < 0 or 1 - similarities[0, 0] > self._max_distance:
+                self.metrics['misses'] += 1
+                return None
+
+            answer, stored_at = self._entries[entry_id]
+
+            if time.time() - stored_at > self._ttl:
+                self._remove([entry_id])
+                self.metrics['expirations'] += 1
+                self.metrics['misses'] += 1
+                return None
+
+            self._entries.move_to_end(entry_id)
+            self.metrics['hits'] += 1
+
+            return answer
+
+    def put(self, embedding, answer: str, index_version: str) -> None:
+        '''Cache answer, evicting the expired entries and then the least recently used ones past max_entries.'''
+
+        with self._lock:
+            self._check_version(index_version)
+            vector = self._normalize(embedding)
+
+            if self._index is None:
+                self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+
+            now = time.time()
+            expired = [entry_id for entry_id, (_, stored_at) in self._entries.items() if now - stored_at > self._ttl]
+            self._remove(expired)
+            self.metrics['expirations'] += len(expired)
+
+            evicted = list(self._entries)[:max(len(self._entries) - self._max_entries + 1, 0)]
+            self._remove(evicted)
+            self.metrics['evictions'] += len(evicted)
+
+            self._index.add_with_ids(vector, np.asarray([self._next_id], dtype = np.int64))
+            self._entries[self._next_id] = (answer, now)
+            self._next_id += 1
+            self.metrics['stores'] += 1
+
+    def stats(self) -> dict:
+        '''Hit, miss, store and eviction counts, the hit rate and the entries held.'''
+
+        with self._lock:
+            lookups = self.metrics['hits'] + self.metrics['misses']
+
+            return {
+                **{name: self.metrics[name] for name in ('hits', 'misses', 'stores', 'evictions', 'expirations', 'invalidations')},
+                'hit_rate': round(self.metrics['hits'] / lookups, 4) if lookups else None,
+                'entries': len(self._entries),
+                'index_version': self._index_version
+            }
+
+
+
+class SharedAnswerCache:
+    '''
+    Answers shared by every web worker through Redis, by exact question. The key holds the question folded to lowercase
+    without sentence punctuation or repeated whitespace, the index version and the prompt version, so a new index or
+    prompt never serves an old answer. Answers are stored zlib compressed for ttl seconds and the oldest are removed
+    past max_bytes. On a miss one worker computes the answer under a lock while the others asking the same question wait
+    for it. When Redis fails the cache is skipped for retry_after seconds and the answers are computed as before.
+    '''
+
+    # Code operators such as = + [ ] ( ) are kept, they change what a question asks
+    _PUNCTUATION_PATTERN = re.compile(r'[.,!?;:¡¿"“”‘’«»…]+')
+
+    def __init__(
+        self, client, ttl: int = 24 * 3600, max_bytes: int = 256 * 2 ** 20, lock_timeout: float = 60.0,
+        poll_interval: float = 0.05, retry_after: float = 30.0, prefix: str = 'answer_cache'
+    ) -> object:
+        self._client = client
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._lock_timeout = lock_timeout
+        self._poll_interval = poll_interval
+        self._retry_after = retry_after
+        self._prefix = prefix
+        # Keys by the time they were stored, their compressed size and the total of the sizes
+        self._index_key = f'{prefix}:index'
+        self._sizes_key = f'{prefix}:sizes'
+        self._bytes_key = f'{prefix}:bytes'
+        self._unavailable_until = 0.0
+        self.metrics = Counter()
+
+    @classmethod
+    def from_settings(cls) -> 'SharedAnswerCache':
+        '''The cache configured in the settings, None when it is disabled.'''
+
+        if not settings.ANSWER_CACHE_ENABLED:
+            return None
+
+        client = redis.Redis.from_url(settings.ANSWER_CACHE_REDIS_URL, socket_connect_timeout = 0.5, socket_timeout = 0.5)
+
+        return cls(
+            client,
+            ttl = settings.ANSWER_CACHE_TTL,
+            max_bytes = settings.ANSWER_CACHE_MAX_MB * 2 ** 20,
+            lock_timeout = settings.ANSWER_CACHE_LOCK_TIMEOUT
+        )
+
+    @classmethod
+    def normalize(cls, question: str) -> str:
+        ''''''
+
+        question = unicodedata.normalize('NFKC', question).casefold()
+
+        return ' '.join(cls._PUNCTUATION_PATTERN.sub(' ', question).split())
+
+    def key(self, question: str, index_version: str, prompt_version: str) -> str:
+        ''''''
+
+        digest = hashlib.sha256(self.normalize(question).encode()).hexdigest()
+
+        return f'{self._prefix}:{index_version}:{prompt_version}:{digest}'
+
+    def get(self, key: str) -> str:
+        ''''''
+
+        value = self._client.get(key)
+
+        return zlib.decompress(value).decode() if value is not None else None
+
+    def _store(self, key: str, value: bytes, now: float) -> int:
+        '''
+        Write value under key with its size in one transaction, retried while another worker writes or removes the same
+        key in between, and return the total of the sizes after it.
+        '''
+
+        with self._client.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(key)
+                    previous_size = int(pipeline.hget(self._sizes_key, key) or 0)
+
+                    pipeline.multi()
+                    pipeline.set(key, value, ex = self._ttl)
+                    pipeline.zadd(self._index_key, {key: now})
+                    pipeline.hset(self._sizes_key, key, len(value))
+                    pipeline.incrby(self._bytes_key, len(value) - previous_size)
+
+                    return pipeline.execute()[-1]
+
+                except redis.WatchError:
+                    continue
+
+    def set(self, key: str, answer: str) -> None:
+        '''Store answer under key, then remove the expired answers and the oldest ones past max_bytes.'''
+
+        value = zlib.compress(answer.encode(), 6)
+        now = time.time()
+        total_bytes = self._store(key, value, now)
+
+        _, remaining_bytes = self._remove(self._client.zrangebyscore(self._index_key, '-inf', now - self._ttl))
+        if remaining_bytes is not None:
+            total_bytes = remaining_bytes
+
+        while total_bytes > self._max_bytes:
+            oldest = self._client.zrange(self._index_key, 0, 31)
+
+            if not oldest:
+                break
+
+            evicted, remaining_bytes = self._remove(oldest)
+            self.metrics['evictions'] += evicted
+            # Another worker removed the same keys first, its total is read back
+            total_bytes = remaining_bytes if remaining_bytes is not None else int(self._client.get(self._bytes_key) or 0)
+
+    def _remove(self, keys: list) -> tuple[int, int]:
+        '''
+        Remove keys from the cache; only the worker whose ZREM takes a key out of the index subtracts its size. Returns
+        how many keys this worker removed and the total of the sizes after it, None when it removed none.
+        '''
+
+        if not keys:
+            return 0, None
+
+        pipeline = self._client.pipeline()
+        for key in keys:
+            pipeline.zrem(self._index_key, key)
+        owned = [key for key, removed in zip(keys, pipeline.execute()) if removed]
+
+        if not owned:
+            return 0, None
+
+        sizes = self._client.hmget(self._sizes_key, owned)
+
+        pipeline = self._client.pipeline()
+        pipeline.delete(*owned)
+        pipeline.hdel(self._sizes_key, *owned)
+        pipeline.incrby(self._bytes_key, -sum(int(size or 0) for size in sizes))
+
+        return len(owned), pipeline.execute()[-1]
+
+    def _release(self, lock_key: str, token: str) -> None:
+        '''Delete the lock unless it expired and another worker took it since.'''
+
+        with self._client.pipeline() as pipeline:
+            try:
+                pipeline.watch(lock_key)
+
+                if pipeline.get(lock_key) == token.encode():
+                    pipeline.multi()
+                    pipeline.delete(lock_key)
+                    pipeline.execute()
+
+            except redis.WatchError:
+                pass
+
+    def _wait(self, key: str, lock_key: str) -> str:
+        '''The answer the worker holding the lock stores, None when it released the lock without one or timed out.'''
+
+        deadline = time.monotonic() + self._lock_timeout
+
+        while time.monotonic() < deadline:
+            time.sleep(self._poll_interval)
+            answer = self.get(key)
+
+            if answer is not None or not self._client.exists(lock_key):
+                return answer
+
+        return None
+
+    def _failed(self, error: Exception) -> None:
+        ''''''
+
+        logger.warning('Answer cache unavailable, skipping it for %.0fs: %s', self._retry_after, error)
+        self._unavailable_until = time.monotonic() + self._retry_after
+        self.metrics['errors'] += 1
+
+    def get_or_compute(self, key: str, compute) -> str:
+        '''
+        The answer cached under key, or the first item of compute(), stored when its second item is true. Concurrent
+        misses on the same key wait for the one computing it instead of computing it again.
+        '''
+
+        if time.monotonic() < self._unavailable_until:
+            self.metrics['bypasses'] += 1
+            return compute()[0]
+
+        lock_key, token, locked, available = f'{key}:lock', uuid.uuid4().hex, False, True
+
+        try:
+            answer = self.get(key)
+
+            if answer is not None:
+                self.metrics['hits'] += 1
+                return answer
+
+            self.metrics['misses'] += 1
+            locked = self._client.set(lock_key, token, nx = True, px = int(self._lock_timeout * 1000))
+
+            if not locked:
+                answer = self._wait(key, lock_key)
+
+                if answer is not None:
+                    self.metrics['waited_hits'] += 1
+                    return answer
+
+        except redis.RedisError as e:
+            self._failed(e)
+            available = False
+
+        try:
+            answer, cacheable = compute()
+
+            if cacheable and available:
+                try:
+                    self.set(key, answer)
+
+                except redis.RedisError as e:
+                    self._failed(e)
+
+            return answer
+
+        finally:
+            if locked:
+                try:
+                    self._release(lock_key, token)
+
+                except redis.RedisError as e:
+                    self._failed(e)
+
+
+
+class SearchResourcesRegistry:
+    '''
+    Process-wide registry of the heavy objects used to answer questions: the embedding model, the FAISS
+    vector stores, the Gemini clients and the compiled prompt chains. Everything is created lazily on first
+    use and kept for the lifetime of the worker; a vector store is swapped when a new index version is published.
+    '''
+
+    _lock = threading.RLock()
+    _embedding_model = None
+    _greeting_classifier = None
+    _executor = None
+    _llms = {}
+    _chains = {}
+    _vectorstores = {}
+    _answer_caches = {}
+    _shared_answer_cache = None
+    _stats = {}
+
+    @classmethod
+    def _record_load(cls, name: str, started_at: float, rss_before: int) -> None:
+        ''''''
+
+        stats = {
+            'load_seconds': round(time.perf_counter() - started_at, 3),
+            'memory_bytes': max(_process_rss_bytes() - rss_before, 0),
+            'loaded_at': time.time()
+        }
+        cls._stats[name] = stats
+
+        logger.info("Loaded %s in %.3fs (+%.1f MiB RSS)", name, stats['load_seconds'], stats['memory_bytes'] / 2 ** 20)
+
+    @staticmethod
+    def _index_signature(faiss_path: str) -> tuple:
+        '''
+        Directory of the index served from faiss_path and what identifies it: the published version of a versioned
+        index, otherwise the size and modification time of the files of an index saved before versions existed.
+        '''
+
+        version_store = IndexVersionStore(faiss_path)
+        version = version_store.current()
+
+        if version is not None:
+            return version_store.path(version), ('version', version)
+
+        signature = []
+
+        for file_name in ('index.faiss', 'index.pkl', ServingIndex.DOCSTORE_FILE):
+            if file_name == ServingIndex.DOCSTORE_FILE and not ServingIndex.exists(faiss_path):
+                continue
 
-    def _get_url_data_from_huggingface(self, url: str) -> list[str]:
-        ''''''
-        
-        response = requests.get(url)
-        response.raise_for_status()
-        
-        return response.json()
-    
-    def _ensure_data_loaded(self) -> None:
-        ''''''
+            file_stat = os.stat(os.path.join(faiss_path, file_name))
+            signature.append((file_name, file_stat.st_size, file_stat.st_mtime_ns))
 
-        if self._full_df is not None:
-            return
-            
-        urls = self._get_url_data_from_huggingface(self._train_data_url)
-        test_urls = self._get_url_data_from_huggingface(self._test_data_url)
-        urls.extend(test_urls)
+        return faiss_path, tuple(signature)
 
-        dfs = []
-        
-        for url in urls:
-            response = requests.get(url)
-            response.raise_for_status()
-            
-            parquet_file = BytesIO(response.content)
-            df = pd.read_parquet(parquet_file)
-            dfs.append(df)
+    @staticmethod
+    def _version_of(signature: tuple) -> str:
+        '''The published version, or for an index saved before versions existed a digest of its file signature.'''
 
-        self._full_df = pd.concat(dfs, ignore_index = True)
-        self._full_df['metadata'] = self._full_df['metadata'].str[0]
+        return signature[1] if signature[:1] == ('version',) else hashlib.sha1(repr(signature).encode()).hexdigest()[:16]
 
-    def get_qid_batches(self) -> list[list[str]]:
-        ''''''
+    @classmethod
+    def get_index_version(cls, faiss_path: str) -> str:
+        '''Version of the index served from faiss_path, read from disk without loading it.'''
 
-        self._ensure_data_loaded()
-        unique_qids = self._full_df['qid'].unique()
-        
-        batches = []
-        
-        for i in range(0, len(unique_qids), self._qids_per_batch):
-            batch = unique_qids[i:i + self._qids_per_batch].tolist()
-            batches.append(batch)
-        
-        return batches
-    
-    def fetch_data_by_qids(self, qid_batch: list[str]) -> pd.DataFrame:
-        ''''''
+        return cls._version_of(cls._index_signature(faiss_path)[1])
 
-        self._ensure_data_loaded()
-        
-        batch_df = self._full_df[self._full_df['qid'].isin(qid_batch)].copy()
-        
-        return batch_df
-    
-    def clear_cache(self) -> None:
+    @staticmethod
+    def _load_vectorstore(index_path: str, embedding_model: Embeddings) -> FAISS:
         ''''''
 
-        if self._full_df is not None:
-            del self._full_df
-            self._full_df = None
-            gc.collect()
+        manifest_path = os.path.join(index_path, IndexVersionStore.MANIFEST_FILE)
 
+        if os.path.exists(manifest_path):
+            version_store = IndexVersionStore(os.path.dirname(os.path.dirname(index_path)))
+            incomplete = version_store.verify(os.path.basename(index_path), full = False)
 
+            if incomplete:
+                raise ValueError(f'Versão do índice FAISS incompleta: {", ".join(incomplete)}')
 
-class DataConsolidationService:
-    ''''''
+        # Indexes saved before the serving format existed are still unpickled whole
+        if ServingIndex.exists(index_path):
+            vectorstore = ServingIndex.load(index_path, embedding_model)
 
-    def __init__(self, batch_df: pd.DataFrame) -> object:
-        self._batch_df = batch_df
+        else:
+            vectorstore = FAISS.load_local(
+                index_path,
+                embeddings = embedding_model,
+                allow_dangerous_deserialization = True
+            )
 
-    def _join_texts(self, series):
-        ''''''
-        
-        return "\n\n---\n\n".join(series.dropna().astype(str).unique())
+        # Search parameters such as nprobe are not stored in the index file
+        index_params = FaissIndexBuilder.load_params(index_path)
+        if index_params:
+            FaissIndexBuilder.apply_search_parameters(vectorstore.index, index_params.get('search_parameters'))
 
-    def _group_question_answer(self) -> pd.DataFrame:
+        return vectorstore
+
+    @classmethod
+    def get_embedding_model(cls) -> Embeddings:
         ''''''
-        
-        consolidated_df = self._batch_df.groupby('qid').agg(
-            question = ('question', 'first'),
-            metadata = ('metadata', 'first'),
-            response_j = ('response_j', self._join_texts),
-            response_k = ('response_k', self._join_texts)
-        ).reset_index()
 
-        consolidated_df['consolidated_answers'] = consolidated_df['response_j'] + "\n\n---\n\n" + consolidated_df['response_k']
-        consolidated_df.drop(columns = ['response_j', 'response_k'], inplace = True)
+        if cls._embedding_model is None:
+            with cls._lock:
+                if cls._embedding_model is None:
+                    started_at, rss_before = time.perf_counter(), _process_rss_bytes()
 
-        return consolidated_df
+                    cls._embedding_model = EmbeddingBackend.from_settings().load(device = 'cpu')
 
-    def _classify_relevant_sentences(self, consolidated_df: pd.DataFrame) -> pd.DataFrame:
-        ''''''
-        
-        consolidated_df_processed = consolidated_df.copy()
+                    cls._record_load('embedding_model', started_at, rss_before)
 
-        consolidated_df_processed['full_text_lower'] = (
-            consolidated_df_processed['question'].str.lower() + " " + consolidated_df_processed['consolidated_answers'].str.lower()
-        )
+        return cls._embedding_model
 
-        python_keywords_regex = r'python|pandas|numpy|django|flask|\bdef\b|\bclass\b|\bimport\b|\bself\b'
-        other_lang_keywords_regex = r'php|objective-c|java|c\#|swift|javascript'
+    @classmethod
+    def get_greeting_classifier(cls) -> GreetingClassifier:
+        '''The local greeting classifier, comparing messages with the embedding model of the index.'''
 
-        consolidated_df_processed['python_signal_count'] = consolidated_df_processed['full_text_lower'].str.findall(python_keywords_regex, flags = re.IGNORECASE).str.len()
+        if cls._greeting_classifier is None:
+            embedding_model = cls.get_embedding_model()
 
-        consolidated_df_processed['is_other_lang'] = consolidated_df_processed['full_text_lower'].str.contains(other_lang_keywords_regex, na = False, case = False)
-        consolidated_df_processed['has_code_block'] = consolidated_df_processed['consolidated_answers'].str.contains('```', na = False)
+            with cls._lock:
+                if cls._greeting_classifier is None:
+                    cls._greeting_classifier = GreetingClassifier(
+                        embedding_model,
+                        match_similarity = settings.GREETING_MATCH_SIMILARITY,
+                        reject_similarity = settings.GREETING_REJECT_SIMILARITY
+                    )
 
-        return consolidated_df_processed
-    
-    def _filter_by_flags(self, consolidated_df: pd.DataFrame) -> pd.DataFrame:
-        ''''''
+        return cls._greeting_classifier
 
-        final_mask = (
-            (consolidated_df['python_signal_count'] >= 3) & 
-            (~consolidated_df['is_other_lang']) & 
-            (consolidated_df['has_code_block'])
-        )
+    @classmethod
+    def get_executor(cls) -> ThreadPoolExecutor:
+        '''Thread pool answering questions while their greeting classification runs.'''
 
-        focused_df = consolidated_df[final_mask].copy()
-        focused_df.drop(columns = ['full_text_lower', 'python_signal_count', 'is_other_lang', 'has_code_block'], inplace = True)
+        if cls._executor is None:
+            with cls._lock:
+                if cls._executor is None:
+                    cls._executor = ThreadPoolExecutor(
+                        max_workers = settings.QUESTION_PIPELINE_WORKERS, thread_name_prefix = 'question'
+                    )
 
-        return focused_df
+        return cls._executor
 
-    def consolidate_batch(self) -> int:
+    @classmethod
+    def get_llm(cls, model_name: str, temperature: float) -> ChatGoogleGenerativeAI:
         ''''''
 
-        consolidated_df = self._group_question_answer()
-        
-        del self._batch_df
-        gc.collect()
+        key = (model_name, temperature)
+        llm = cls._llms.get(key)
 
-        consolidated_df_processed = self._classify_relevant_sentences(consolidated_df)
-        
-        del consolidated_df
-        gc.collect()
+        if llm is None:
+            with cls._lock:
+                llm = cls._llms.get(key)
 
-        focused_df = self._filter_by_flags(consolidated_df_processed)
-        
-        del consolidated_df_processed
-        gc.collect()
+                if llm is None:
+                    os.environ["GOOGLE_API_KEY"] = config("GOOGLE_API_KEY")
 
-        if focused_df.empty:
-            return 0
+                    llm = ChatGoogleGenerativeAI(model = model_name, temperature = temperature)
+                    cls._llms[key] = llm
 
-        focused_df.reset_index(inplace = True)
-        focused_df = focused_df.rename(columns = {'index': 'parent_index'})
+        return llm
 
-        documents = [
-            Document(
-                parent_index = row['parent_index'],
-                qid = row['qid'],
-                question = row['question'],
-                metadata = row['metadata'],
-                consolidated_answers = row['consolidated_answers']
-            )
-            for row in focused_df.to_dict(orient = 'records')
-        ]
+    @classmethod
+    def get_chain(cls, prompt_template: str, model_name: str, temperature: float):
+        '''Return the prompt | llm chain for a template, compiling it only the first time it is requested.'''
 
-        Document.objects.bulk_create(documents)
-        
-        docs_count = len(documents)
-        
-        del focused_df, documents
-        gc.collect()
-        
-        return docs_count
+        key = (prompt_template, model_name, temperature)
+        chain = cls._chains.get(key)
 
+        if chain is None:
+            llm = cls.get_llm(model_name, temperature)
 
+            with cls._lock:
+                chain = cls._chains.get(key)
 
-class CreateFaissTreeService:
-    ''''''
+                if chain is None:
+                    chain = PromptTemplate.from_template(prompt_template) | llm
+                    cls._chains[key] = chain
 
-    def __init__(self, documents_batch_size: int = 5000) -> object:
-        self._documents_batch_size = documents_batch_size
+        return chain
 
-    def _clean_text(self, text: str) -> str:
-        ''''''
-        
-        if not isinstance(text, str):
-            return ""
-        
-        try:
-            soup = BeautifulSoup(text, "lxml")
-            text = soup.get_text()
-        
-        except Exception:
-            pass
-        
-        text = re.sub(r'http\S+|www\S+|https\S+', '', text, flags = re.MULTILINE)
-        text = re.sub(r'\[([^\]]*)\]\([^\)]*\)?', r'\1', text)
-        text = re.sub(r'```[a-zA-Z]*\n', '', text)
-        text = text.replace('```', '')
-        text = text.replace('`', '')
-        text = re.sub(r'\s+', ' ', text).strip()
-        
-        return text
+    @classmethod
+    def get_vectorstore(cls, faiss_path: str) -> FAISS:
+        '''
+        Return the FAISS vector store served from faiss_path, swapping in the new version as soon as one is published
+        (or, for an index saved before versions existed, as soon as its files change).
+        '''
 
-    def _create_chunks_batch(self, documents_df: pd.DataFrame) -> pd.DataFrame:
-        ''''''
+        return cls.get_versioned_vectorstore(faiss_path)[0]
 
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size = 2000,
-            chunk_overlap = 400,
-            separators = ["\n\n", "\n", " ", ""],
-            length_function = len
-        )
+    @classmethod
+    def get_versioned_vectorstore(cls, faiss_path: str) -> tuple[FAISS, str]:
+        '''The vector store served from faiss_path and the version of the index it holds.'''
 
-        documents_df['text_for_chunking'] = documents_df['question'] + "\n\nAnswers:\n" + documents_df['consolidated_answers']
-        documents_df['raw_chunks'] = documents_df['text_for_chunking'].apply(lambda text: text_splitter.split_text(text))
+        index_path, signature = cls._index_signature(faiss_path)
+        loaded = cls._vectorstores.get(faiss_path)
 
-        chunks_df = documents_df[['parent_index', 'metadata', 'raw_chunks']].explode('raw_chunks')
-        chunks_df = chunks_df.rename(columns = {'raw_chunks': 'raw_text_chunk'})
-        chunks_df['cleaned_text_chunk'] = chunks_df['raw_text_chunk'].apply(self._clean_text)
-        chunks_df = chunks_df[chunks_df['cleaned_text_chunk'].str.strip().astype(bool)].reset_index(drop = True)
+        if loaded is None or loaded[0] != signature:
+            embedding_model = cls.get_embedding_model()
 
-        return chunks_df
+            with cls._lock:
+                loaded = cls._vectorstores.get(faiss_path)
 
-    def _process_embeddings_batch(self, chunks_df: pd.DataFrame, embedding_model, batch_size: int = 512):
-        ''''''
+                if loaded is None or loaded[0] != signature:
+                    started_at, rss_before = time.perf_counter(), _process_rss_bytes()
 
-        embeddings_data = []
-        total_chunks = len(chunks_df)
-        
-        for i in range(0, total_chunks, batch_size):
-            batch_chunks = chunks_df.iloc[i:i + batch_size]
-            
-            texts_to_embed = batch_chunks['cleaned_text_chunk'].tolist()
-            texts_to_store = batch_chunks['raw_text_chunk'].tolist()
-            metadatas = [
-                {'parent_index': row.parent_index, 'metadata_link': row.metadata}
-                for row in batch_chunks.itertuples(index=False)
-            ]
-            
-            if texts_to_embed:
-                embeddings = embedding_model.embed_documents(texts_to_embed)
-                
-                for text, embedding, metadata in zip(texts_to_store, embeddings, metadatas):
-                    embeddings_data.append((text, embedding, metadata))
-            
-            gc.collect()
-        
-        return embeddings_data
+                    try:
+                        vectorstore = cls._load_vectorstore(index_path, embedding_model)
 
-    def create_faiss_index(self, batch_size: int = 512, faiss_save_path: str = 'faiss_index', task_id: str = None) -> None:
-        ''''''
-        
-        embedding_model = HuggingFaceEmbeddings(
-            model_name='all-MiniLM-L6-v2',
-            model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"}
-        )
-        
-        total_documents = Document.objects.count()
-        if total_documents == 0:
-            raise ValueError("Nenhum documento encontrado no banco de dados")
-        
-        vectorstore = None
-        processed_docs = 0
-        
-        for offset in range(0, total_documents, self._documents_batch_size):
-            if task_id:
-                TaskStatus.objects.filter(task_id = task_id).update(
-                    status = states.PENDING,
-                    result = f'Processando embeddings: {processed_docs}/{total_documents} documentos'
-                )
-            
-            queryset = Document.objects.values().order_by('id')[offset:offset + self._documents_batch_size]
-            documents_df = pd.DataFrame.from_records(queryset)
-            
-            if documents_df.empty:
-                continue
-            
-            chunks_df = self._create_chunks_batch(documents_df)
-            
-            del documents_df
-            gc.collect()
-            
-            if chunks_df.empty:
-                continue
-            
-            embeddings_data = self._process_embeddings_batch(chunks_df, embedding_model, batch_size)
-            
-            del chunks_df
-            gc.collect()
-            
-            if not embeddings_data:
-                continue
-            
-            texts_to_store = [item[0] for item in embeddings_data]
-            embeddings = [item[1] for item in embeddings_data]
-            metadatas = [item[2] for item in embeddings_data]
-            
-            text_embedding_pairs = list(zip(texts_to_store, embeddings))
-            
-            if vectorstore is None:
-                vectorstore = FAISS.from_embeddings(text_embedding_pairs, embedding_model, metadatas = metadatas)
-            else:
-                vectorstore.add_embeddings(text_embedding_pairs, metadatas = metadatas)
-            
-            del embeddings_data, text_embedding_pairs, texts_to_store, embeddings, metadatas
-            gc.collect()
-            
-            processed_docs += min(self._documents_batch_size, total_documents - processed_docs)
-            
-            if task_id:
-                TaskStatus.objects.filter(task_id = task_id).update(
-                    status = states.PENDING,
-                    result = f'Embeddings processados: {processed_docs}/{total_documents} documentos'
-                )
-        
-        if vectorstore:
-            if task_id:
-                TaskStatus.objects.filter(task_id = task_id).update(
-                    status = states.PENDING,
-                    result = 'Salvando índice FAISS...'
+                    except Exception:
+                        if loaded is None:
+                            raise
+
+                        # A version that does not load is skipped until the next publish, the previous one stays served
+                        logger.exception('Could not load the FAISS index at %s, still serving the previous one', index_path)
+                        loaded = (signature, *loaded[1:])
+                        cls._vectorstores[faiss_path] = loaded
+
+                        return loaded[1:]
+
+                    index_version = cls._version_of(signature)
+
+                    # In-flight requests keep their own reference to the previous store, only new ones see the reload
+                    loaded = (signature, vectorstore, index_version)
+                    cls._vectorstores[faiss_path] = loaded
+
+                    cls._record_load(f'vectorstore:{faiss_path}', started_at, rss_before)
+                    cls._stats[f'vectorstore:{faiss_path}']['version'] = index_version
+
+        return loaded[1:]
+
+    @classmethod
+    def versions_in_use(cls) -> set[str]:
+        '''Index versions of the vector stores this process serves, which must outlive their retirement.'''
+
+        return {loaded[2] for loaded in list(cls._vectorstores.values())}
+
+    @classmethod
+    def get_shared_answer_cache(cls) -> SharedAnswerCache:
+        '''The answer cache shared by the workers through Redis, None when it is disabled.'''
+
+        if cls._shared_answer_cache is None and settings.ANSWER_CACHE_ENABLED:
+            with cls._lock:
+                if cls._shared_answer_cache is None:
+                    cls._shared_answer_cache = SharedAnswerCache.from_settings()
+
+        return cls._shared_answer_cache
+
+    @classmethod
+    def get_answer_cache(cls, faiss_path: str) -> SemanticAnswerCache:
+        '''The semantic answer cache of the index at faiss_path, None when the cache is disabled.'''
+
+        if not settings.SEMANTIC_CACHE_ENABLED:
+            return None
+
+        answer_cache = cls._answer_caches.get(faiss_path)
+
+        if answer_cache is None:
+            with cls._lock:
+                answer_cache = cls._answer_caches.setdefault(
+                    faiss_path,
+                    SemanticAnswerCache(
+                        max_distance = settings.SEMANTIC_CACHE_MAX_DISTANCE,
+                        ttl = settings.SEMANTIC_CACHE_TTL,
+                        max_entries = settings.SEMANTIC_CACHE_MAX_ENTRIES
+                    )
                 )
-            
-            vectorstore.save_local(faiss_save_path)
-            
-            del vectorstore, embedding_model
-            gc.collect()
-        
-        else:
-            raise ValueError("O vectorstore não foi criado. Nenhum documento foi processado ou adicionado ao índice.")
+
+        return answer_cache
+
+    @classmethod
+    def stats(cls) -> dict:
+        '''Load time and memory footprint of every resource loaded so far in this process.'''
+
+        with cls._lock:
+            return {
+                'resources': {name: dict(stats) for name, stats in cls._stats.items()},
+                'llm_clients': len(cls._llms),
+                'compiled_chains': len(cls._chains),
+                'greeting_decisions': dict(cls._greeting_classifier.decisions) if cls._greeting_classifier is not None else {},
+                'answer_caches': {faiss_path: answer_cache.stats() for faiss_path, answer_cache in cls._answer_caches.items()},
+                'shared_answer_cache': dict(cls._shared_answer_cache.metrics) if cls._shared_answer_cache is not None else {},
+                'process_rss_bytes': _process_rss_bytes()
+            }
+
+    @classmethod
+    def clear(cls) -> None:
+        '''Drop every cached resource, they are loaded again on the next request.'''
+
+        with cls._lock:
+            cls._embedding_model = None
+            cls._greeting_classifier = None
+            cls._llms.clear()
+
+            if cls._executor is not None:
+                cls._executor.shutdown(wait = False, cancel_futures = True)
+                cls._executor = None
+
+            cls._chains.clear()
+            cls._vectorstores.clear()
+            cls._answer_caches.clear()
+            cls._shared_answer_cache = None
+            cls._stats.clear()
+
+        gc.collect()
 
 
 
@@ -364,22 +4357,28 @@ class GetResponseFromGeminiService:
     ''''''
 
     def __init__(self, faiss_path: str, model_name: str = "gemini-1.5-flash") -> object:
-        os.environ["GOOGLE_API_KEY"] = config("GOOGLE_API_KEY")
-        
-        self.embedding_model = HuggingFaceEmbeddings(
-            model_name = 'all-MiniLM-L6-v2',
-            model_kwargs = {'device': 'cpu'}
-        )
-        
-        self.llm = ChatGoogleGenerativeAI(model = model_name, temperature = 0.3)
-        
-        self.vectorstore = FAISS.load_local(
-            faiss_path, 
-            embeddings = self.embedding_model, 
-            allow_dangerous_deserialization = True
-        )
+        self._model_name = model_name
+
+        self.embedding_model = SearchResourcesRegistry.get_embedding_model()
+        self.llm = SearchResourcesRegistry.get_llm(model_name, 0.3)
+        self.vectorstore, self.index_version = SearchResourcesRegistry.get_versioned_vectorstore(faiss_path)
+        self.answer_cache = SearchResourcesRegistry.get_answer_cache(faiss_path)
 
     def classify_greeting(self, question: str) -> str:
+        '''The answer to a greeting, or "other"; only the messages the local classifier cannot settle reach the LLM.'''
+
+        if not settings.GREETING_LOCAL_CLASSIFIER:
+            return self.classify_greeting_with_llm(question)
+
+        label, answer = SearchResourcesRegistry.get_greeting_classifier().classify(question)
+
+        if label == GreetingClassifier.AMBIGUOUS:
+            return self.classify_greeting_with_llm(question)
+
+        return answer if label == GreetingClassifier.GREETING else "other"
+
+    @staticmethod
+    def classify_greeting_with_llm(question: str) -> str:
         ''''''
         
         prompt_template = """
@@ -390,16 +4389,15 @@ class GetResponseFromGeminiService:
             Resposta:
         """
 
-        greeting_llm = ChatGoogleGenerativeAI(model = "gemini-1.5-flash", temperature=0.7)
-        
-        chain = PromptTemplate.from_template(prompt_template) | greeting_llm
+        chain = SearchResourcesRegistry.get_chain(prompt_template, "gemini-1.5-flash", 0.7)
         answer = chain.invoke({"question": question})
         
         result = answer.content.strip().lower()
         
         return result if result != "other" else "other"
     
-    def _choose_best_prompt(self, best_score: float) -> str:
+    @staticmethod
+    def _choose_best_prompt(best_score: float) -> str:
         ''''''
 
         HIGH_CONFIDENCE_THRESHOLD = 0.85
@@ -430,6 +4428,14 @@ class GetResponseFromGeminiService:
         else:
             return json.dumps([{"response": "Não encontrei informações suficientemente relevantes.", "references": []}], indent = 2)
         
+    @classmethod
+    def prompt_version(cls, model_name: str = "gemini-1.5-flash") -> str:
+        '''Digest of the answer prompts and model, which a cached answer has to have been generated with.'''
+
+        prompts = [cls._choose_best_prompt(best_score) for best_score in (0.0, 1.0, 2.0)]
+
+        return hashlib.sha1('\0'.join([model_name, *prompts]).encode()).hexdigest()[:12]
+
     def _filter_best_references(self, vector_results) -> list:
         ''''''
 
@@ -481,30 +4487,115 @@ class GetResponseFromGeminiService:
 
 
 
-    def get_answer(self, question: str, top_k: int = 5) -> str:
-        ''''''
+    def _search_and_generate(self, question: str, top_k: int = 5, cancelled: threading.Event = None) -> dict:
+        '''
+        Embed the question and take its answer from the semantic cache, or search the index and have the LLM answer
+        from the chunks found. Returns the query embedding with the cached answer or with the search results and the
+        answer text; None when cancelled is set before the LLM is called.
+        '''
+
+        embedding = self.embedding_model.embed_query(question)
+        result = {'embedding': embedding, 'cached_answer': None, 'vector_results': [], 'response_text': None}
+
+        if self.answer_cache is not None:
+            result['cached_answer'] = self.answer_cache.get(embedding, self.index_version)
+
+            if result['cached_answer'] is not None:
+                return result
 
-        vector_results = self.vectorstore.similarity_search_with_score(query = question, k = top_k)
+        vector_results = self.vectorstore.similarity_search_with_score_by_vector(
+            embedding, k = top_k, filter = IncrementalIndexService.is_live, fetch_k = top_k * 4
+        )
+        result['vector_results'] = vector_results
 
         if not vector_results:
-            return json.dumps([{"response": "Desculpe, não encontrei nenhuma informação.", "references": []}], indent = 2)
+            return result
+
+        if cancelled is not None and cancelled.is_set():
+            return None
 
         best_score = vector_results[0][1]
         context_for_llm = "\n\n---\n\n".join([doc.page_content for doc, score in vector_results])
 
         appropriate_prompt = self._choose_best_prompt(best_score)
 
-        prompt_template = PromptTemplate.from_template(appropriate_prompt)
-        chain = prompt_template | self.llm
+        chain = SearchResourcesRegistry.get_chain(appropriate_prompt, self._model_name, 0.3)
         
         gemini_answer = chain.invoke({"context": context_for_llm, "question": question})
-        response_text = gemini_answer.content
+        result['response_text'] = gemini_answer.content
+
+        return result
+
+    def _format_answer(self, result: dict) -> str:
+        '''The JSON answer of a _search_and_generate result, cached for the questions asked again in other words.'''
+
+        if result['cached_answer'] is not None:
+            return result['cached_answer']
+
+        if not result['vector_results']:
+            return json.dumps([{"response": "Desculpe, não encontrei nenhuma informação.", "references": []}], indent = 2)
 
-        filtered_results = self._filter_best_references(vector_results)
+        filtered_results = self._filter_best_references(result['vector_results'])
         parent_indices = self._retrieve_original_ref_index(filtered_results)
-        final_output = self._create_response(parent_indices, response_text)
-        
-        return json.dumps(final_output, indent = 2)
+        final_output = self._create_response(parent_indices, result['response_text'])
+        answer = json.dumps(final_output, indent = 2)
+
+        if self.answer_cache is not None:
+            self.answer_cache.put(result['embedding'], answer, self.index_version)
+
+        return answer
+
+    def get_answer(self, question: str, top_k: int = 5) -> str:
+        ''''''
+
+        return self._format_answer(self._search_and_generate(question, top_k))
+
+    def respond(self, question: str) -> str:
+        ''''''
+
+        return self.classify_and_answer(question)[0]
+
+    def classify_and_answer(self, question: str) -> tuple[str, bool]:
+        '''
+        Answer question, or the greeting it is, and tell whether it was a greeting. A message the local classifier
+        settles is answered right away, in the request thread. Only while the LLM classifies a message does the search
+        and LLM answer run ahead on the registry thread pool, so a question takes one LLM round trip instead of two;
+        when the message turns out a greeting the answer is dropped, before its LLM call if that has not started.
+        '''
+
+        if settings.GREETING_LOCAL_CLASSIFIER:
+            label, answer = SearchResourcesRegistry.get_greeting_classifier().classify(question)
+
+            if label == GreetingClassifier.GREETING:
+                return answer, True
+
+            if label == GreetingClassifier.OTHER:
+                return self.get_answer(question), False
+
+        if not settings.QUESTION_PIPELINE_CONCURRENT:
+            greeting = self.classify_greeting_with_llm(question)
+
+            return (greeting, True) if greeting != "other" else (self.get_answer(question), False)
+
+        cancelled = threading.Event()
+        answer_future = SearchResourcesRegistry.get_executor().submit(self._search_and_generate, question, cancelled = cancelled)
+
+        try:
+            greeting = self.classify_greeting_with_llm(question)
+
+        except Exception:
+            cancelled.set()
+            answer_future.cancel()
+            raise
+
+        if greeting != "other":
+            cancelled.set()
+            answer_future.cancel()
+
+            return greeting, True
+
+        # References are read from the database in the request thread, the pool threads never open a connection
+        return self._format_answer(answer_future.result()), False
 
 
 
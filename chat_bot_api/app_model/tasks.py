@@ -1,21 +1,65 @@
 import os
 import gc
 import traceback
-import shutil
+import logging
 import requests
 
-from django.db import IntegrityError
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
 from rest_framework.exceptions import ValidationError
-from celery import shared_task, states
+from celery import chord, shared_task, states
 
 from .models import TaskStatus, Document
-from .services import FetchDataService, DataConsolidationService, CreateFaissTreeService, GetResponseFromGeminiService
+from .services import (
+    ShardDownloadService, FetchDataService, DocumentBulkLoader, ParallelConsolidationService, TrainingCheckpoint,
+    TrainingInProgressError, TrainingHeartbeat, EmbeddingBackend, EmbeddingCache, FaissIndexBuilder,
+    CreateFaissTreeService, IncrementalIndexService, IndexVersionStore, SearchResourcesRegistry,
+    GetResponseFromGeminiService
+)
 from core.models import LogSystem
 
 
+logger = logging.getLogger(__name__)
+
+
+def _open_embedding_cache(embedding_backend: EmbeddingBackend) -> EmbeddingCache:
+    ''''''
+
+    try:
+        return EmbeddingCache(settings.EMBEDDING_CACHE_DIR, embedding_backend.cache_name)
+
+    except RuntimeError as e:
+        logger.warning('%s, embeddings will not be cached', e)
+        return None
+
+
+def _create_indexer(embedding_backend: EmbeddingBackend, embedding_cache: EmbeddingCache = None) -> CreateFaissTreeService:
+    ''''''
+
+    return CreateFaissTreeService(
+        chunk_workers = settings.INDEXING_CHUNK_WORKERS,
+        queue_size = settings.INDEXING_QUEUE_SIZE,
+        embedding_cache = embedding_cache,
+        embedding_backend = embedding_backend,
+        index_builder = FaissIndexBuilder(
+            spec = settings.FAISS_INDEX_SPEC,
+            train_size = settings.FAISS_INDEX_TRAIN_SIZE,
+            nprobe = settings.FAISS_INDEX_NPROBE,
+            ef_search = settings.FAISS_INDEX_EF_SEARCH
+        )
+    )
+
+
 @shared_task
 def set_database_and_train_data(faiss_save_dir: str):
     task_id = set_database_and_train_data.request.id
+    # The index of an earlier run is updated into a new version, unless it predates the current index format and is
+    # rebuilt; a failed run only removes the version it was writing
+    version_store = IndexVersionStore.from_settings(faiss_save_dir)
+    index_existed = version_store.accepts_updates()
+    version_path = None
+    heartbeat = TrainingHeartbeat(task_id).start()
     
     try:
         TaskStatus.objects.get_or_create(
@@ -23,81 +67,179 @@ def set_database_and_train_data(faiss_save_dir: str):
             defaults = {'status': states.PENDING, 'result': 'Iniciando processamento'}
         )
 
-        Document.objects.all().delete()
-        
-        fetch_data = FetchDataService(
-            "https://huggingface.co/api/datasets/tyson0420/stackexchange-overflow-fil-python/parquet/default/train",
-            "https://huggingface.co/api/datasets/tyson0420/stackexchange-overflow-fil-python/parquet/default/test"
-        )
+        checkpoint = TrainingCheckpoint.resume(task_id)
+        rows_per_second = None
 
-        TaskStatus.objects.filter(task_id = task_id).update(
-            status = states.PENDING,
-            result = 'Analisando dados e criando lotes de QIDs'
-        )
-        
-        qid_batches = fetch_data.get_qid_batches()
-        total_batches = len(qid_batches)
-        total_documents_saved = 0
+        if checkpoint.stage != TrainingCheckpoint.EMBEDDING:
+            downloader = ShardDownloadService(
+                cache_dir = settings.DATASET_CACHE_DIR,
+                mirror_dir = settings.DATASET_MIRROR_DIR,
+                offline = settings.DATASET_OFFLINE,
+                max_workers = settings.DATASET_DOWNLOAD_WORKERS
+            )
 
-        TaskStatus.objects.filter(task_id = task_id).update(
-            status = states.PENDING,
-            result = f'Processando {total_batches} lotes de dados'
-        )
+            fetch_data = FetchDataService(
+                "https://huggingface.co/api/datasets/tyson0420/stackexchange-overflow-fil-python/parquet/default/train",
+                "https://huggingface.co/api/datasets/tyson0420/stackexchange-overflow-fil-python/parquet/default/test",
+                downloader = downloader
+            )
 
-        for batch_idx, qid_batch in enumerate(qid_batches, 1):
             TaskStatus.objects.filter(task_id = task_id).update(
                 status = states.PENDING,
-                result = f'Processando lote {batch_idx}/{total_batches} - Baixando dados'
+                updated_at = timezone.now(),
+                result = 'Analisando dados e criando lotes de QIDs'
             )
-            
-            batch_df = fetch_data.fetch_data_by_qids(qid_batch)
-            
-            TaskStatus.objects.filter(task_id = task_id).update(
-                status = states.PENDING,
-                result = f'Processando lote {batch_idx}/{total_batches} - Consolidando dados'
+
+            # Batch numbers differ between the streaming and the in-memory batching of the same data
+            fingerprint = f'{fetch_data.get_dataset_fingerprint()}:{"streaming" if settings.INGESTION_STREAMING else "memory"}'
+
+            # Saving a batch only writes new or changed documents, so restarting the stage over the same table is cheap
+            if not checkpoint.matches(fingerprint):
+                checkpoint.start(fingerprint, f'{faiss_save_dir}_work')
+
+            if settings.INGESTION_STREAMING:
+                batches = fetch_data.iter_qid_batches()
+                total_batches = None
+
+            else:
+                batches = fetch_data.get_batch_plan()
+                total_batches = len(batches)
+
+            data_consolidation = ParallelConsolidationService(
+                workers = settings.CONSOLIDATION_WORKERS,
+                worker_memory_mb = settings.CONSOLIDATION_WORKER_MEMORY_MB,
+                batches_per_child = settings.CONSOLIDATION_BATCHES_PER_CHILD,
+                fetch_data = fetch_data,
+                on_batch_saved = checkpoint.mark_batch_saved
             )
-            
-            data_consolidation = DataConsolidationService(batch_df)
-            docs_saved = data_consolidation.consolidate_batch()
-            total_documents_saved += docs_saved
-            
-            del batch_df, data_consolidation
-            gc.collect()
-            
+
+            completed_batches = checkpoint.completed_batches
+
             TaskStatus.objects.filter(task_id = task_id).update(
                 status = states.PENDING,
-                result = f'Lote {batch_idx}/{total_batches} concluído - {docs_saved} documentos salvos'
+                updated_at = timezone.now(),
+                result = (
+                    f'Processando {total_batches or "os"} lotes de dados com {data_consolidation.get_worker_count()} processo(s)'
+                    + (f', retomando após {len(completed_batches)} lotes já salvos' if completed_batches else '')
+                )
             )
 
+            for batch_idx, docs_saved in data_consolidation.consolidate_batches(batches, skip_batches = completed_batches):
+                batch_label = f'{batch_idx + 1}/{total_batches}' if total_batches else f'{batch_idx + 1}'
+                
+                TaskStatus.objects.filter(task_id = task_id).update(
+                    status = states.PENDING,
+                    updated_at = timezone.now(),
+                    result = f'Lote {batch_label} concluído - {docs_saved} documentos novos ou alterados salvos'
+                )
+
+            rows_per_second = data_consolidation.loader.rows_per_second
+
+            fetch_data.clear_cache()
+
+            del batches, data_consolidation, fetch_data
+            gc.collect()
+
+            with transaction.atomic():
+                removed_qids = DocumentBulkLoader().delete_missing(checkpoint.consolidated_qids())
+                checkpoint.start_embedding(removed_qids)
+
+        total_documents = Document.objects.count()
+        changed_documents = checkpoint.documents_saved
+        load_rate = f' ({rows_per_second:,.0f} documentos/s na gravação)' if rows_per_second is not None else ''
+
         TaskStatus.objects.filter(task_id = task_id).update(
             status = states.PENDING,
-            result = f'Dados consolidados: {total_documents_saved} documentos. Criando embeddings e índice FAISS'
+            updated_at = timezone.now(),
+            result = (
+                f'Dados consolidados: {total_documents} documentos, {changed_documents} novos ou alterados{load_rate} '
+                f'e {len(checkpoint.removed_qids)} removidos. Criando embeddings e índice FAISS'
+            )
         )
 
-        create_faiss_index = CreateFaissTreeService()
-        create_faiss_index.create_faiss_index(
-            batch_size = 512,
-            faiss_save_path = faiss_save_dir,
-            task_id = task_id
-        )
+        if not index_existed and settings.INDEX_BUILD_SHARDS > 1:
+            # The shard tasks embed disjoint id ranges on any free worker and the merge task finishes the run
+            checkpoint.plan_index_shards(CreateFaissTreeService.plan_id_ranges(settings.INDEX_BUILD_SHARDS))
+            os.makedirs(checkpoint.build_dir, exist_ok = True)
+
+            chord(
+                build_index_shard.s(task_id, shard) for shard in range(len(checkpoint.index_shards))
+            )(merge_index_shards.s(task_id, faiss_save_dir))
+
+            TaskStatus.objects.filter(task_id = task_id).update(
+                status = states.PENDING,
+                updated_at = timezone.now(),
+                result = f'Criando embeddings e índice FAISS em {len(checkpoint.index_shards)} partes'
+            )
+
+            return
+
+        embedding_backend = EmbeddingBackend.from_settings()
+        embedding_cache = _open_embedding_cache(embedding_backend)
+        create_faiss_index = _create_indexer(embedding_backend, embedding_cache)
+
+        try:
+            if index_existed:
+                version_path = version_store.create_from_current()
+                index_update = IncrementalIndexService(
+                    version_path,
+                    indexer = create_faiss_index,
+                    compact_ratio = settings.FAISS_COMPACT_TOMBSTONE_RATIO
+                ).update(checkpoint.removed_qids, task_id)
+
+                result = (
+                    f'Processamento concluído! {total_documents} documentos e índice FAISS atualizado: '
+                    f'{index_update["appended_documents"]} documentos adicionados, {index_update["tombstoned_chunks"]} trechos '
+                    f'removidos, {index_update["compacted_chunks"]} trechos compactados'
+                )
+
+            else:
+                version_path = version_store.create()
+                create_faiss_index.create_faiss_index(
+                    batch_size = 512,
+                    faiss_save_path = version_path,
+                    task_id = task_id,
+                    checkpoint = checkpoint
+                )
+
+                result = (
+                    f'Processamento concluído! {total_documents} documentos processados e índice FAISS criado '
+                    f'({create_faiss_index.summary()}; {FaissIndexBuilder.summary(create_faiss_index.index_params)})'
+                )
+
+        finally:
+            if embedding_cache is not None:
+                embedding_cache.close()
+
+        manifest = version_store.publish(version_path, task_id = task_id, documents = total_documents)
+
+        if not index_existed:
+            create_faiss_index.mark_indexed()
+
+        checkpoint.finish()
 
         TaskStatus.objects.filter(task_id = task_id).update(
             status = states.SUCCESS,
-            result = f'Processamento concluído! {total_documents_saved} documentos processados e índice FAISS criado'
+            result = f'{result}. Versão publicada: {manifest["version"]}'
         )
 
-        fetch_data.clear_cache()
         gc.collect()
 
-    except requests.HTTPError as e:
+    except TrainingInProgressError as e:
+        # A duplicate run leaves the running one, its checkpoint and its work directory alone
+        TaskStatus.objects.filter(task_id = task_id).update(
+            status = states.FAILURE,
+            result = str(e)
+        )
+
+    except (requests.HTTPError, requests.ConnectionError) as e:
         TaskStatus.objects.filter(task_id = task_id).update(
             status = states.FAILURE,
             result = f'Erro ao baixar dados: {str(e)}'
         )
 
     except ValidationError as e:
-        if os.path.exists(faiss_save_dir):
-            shutil.rmtree(faiss_save_dir)
+        version_store.discard(version_path)
 
         TaskStatus.objects.filter(task_id = task_id).update(
             status = states.FAILURE,
@@ -120,8 +262,127 @@ def set_database_and_train_data(faiss_save_dir: str):
             result = f'Erro inesperado: {str(e)}'
         )
 
-        if os.path.exists(faiss_save_dir):
-            shutil.rmtree(faiss_save_dir)
+        version_store.discard(version_path)
+
+    finally:
+        heartbeat.stop()
+
+
+
+@shared_task(bind = True, max_retries = settings.INDEX_SHARD_MAX_RETRIES)
+def build_index_shard(self, parent_task_id: str, shard: int) -> dict:
+    '''
+    Build the partial index of one document id range of a sharded build. A failed shard is retried on its own; once
+    out of retries the run is marked as failed and the merge never runs.
+    '''
+
+    checkpoint = TrainingCheckpoint.load(parent_task_id)
+    shard_plan = checkpoint.index_shards[shard]
+
+    if shard_plan['done']:
+        return {'shard': shard, 'path': shard_plan['path']}
+
+    total_documents = Document.objects.count()
+
+    def progress_message(index_shards: list[dict]) -> str:
+        embedded = sum(index_shard['documents'] for index_shard in index_shards)
+        done = sum(index_shard['done'] for index_shard in index_shards)
+
+        return (
+            f'Embeddings processados: {embedded}/{total_documents} documentos em {len(index_shards)} partes '
+            f'({done} concluídas)'
+        )
+
+    embedding_backend = EmbeddingBackend.from_settings()
+    # Only one process holds the cache at a time, the shards running next to it go without
+    embedding_cache = _open_embedding_cache(embedding_backend)
+    heartbeat = TrainingHeartbeat(parent_task_id).start()
+
+    try:
+        shard_result = _create_indexer(embedding_backend, embedding_cache).create_index_shard(
+            os.path.join(checkpoint.build_dir, f'range_{shard:05d}'),
+            shard_plan['after_id'],
+            shard_plan['up_to_id'],
+            batch_size = 512,
+            on_progress = lambda documents: checkpoint.update_index_shard(shard, progress_message, documents = documents)
+        )
+
+    except Exception as e:
+        checkpoint.update_index_shard(shard, progress_message, documents = 0)
+
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc = e, countdown = 10 * 2 ** self.request.retries)
+
+        LogSystem.objects.create(error = str(e), stacktrace = traceback.format_exc())
+
+        TaskStatus.objects.filter(task_id = parent_task_id).update(
+            status = states.FAILURE,
+            result = f'Erro na parte {shard + 1} do índice FAISS: {str(e)}'
+        )
+
+        raise
+
+    finally:
+        heartbeat.stop()
+
+        if embedding_cache is not None:
+            embedding_cache.close()
+
+    checkpoint.update_index_shard(
+        shard, progress_message, documents = shard_result['documents'], path = shard_result['path'], done = True
+    )
+
+    return {'shard': shard, 'path': shard_result['path']}
+
+
+@shared_task
+def merge_index_shards(shard_results: list[dict], parent_task_id: str, faiss_save_dir: str):
+    '''Merge the partial indexes of the shard tasks into a new index version, publish it and finish the run.'''
+
+    version_store = IndexVersionStore.from_settings(faiss_save_dir)
+    version_path = None
+    heartbeat = TrainingHeartbeat(parent_task_id).start()
+
+    try:
+        checkpoint = TrainingCheckpoint.load(parent_task_id)
+        create_faiss_index = _create_indexer(EmbeddingBackend.from_settings())
+        version_path = version_store.create()
+
+        create_faiss_index.merge_index_shards(
+            [shard_result['path'] for shard_result in sorted(shard_results, key = lambda shard_result: shard_result['shard'])],
+            version_path,
+            checkpoint.index_shards[-1]['up_to_id'],
+            parent_task_id
+        )
+
+        total_documents = Document.objects.count()
+        manifest = version_store.publish(version_path, task_id = parent_task_id, documents = total_documents)
+        create_faiss_index.mark_indexed()
+        checkpoint.finish()
+
+        TaskStatus.objects.filter(task_id = parent_task_id).update(
+            status = states.SUCCESS,
+            result = (
+                f'Processamento concluído! {total_documents} documentos processados e índice FAISS criado '
+                f'em {len(shard_results)} partes ({FaissIndexBuilder.summary(create_faiss_index.index_params)}). '
+                f'Versão publicada: {manifest["version"]}'
+            )
+        )
+
+        gc.collect()
+
+    except Exception as e:
+        LogSystem.objects.create(error = str(e), stacktrace = traceback.format_exc())
+
+        TaskStatus.objects.filter(task_id = parent_task_id).update(
+            status = states.FAILURE,
+            result = f'Erro inesperado: {str(e)}'
+        )
+
+        version_store.discard(version_path)
+
+    finally:
+        heartbeat.stop()
 
 
 
@@ -131,14 +392,21 @@ def get_response_from_vector_base(question: str, faiss_path: str) -> str:
     if not question:
         raise ValidationError('no sentence provided for search.')
     
-    get_reponse_from_gemini = GetResponseFromGeminiService(faiss_path = faiss_path)
+    shared_answer_cache = SearchResourcesRegistry.get_shared_answer_cache()
 
-    verify_greetings = get_reponse_from_gemini.classify_greeting(question)
+    if shared_answer_cache is None:
+        return GetResponseFromGeminiService(faiss_path = faiss_path).respond(question)
 
-    if verify_greetings != 'other':
-        return verify_greetings
-    
-    response = get_reponse_from_gemini.get_answer(question)
+    def answer_question() -> tuple[str, bool]:
+        # Greetings are cheap to answer and not cached
+        answer, is_greeting = GetResponseFromGeminiService(faiss_path = faiss_path).classify_and_answer(question)
+
+        return answer, not is_greeting
+
+    # A question any worker answered is returned without loading the search resources
+    key = shared_answer_cache.key(
+        question, SearchResourcesRegistry.get_index_version(faiss_path), GetResponseFromGeminiService.prompt_version()
+    )
 
-    return response
+    return shared_answer_cache.get_or_compute(key, answer_question)
     
@@ -1,3 +1,1588 @@
-from django.test import TestCase
+import io
+import os
+import json
+import csv
+import time
+import random
+import shutil
+import hashlib
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import faiss
+import numpy as np
+import pandas as pd
+import redis
+import requests
+
+try:
+    import fakeredis
+
+except ImportError:
+    fakeredis = None
+
+from django.conf import settings
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+from celery import chord, states
+from langchain_core.embeddings import FakeEmbeddings, DeterministicFakeEmbedding
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+from chat_bot_api.celery import app as celery_app
+from .models import Document, TaskStatus
+from .views import SendDatabaseAndTrainModel
+from .tasks import set_database_and_train_data, build_index_shard, merge_index_shards, get_response_from_vector_base
+from .management.commands.benchmark_consolidation import reference_group_question_answer, reference_classify_relevant_sentences
+from .management.commands.benchmark_text_cleaner import reference_clean_text
+from .services import (
+    SearchResourcesRegistry, ShardDownloadService, FetchDataService, DocumentBulkLoader, DataConsolidationService,
+    ParallelConsolidationService, TrainingCheckpoint, TrainingInProgressError, TrainingHeartbeat, EmbeddingBackend,
+    EmbeddingCache, FaissIndexBuilder, TextCleaner, SqliteDocstore, ServingIndex, IndexVersionStore,
+    CreateFaissTreeService, IncrementalIndexService, GreetingClassifier, SemanticAnswerCache, SharedAnswerCache,
+    GetResponseFromGeminiService
+)
+
+
+TRAIN_URL = 'https://huggingface.co/api/datasets/tyson0420/stackexchange-overflow-fil-python/parquet/default/train'
+TEST_URL = 'https://huggingface.co/api/datasets/tyson0420/stackexchange-overflow-fil-python/parquet/default/test'
+
+
+def make_stackexchange_df(qids: list[int], start: int = 0) -> pd.DataFrame:
+    '''Build rows shaped like the HuggingFace stackexchange parquet shards.'''
+
+    return pd.DataFrame({
+        'qid': qids,
+        'question': [f'question {qid}' for qid in qids],
+        'date': ['2020-01-01'] * len(qids),
+        'metadata': [[f'https://stackoverflow.com/questions/{qid}'] for qid in qids],
+        'response_j': [f'answer j {i}' for i in range(start, start + len(qids))],
+        'response_k': [f'answer k {i}' for i in range(start, start + len(qids))],
+    })
+
+
+def make_python_answers_df(total_qids: int, first_qid: int = 1) -> pd.DataFrame:
+    '''Build batch rows whose answers pass the Python relevance filter of DataConsolidationService.'''
+
+    qids = [qid for qid in range(first_qid, first_qid + total_qids) for _ in range(2)]
+
+    return pd.DataFrame({
+        'qid': qids,
+        'question': [f'How to use pandas groupby {qid}?' for qid in qids],
+        'metadata': [f'https://stackoverflow.com/questions/{qid}' for qid in qids],
+        'response_j': [f'```python\nimport pandas as pd\ndef f{i}(self): pass\n```' for i in range(len(qids))],
+        'response_k': [f'Use numpy {i}' for i in range(len(qids))],
+    })
+
+
+def make_sentence_transformer(model_dir: str) -> None:
+    '''Save a small randomly initialized BERT with a letter vocabulary, loadable as a sentence-transformers model.'''
+
+    import torch
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + list('abcdefghijklmnopqrstuvwxyz') + [f'##{c}' for c in 'abcdefghijklmnopqrstuvwxyz']
+    vocab_path = os.path.join(model_dir, 'vocab.txt')
+
+    with open(vocab_path, 'w') as vocab_file:
+        vocab_file.write('\n'.join(vocab))
+
+    BertTokenizerFast(vocab_path, model_max_length = 48).save_pretrained(model_dir)
+    torch.manual_seed(0)
+    BertModel(BertConfig(
+        vocab_size = len(vocab), hidden_size = 32, num_hidden_layers = 2, num_attention_heads = 4,
+        intermediate_size = 64, max_position_embeddings = 64
+    )).save_pretrained(model_dir)
+
+
+class SearchResourcesRegistryTest(SimpleTestCase):
+    '''Tests for the process-wide cache of search resources.'''
+
+    def setUp(self):
+        SearchResourcesRegistry.clear()
+        SearchResourcesRegistry._embedding_model = FakeEmbeddings(size = 8)
+
+        self.faiss_dir = tempfile.mkdtemp()
+        self.vectorstore = FAISS.from_embeddings([('text', [0.1] * 8)], SearchResourcesRegistry._embedding_model)
+        self.vectorstore.save_local(self.faiss_dir)
+
+    def tearDown(self):
+        SearchResourcesRegistry.clear()
+        shutil.rmtree(self.faiss_dir)
+
+    def test_vectorstore_is_loaded_once(self):
+        first = SearchResourcesRegistry.get_vectorstore(self.faiss_dir)
+        second = SearchResourcesRegistry.get_vectorstore(self.faiss_dir)
+
+        self.assertIs(first, second)
+        self.assertIn(f'vectorstore:{self.faiss_dir}', SearchResourcesRegistry.stats()['resources'])
+
+    def test_vectorstore_is_reloaded_when_index_changes(self):
+        first = SearchResourcesRegistry.get_vectorstore(self.faiss_dir)
+
+        time.sleep(0.01)
+        self.vectorstore.save_local(self.faiss_dir)
+
+        self.assertIsNot(first, SearchResourcesRegistry.get_vectorstore(self.faiss_dir))
+
+    def test_missing_index_raises_file_not_found(self):
+        with self.assertRaises(FileNotFoundError):
+            SearchResourcesRegistry.get_vectorstore(os.path.join(self.faiss_dir, 'missing'))
+
+    def test_serving_index_reads_chunks_from_sqlite(self):
+        embeddings = np.random.default_rng(0).random((5, 8), dtype = np.float32)
+        chunks_df = pd.DataFrame({
+            'raw_text_chunk': [f'chunk {i}' for i in range(5)],
+            'parent_index': np.arange(10, 15),
+            'metadata': [f'https://stackoverflow.com/questions/{i}' for i in range(5)]
+        })
+        vectorstore = CreateFaissTreeService._add_embeddings(None, SearchResourcesRegistry._embedding_model, embeddings, chunks_df)
+        vectorstore.save_local(self.faiss_dir)
+        ServingIndex.save(vectorstore, self.faiss_dir)
+
+        serving = SearchResourcesRegistry.get_vectorstore(self.faiss_dir)
+        expected = vectorstore.similarity_search_with_score_by_vector(embeddings[3], k = 3)
+        found = serving.similarity_search_with_score_by_vector(embeddings[3], k = 3)
+
+        self.assertIsInstance(serving.docstore, SqliteDocstore)
+        self.assertEqual([document.page_content for document, _ in found], [document.page_content for document, _ in expected])
+        self.assertEqual(found[0][0].metadata, expected[0][0].metadata)
+        self.assertEqual(found[0][0].metadata['parent_index'], 13)
+
+    def _publish(self, version_store: IndexVersionStore, text: str) -> str:
+        vectorstore = FAISS.from_embeddings([(text, [0.1] * 8)], SearchResourcesRegistry._embedding_model)
+        version_path = version_store.create()
+        vectorstore.save_local(version_path)
+        ServingIndex.save(vectorstore, version_path)
+        version_store.publish(version_path)
+
+        return version_path
+
+    def test_published_version_is_swapped_in(self):
+        version_store = IndexVersionStore(self.faiss_dir, keep = 1, retired_grace_seconds = 0)
+        self._publish(version_store, 'first')
+        first = SearchResourcesRegistry.get_vectorstore(self.faiss_dir)
+        first.similarity_search_by_vector([0.1] * 8, k = 1)
+
+        self._publish(version_store, 'second')
+
+        # The first version is still served when the second is published, so it is kept until the swap
+        self.assertEqual(len(version_store.versions()), 2)
+
+        second = SearchResourcesRegistry.get_vectorstore(self.faiss_dir)
+        version_store.gc()
+
+        # The first version was collected, but a request still holding it keeps searching its open files
+        self.assertEqual(len(version_store.versions()), 1)
+        self.assertEqual(first.similarity_search_by_vector([0.1] * 8, k = 1)[0].page_content, 'first')
+        self.assertEqual(second.similarity_search_by_vector([0.1] * 8, k = 1)[0].page_content, 'second')
+        self.assertEqual(
+            SearchResourcesRegistry.stats()['resources'][f'vectorstore:{self.faiss_dir}']['version'], version_store.current()
+        )
+
+    def test_incomplete_version_keeps_the_previous_one_served(self):
+        version_store = IndexVersionStore(self.faiss_dir)
+        self._publish(version_store, 'first')
+        first = SearchResourcesRegistry.get_vectorstore(self.faiss_dir)
+
+        version_path = self._publish(version_store, 'second')
+        with open(os.path.join(version_path, 'index.faiss'), 'r+b') as index_file:
+            index_file.truncate(10)
+
+        with self.assertLogs('app_model.services', 'ERROR'):
+            self.assertIs(SearchResourcesRegistry.get_vectorstore(self.faiss_dir), first)
+
+        self.assertIs(SearchResourcesRegistry.get_vectorstore(self.faiss_dir), first)
+
+
+class IndexVersionStoreTest(SimpleTestCase):
+    '''Tests for the versioned index directories and their publishing.'''
+
+    def setUp(self):
+        self.faiss_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.faiss_dir)
+        self.version_store = IndexVersionStore(self.faiss_dir, keep = 2, retired_grace_seconds = 0)
+
+    def _write_version(self, content: bytes = b'vectors') -> str:
+        version_path = self.version_store.create()
+
+        for name in ('index.faiss', 'index.pkl', FaissIndexBuilder.PARAMS_FILE):
+            with open(os.path.join(version_path, name), 'wb') as index_file:
+                index_file.write(content)
+
+        return version_path
+
+    def test_publish_writes_manifest_and_moves_pointer(self):
+        self.assertIsNone(self.version_store.current_path())
+
+        version_path = self._write_version()
+        manifest = self.version_store.publish(version_path, documents = 3)
+
+        self.assertEqual(self.version_store.current_path(), version_path)
+        self.assertEqual(manifest['documents'], 3)
+        self.assertEqual(manifest['files']['index.faiss']['size'], len(b'vectors'))
+        self.assertEqual(self.version_store.verify(manifest['version']), [])
+
+        with open(os.path.join(version_path, 'index.pkl'), 'wb') as index_file:
+            index_file.write(b'VECTORS')
+
+        self.assertEqual(self.version_store.verify(manifest['version'], full = False), [])
+        self.assertEqual(self.version_store.verify(manifest['version']), ['index.pkl'])
+
+    def test_new_version_shares_the_files_of_the_current_one(self):
+        parent_path = self._write_version()
+        self.version_store.publish(parent_path)
+
+        version_path = self.version_store.create_from_current()
+        manifest = self.version_store.publish(version_path)
+
+        self.assertEqual(manifest['parent'], os.path.basename(parent_path))
+        self.assertTrue(os.path.samefile(os.path.join(parent_path, 'index.faiss'), os.path.join(version_path, 'index.faiss')))
+        self.assertFalse(
+            os.path.samefile(
+                os.path.join(parent_path, FaissIndexBuilder.PARAMS_FILE), os.path.join(version_path, FaissIndexBuilder.PARAMS_FILE)
+            )
+        )
+
+    def test_gc_keeps_the_newest_versions(self):
+        published = []
+
+        for _ in range(4):
+            published.append(self._write_version())
+            self.version_store.publish(published[-1])
+
+        failed_path, stale_path = self._write_version(), self._write_version()
+        os.utime(stale_path, (time.time() - 2 * 24 * 3600, time.time() - 2 * 24 * 3600))
+        self.version_store.gc()
+
+        remaining = {os.path.join(self.faiss_dir, 'versions', name) for name in os.listdir(os.path.join(self.faiss_dir, 'versions'))}
+        self.assertEqual(remaining, {published[-2], published[-1], failed_path})
+
+        self.version_store.rollback(os.path.basename(published[-2]))
+        self.version_store.discard(published[-2])
+
+        self.assertEqual(self.version_store.current_path(), published[-2])
+        self.assertTrue(os.path.exists(published[-2]))
+
+    def test_gc_keeps_retired_versions_still_in_use(self):
+        version_store = IndexVersionStore(self.faiss_dir, keep = 1, retired_grace_seconds = 600)
+        published = []
+
+        for _ in range(3):
+            published.append(self._write_version())
+            version_store.publish(published[-1])
+
+        # Recently retired versions outlive keep, for the web workers still reading them
+        self.assertTrue(all(os.path.exists(version_path) for version_path in published))
+
+        retired = version_store.retired()
+        retired = {version: retired_at - 601 for version, retired_at in retired.items()}
+        with open(os.path.join(self.faiss_dir, IndexVersionStore.RETIRED_FILE), 'w') as retired_file:
+            json.dump(retired, retired_file)
+
+        served = (('version', os.path.basename(published[0])), mock.Mock(), os.path.basename(published[0]))
+        self.addCleanup(SearchResourcesRegistry.clear)
+        SearchResourcesRegistry._vectorstores[self.faiss_dir] = served
+
+        self.assertEqual(version_store.gc(), [os.path.basename(published[1])])
+        self.assertTrue(os.path.exists(published[0]))
+        self.assertNotIn(os.path.basename(published[1]), version_store.retired())
+
+    def test_index_saved_before_versions_is_served_until_first_publish(self):
+        with open(os.path.join(self.faiss_dir, 'index.faiss'), 'wb') as index_file:
+            index_file.write(b'legacy')
+
+        self.assertEqual(self.version_store.current_path(), self.faiss_dir)
+
+        version_path = self.version_store.create_from_current()
+        self.version_store.publish(version_path)
+
+        self.assertEqual(self.version_store.current_path(), version_path)
+        self.assertFalse(os.path.exists(os.path.join(self.faiss_dir, 'index.faiss')))
+
+
+class GreetingClassifierTest(SimpleTestCase):
+    '''Tests for the local greeting classifier that keeps greetings away from the LLM.'''
+
+    def setUp(self):
+        # Question prototypes and greetings point in orthogonal directions
+        self.embedding_model = mock.Mock()
+        self.embedding_model.embed_documents.side_effect = lambda texts: [
+            [0.0, 1.0] if text in GreetingClassifier.QUESTION_PROTOTYPES else [1.0, 0.0] for text in texts
+        ]
+
+    def test_lexicon_greetings_are_answered_without_embedding(self):
+        classifier = GreetingClassifier(self.embedding_model)
+
+        self.assertEqual(classifier.classify('Olááá, bom dia pessoal!'), (GreetingClassifier.GREETING, classifier.answer('pt', 'morning')))
+        self.assertEqual(classifier.classify('hi there')[1], classifier.answer('en', 'hello'))
+        self.assertEqual(classifier.classify('¡Buenas noches!')[1], classifier.answer('es', 'evening'))
+        self.embedding_model.embed_query.assert_not_called()
+
+    def test_questions_are_not_greetings(self):
+        classifier = GreetingClassifier(self.embedding_model)
+
+        self.assertEqual(classifier.classify('Oi, como faço para ordenar uma lista em Python?')[0], GreetingClassifier.OTHER)
+        self.assertEqual(classifier.classify('o que é lambda?')[0], GreetingClassifier.OTHER)
+        self.embedding_model.embed_query.assert_not_called()
+
+    def test_short_messages_are_settled_by_embedding_similarity(self):
+        classifier = GreetingClassifier(self.embedding_model)
+
+        self.embedding_model.embed_query.return_value = [0.95, 0.1]
+        self.assertEqual(classifier.classify('greetz bro')[0], GreetingClassifier.GREETING)
+
+        self.embedding_model.embed_query.return_value = [0.1, 0.95]
+        self.assertEqual(classifier.classify('decorators')[0], GreetingClassifier.OTHER)
+
+        self.embedding_model.embed_query.return_value = [0.6, 0.6]
+        self.assertEqual(classifier.classify('abc')[0], GreetingClassifier.AMBIGUOUS)
+
+        self.assertEqual(self.embedding_model.embed_documents.call_count, 1)
+        self.assertEqual(classifier.decisions['greeting:embedding'], 1)
+
+    def test_only_ambiguous_messages_reach_the_llm(self):
+        SearchResourcesRegistry._greeting_classifier = GreetingClassifier()
+        self.addCleanup(SearchResourcesRegistry.clear)
+        service = object.__new__(GetResponseFromGeminiService)
+
+        with mock.patch.object(SearchResourcesRegistry, 'get_chain') as get_chain:
+            get_chain.return_value.invoke.return_value.content = 'Olá!'
+
+            self.assertEqual(service.classify_greeting('Boa tarde!'), GreetingClassifier().answer('pt', 'afternoon'))
+            self.assertEqual(service.classify_greeting('Como ler um CSV com pandas?'), 'other')
+            get_chain.assert_not_called()
+
+            self.assertEqual(service.classify_greeting('blorp'), 'olá!')
+            get_chain.assert_called_once()
+
+
+class QuestionPipelineTest(TestCase):
+    '''Tests for answering a question while its greeting classification runs.'''
+
+    def setUp(self):
+        SearchResourcesRegistry._greeting_classifier = GreetingClassifier()
+        self.addCleanup(SearchResourcesRegistry.clear)
+
+        self.service = object.__new__(GetResponseFromGeminiService)
+        self.service._model_name = 'gemini-1.5-flash'
+        self.service.embedding_model = DeterministicFakeEmbedding(size = 8)
+        self.service.vectorstore = FAISS.from_embeddings(
+            [('chunk', [0.1] * 8)], self.service.embedding_model, metadatas = [{'parent_index': 1}]
+        )
+        self.service.index_version, self.service.answer_cache = 'v1', None
+
+        def get_chain(prompt_template, model_name, temperature):
+            # Each LLM round trip takes 0.3 s; the classifier answers "other", so the message is a question
+            chain = mock.Mock()
+            content = 'other' if 'classificador de saudações' in prompt_template else 'answer'
+            chain.invoke.side_effect = lambda inputs: time.sleep(0.3) or mock.Mock(content = content)
+
+            return chain
+
+        get_chain_patcher = mock.patch.object(SearchResourcesRegistry, 'get_chain', side_effect = get_chain)
+        self.get_chain = get_chain_patcher.start()
+        self.addCleanup(get_chain_patcher.stop)
+
+    def test_llm_classification_and_answer_overlap(self):
+        started_at = time.perf_counter()
+        answer = self.service.respond('blorp')
+
+        self.assertLess(time.perf_counter() - started_at, 0.55)
+        self.assertEqual(json.loads(answer)[0]['response'], 'answer')
+        self.assertEqual(self.get_chain.call_count, 2)
+
+    def test_locally_settled_messages_skip_the_pool(self):
+        with mock.patch.object(SearchResourcesRegistry, 'get_executor') as get_executor:
+            self.assertEqual(self.service.respond('Olá!'), GreetingClassifier().answer('pt', 'hello'))
+            self.get_chain.assert_not_called()
+
+            answer = self.service.respond('Como ordenar uma lista em Python?')
+
+        get_executor.assert_not_called()
+        self.assertEqual(json.loads(answer)[0]['response'], 'answer')
+        self.assertEqual(self.get_chain.call_count, 1)
+
+    def test_greeting_drops_the_answer(self):
+        cancelled = threading.Event()
+        cancelled.set()
+        self.get_chain.reset_mock()
+
+        self.assertIsNone(self.service._search_and_generate('Olá!', cancelled = cancelled))
+        self.get_chain.assert_not_called()
+
+    def test_question_asked_again_is_answered_from_the_cache(self):
+        self.service.answer_cache = SemanticAnswerCache()
+
+        first = self.service.get_answer('How to sort a list?')
+        self.get_chain.reset_mock()
+
+        self.assertEqual(self.service.respond('How to sort a list?'), first)
+        self.assertEqual([call.args[0] for call in self.get_chain.call_args_list if 'classificador' not in call.args[0]], [])
+        self.assertEqual(self.service.answer_cache.stats()['hits'], 1)
+
+    @override_settings(QUESTION_PIPELINE_CONCURRENT = False)
+    def test_sequential_pipeline(self):
+        started_at = time.perf_counter()
+        answer = self.service.respond('blorp')
+
+        self.assertGreaterEqual(time.perf_counter() - started_at, 0.6)
+        self.assertEqual(json.loads(answer)[0]['response'], 'answer')
+
+
+class SemanticAnswerCacheTest(SimpleTestCase):
+    '''Tests for the in-process answer cache by question embedding.'''
+
+    def test_near_question_hits_and_far_question_misses(self):
+        answer_cache = SemanticAnswerCache(max_distance = 0.05)
+        answer_cache.put([1.0, 0.0, 0.0], 'answer', 'v1')
+
+        self.assertEqual(answer_cache.get([0.99, 0.05, 0.0], 'v1'), 'answer')
+        self.assertIsNone(answer_cache.get([0.7, 0.7, 0.0], 'v1'))
+        self.assertEqual(answer_cache.stats()['hits'], 1)
+        self.assertEqual(answer_cache.stats()['misses'], 1)
+        self.assertEqual(answer_cache.stats()['hit_rate'], 0.5)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        answer_cache = SemanticAnswerCache(max_entries = 2)
+        answer_cache.put([1.0, 0.0, 0.0], 'first', 'v1')
+        answer_cache.put([0.0, 1.0, 0.0], 'second', 'v1')
+        answer_cache.get([1.0, 0.0, 0.0], 'v1')
+        answer_cache.put([0.0, 0.0, 1.0], 'third', 'v1')
+
+        self.assertEqual(answer_cache.get([1.0, 0.0, 0.0], 'v1'), 'first')
+        self.assertIsNone(answer_cache.get([0.0, 1.0, 0.0], 'v1'))
+        self.assertEqual(answer_cache.stats()['evictions'], 1)
+        self.assertEqual(answer_cache.stats()['entries'], 2)
+
+    def test_expired_entry_misses(self):
+        answer_cache = SemanticAnswerCache(ttl = 60)
+        answer_cache.put([1.0, 0.0], 'answer', 'v1')
+
+        with mock.patch('app_model.services.time.time', return_value = time.time() + 61):
+            self.assertIsNone(answer_cache.get([1.0, 0.0], 'v1'))
+
+        self.assertEqual(answer_cache.stats()['expirations'], 1)
+        self.assertEqual(answer_cache.stats()['entries'], 0)
+
+    def test_new_index_version_empties_the_cache(self):
+        answer_cache = SemanticAnswerCache()
+        answer_cache.put([1.0, 0.0], 'answer', 'v1')
+
+        self.assertIsNone(answer_cache.get([1.0, 0.0], 'v2'))
+        self.assertEqual(answer_cache.stats()['invalidations'], 1)
+        self.assertEqual(answer_cache.stats()['index_version'], 'v2')
+
+
+@skipUnless(fakeredis, 'fakeredis is not installed')
+class SharedAnswerCacheTest(SimpleTestCase):
+    '''Tests for the answer cache the web workers share through Redis.'''
+
+    def setUp(self):
+        self.client = fakeredis.FakeRedis()
+        self.answer_cache = SharedAnswerCache(self.client, poll_interval = 0.01)
+        self.computed = []
+
+    def _compute(self, answer: str = 'answer', cacheable: bool = True, seconds: float = 0.0):
+        def compute():
+            self.computed.append(answer)
+            time.sleep(seconds)
+
+            return answer, cacheable
+
+        return compute
+
+    def test_key_folds_case_whitespace_and_punctuation(self):
+        key = self.answer_cache.key('How do I sort a list?', 'v1', 'p1')
+
+        self.assertEqual(self.answer_cache.key('  how do i SORT   a list ', 'v1', 'p1'), key)
+        self.assertNotEqual(self.answer_cache.key('How do I sort a list?', 'v2', 'p1'), key)
+        self.assertNotEqual(self.answer_cache.key('How do I sort a list?', 'v1', 'p2'), key)
+        self.assertNotEqual(self.answer_cache.key('x = [1]', 'v1', 'p1'), self.answer_cache.key('x == [1]', 'v1', 'p1'))
+
+    def test_answer_is_computed_once_and_stored_compressed(self):
+        answer = json.dumps([{'response': 'Use sorted(items). ' * 50, 'references': []}], indent = 2)
+        key = self.answer_cache.key('How do I sort a list?', 'v1', 'p1')
+
+        self.assertEqual(self.answer_cache.get_or_compute(key, self._compute(answer)), answer)
+        self.assertEqual(self.answer_cache.get_or_compute(key, self._compute(answer)), answer)
+
+        self.assertEqual(len(self.computed), 1)
+        self.assertLess(len(self.client.get(key)), len(answer) / 4)
+        self.assertLessEqual(self.client.ttl(key), 24 * 3600)
+        self.assertEqual(self.answer_cache.metrics['hits'], 1)
+
+    def test_uncacheable_answer_is_not_stored(self):
+        key = self.answer_cache.key('Olá!', 'v1', 'p1')
+
+        self.answer_cache.get_or_compute(key, self._compute('Olá!', cacheable = False))
+        self.answer_cache.get_or_compute(key, self._compute('Olá!', cacheable = False))
+
+        self.assertEqual(len(self.computed), 2)
+        self.assertIsNone(self.client.get(key))
+
+    def test_oldest_answers_are_removed_past_the_memory_cap(self):
+        answer_cache = SharedAnswerCache(self.client, max_bytes = 500)
+        keys = [answer_cache.key(f'question {i}', 'v1', 'p1') for i in range(5)]
+
+        for i, key in enumerate(keys):
+            answer_cache.set(key, os.urandom(150).hex())
+            time.sleep(0.001)
+
+        self.assertLessEqual(int(self.client.get('answer_cache:bytes')), 500)
+        self.assertIsNone(self.client.get(keys[0]))
+        self.assertIsNotNone(self.client.get(keys[-1]))
+        self.assertEqual(int(self.client.get('answer_cache:bytes')), sum(len(self.client.get(key) or b'') for key in keys))
+
+    def test_concurrent_sets_keep_the_size_total(self):
+        answer_cache = SharedAnswerCache(self.client, max_bytes = 2000)
+        keys = [answer_cache.key(f'question {i}', 'v1', 'p1') for i in range(4)]
+
+        def store(worker: int):
+            for i in range(30):
+                answer_cache.set(keys[(worker + i) % len(keys)], os.urandom(50 + 20 * worker).hex())
+
+        threads = [threading.Thread(target = store, args = (worker,)) for worker in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        sizes = {key: int(size) for key, size in self.client.hgetall('answer_cache:sizes').items()}
+
+        self.assertEqual(int(self.client.get('answer_cache:bytes')), sum(sizes.values()))
+        self.assertEqual(sizes, {key: len(self.client.get(key)) for key in sizes})
+        self.assertLessEqual(int(self.client.get('answer_cache:bytes')), 2000)
+
+    def test_concurrent_misses_compute_once(self):
+        key = self.answer_cache.key('How do I sort a list?', 'v1', 'p1')
+        answers = []
+
+        threads = [
+            threading.Thread(target = lambda: answers.append(self.answer_cache.get_or_compute(key, self._compute(seconds = 0.2))))
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(answers, ['answer'] * 3)
+        self.assertEqual(len(self.computed), 1)
+        self.assertEqual(self.answer_cache.metrics['waited_hits'], 2)
+
+    def test_unavailable_redis_is_skipped(self):
+        client = mock.Mock()
+        client.get.side_effect = redis.ConnectionError('refused')
+        answer_cache = SharedAnswerCache(client)
+
+        with self.assertLogs('app_model.services', 'WARNING'):
+            self.assertEqual(answer_cache.get_or_compute('key', self._compute()), 'answer')
+
+        self.assertEqual(answer_cache.get_or_compute('key', self._compute()), 'answer')
+        self.assertEqual(client.get.call_count, 1)
+        self.assertEqual(answer_cache.metrics['bypasses'], 1)
+
+    def test_search_answers_are_shared_and_greetings_are_not(self):
+        SearchResourcesRegistry._shared_answer_cache = self.answer_cache
+        self.addCleanup(SearchResourcesRegistry.clear)
+
+        with mock.patch('app_model.tasks.GetResponseFromGeminiService') as service_class, \
+                mock.patch.object(SearchResourcesRegistry, 'get_index_version', return_value = 'v1'):
+            service_class.prompt_version.return_value = 'p1'
+            service_class.return_value.classify_and_answer.side_effect = lambda question: (
+                ('Olá!', True) if question == 'Olá' else ('answer', False)
+            )
+
+            for question in ('How do I sort a list?', 'how do I sort a list', 'Olá', 'Olá'):
+                get_response_from_vector_base(question, '/unused')
+
+        self.assertEqual(service_class.return_value.classify_and_answer.call_count, 3)
+
+
+class FetchDataServiceTest(SimpleTestCase):
+    '''Tests for the cached download and batching of the parquet shards.'''
+
+    def setUp(self):
+        self.mirror_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.shard_dfs = [
+            make_stackexchange_df([1, 2, 3, 1, 4], start = 0),
+            make_stackexchange_df([2, 5, 6, 6, 7], start = 5)
+        ]
+
+        for split_url, shard_df in zip((TRAIN_URL, TEST_URL), self.shard_dfs):
+            split_dir = os.path.join(self.mirror_dir, split_url.split('huggingface.co/')[1])
+            os.makedirs(split_dir)
+            shard_df.to_parquet(os.path.join(split_dir, '0.parquet'))
+
+        self.downloader = ShardDownloadService(self.cache_dir, mirror_dir = self.mirror_dir, offline = True)
+
+    def tearDown(self):
+        shutil.rmtree(self.mirror_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def test_offline_mode_reads_from_mirror(self):
+        listing = self.downloader.get_json(TRAIN_URL)
+
+        self.assertEqual(listing, [f'{TRAIN_URL}/0.parquet'])
+        self.assertTrue(self.downloader.fetch(listing[0]).startswith(self.mirror_dir))
+
+    def test_offline_mode_without_copy_raises(self):
+        downloader = ShardDownloadService(self.cache_dir, offline = True)
+
+        with self.assertRaises(FileNotFoundError):
+            downloader.fetch(f'{TRAIN_URL}/0.parquet')
+
+    def _partial_download(self, downloader: ShardDownloadService, url: str, content: bytes) -> None:
+        os.makedirs(downloader._partial_dir, exist_ok = True)
+
+        with open(os.path.join(downloader._partial_dir, hashlib.sha1(url.encode()).hexdigest() + '.part'), 'wb') as partial_file:
+            partial_file.write(content)
+
+    @staticmethod
+    def _response(status_code: int, content: bytes = b'') -> mock.MagicMock:
+        response = mock.MagicMock(status_code = status_code)
+        response.__enter__.return_value = response
+        response.iter_content.return_value = [content]
+
+        if status_code >= 400:
+            response.raise_for_status.side_effect = requests.HTTPError(str(status_code))
+
+        return response
+
+    def test_manifest_updates_from_several_processes_are_kept(self):
+        first, second = ShardDownloadService(self.cache_dir), ShardDownloadService(self.cache_dir)
+        # Both load the manifest before either writes, as two workers started together do
+        first._get_manifest()
+        second._get_manifest()
+
+        first._update_manifest('files', f'{TRAIN_URL}/1.parquet', {'sha256': 'a', 'size': 1, 'etag': None})
+        second._update_manifest('files', f'{TRAIN_URL}/2.parquet', {'sha256': 'b', 'size': 2, 'etag': None})
+
+        with open(os.path.join(self.cache_dir, 'manifest.json')) as manifest_file:
+            files = json.load(manifest_file)['files']
+
+        self.assertEqual(sorted(files), [f'{TRAIN_URL}/1.parquet', f'{TRAIN_URL}/2.parquet'])
+        self.assertFalse([name for name in os.listdir(self.cache_dir) if name.endswith('.tmp')])
+
+    def test_complete_partial_download_is_stored_without_a_request(self):
+        downloader = ShardDownloadService(self.cache_dir)
+        downloader._session = mock.Mock()
+        url = f'{TRAIN_URL}/1.parquet'
+        self._partial_download(downloader, url, b'whole shard')
+
+        object_path = downloader._download(url, 'etag', len(b'whole shard'))
+
+        downloader.session.get.assert_not_called()
+        with open(object_path, 'rb') as object_file:
+            self.assertEqual(object_file.read(), b'whole shard')
+        self.assertEqual(downloader._cached_path(url), object_path)
+
+    def test_unsatisfiable_range_restarts_the_download(self):
+        downloader = ShardDownloadService(self.cache_dir)
+        downloader._session = mock.Mock()
+        downloader.session.get.side_effect = [self._response(416), self._response(200, b'new shard!')]
+        url = f'{TRAIN_URL}/1.parquet'
+        self._partial_download(downloader, url, b'old')
+
+        object_path = downloader._download(url, 'etag', len(b'new shard!'))
+
+        self.assertEqual(downloader.session.get.call_args_list[0].kwargs['headers']['Range'], 'bytes=3-')
+        with open(object_path, 'rb') as object_file:
+            self.assertEqual(object_file.read(), b'new shard!')
+
+    def test_batches_are_qid_complete_and_bounded(self):
+        fetch_data = FetchDataService(
+            TRAIN_URL, TEST_URL, qids_per_batch = 2, rows_per_partition = 4, record_batch_size = 2, downloader = self.downloader
+        )
+
+        batches = list(fetch_data.iter_qid_batches())
+        streamed_df = pd.concat(batches, ignore_index = True)
+        expected_df = pd.concat(self.shard_dfs, ignore_index = True)
+
+        self.assertEqual(list(streamed_df.columns), FetchDataService.CONSOLIDATION_COLUMNS)
+        self.assertEqual(sorted(streamed_df['response_j']), sorted(expected_df['response_j']))
+        self.assertTrue(all(batch_df['qid'].nunique() <= 2 for batch_df in batches))
+
+        qid_batches = [set(batch_df['qid']) for batch_df in batches]
+        self.assertEqual(sum(len(qids) for qids in qid_batches), expected_df['qid'].nunique())
+
+        first_metadata = streamed_df.loc[streamed_df['qid'] == 6, 'metadata'].iloc[0]
+        self.assertEqual(first_metadata, 'https://stackoverflow.com/questions/6')
+
+    def test_batch_plan_slices_match_qid_batches(self):
+        fetch_data = FetchDataService(TRAIN_URL, TEST_URL, qids_per_batch = 3, downloader = self.downloader)
+        expected_df = pd.concat(self.shard_dfs, ignore_index = True)
+
+        qid_batches = fetch_data.get_qid_batches()
+        batch_plan = fetch_data.get_batch_plan()
+
+        self.assertEqual(qid_batches, [[1, 2, 3], [4, 5, 6], [7]])
+        self.assertEqual(len(batch_plan), len(qid_batches))
+
+        for qid_batch, row_range in zip(qid_batches, batch_plan):
+            expected_batch = expected_df[expected_df['qid'].isin(qid_batch)]
+            batch_df = fetch_data.fetch_batch(row_range)
+
+            self.assertEqual(sorted(batch_df['response_j']), sorted(expected_batch['response_j']))
+            self.assertEqual(list(fetch_data.fetch_data_by_qids(qid_batch)['response_j']), list(batch_df['response_j']))
+
+        self.assertEqual(list(fetch_data.fetch_data_by_qids([6, 1])['qid']), [1, 1, 6, 6])
+
+
+class ParallelConsolidationServiceTest(TestCase):
+    '''Tests for the process pool consolidation of qid batches.'''
+
+    def setUp(self):
+        self.batch_dfs = [make_python_answers_df(5), make_python_answers_df(3, 6), make_python_answers_df(4, 9)]
+
+    def _saved_documents(self) -> list:
+        return list(Document.objects.order_by('id').values_list('parent_index', 'qid', 'consolidated_answers'))
+
+    def test_parallel_matches_sequential_in_batch_order(self):
+        sequential = ParallelConsolidationService(workers = 1)
+        sequential_counts = list(sequential.consolidate_batches(iter(self.batch_dfs)))
+        sequential_documents = self._saved_documents()
+
+        Document.objects.all().delete()
+
+        parallel = ParallelConsolidationService(workers = 2, batches_per_child = 1)
+        parallel_counts = list(parallel.consolidate_batches(iter(self.batch_dfs)))
+
+        self.assertEqual(sequential_counts, [(0, 5), (1, 3), (2, 4)])
+        self.assertEqual(parallel_counts, sequential_counts)
+        self.assertEqual(self._saved_documents(), sequential_documents)
+
+    def test_worker_count_respects_memory_budget(self):
+        service = ParallelConsolidationService(workers = 64, worker_memory_mb = 10 ** 9)
+
+        self.assertEqual(service.get_worker_count(), 1)
+
+
+class LanguageSignalClassifierTest(SimpleTestCase):
+    '''Tests that the single-pass classifier matches the previous three-pass implementation.'''
+
+    WORDS = [
+        'python', 'Pandas', 'NUMPY', 'django', 'flask', 'def', 'class', 'import', 'self', 'my_class', 'selfish', 'def()',
+        'php', 'objective-c', 'Java', 'c#', 'swift', 'javascript', '```', '```python', 'pandaswift', 'phpython',
+        'djangobjective-c', 'objective-class', 'pythonumpy', 'the', 'data', 'frame', 'print(x)', '\n', '-', 'i',
+    ]
+
+    def _random_text(self, generator: random.Random, total_words: int) -> str:
+        return ' '.join(generator.choice(self.WORDS) for _ in range(total_words))
+
+    def test_matches_reference_implementation(self):
+        generator = random.Random(42)
+        consolidated_df = pd.DataFrame({
+            'question': [self._random_text(generator, 8) for _ in range(2000)],
+            'consolidated_answers': [self._random_text(generator, 40) for _ in range(2000)],
+        })
+        flag_columns = ['python_signal_count', 'is_other_lang', 'has_code_block']
+
+        expected_df = reference_classify_relevant_sentences(consolidated_df)
+        classified_df = DataConsolidationService(consolidated_df)._classify_relevant_sentences(consolidated_df)
+
+        pd.testing.assert_frame_equal(classified_df[flag_columns], expected_df[flag_columns], check_dtype = False)
+
+    def test_overlapping_keywords(self):
+        consolidated_df = pd.DataFrame({
+            'question': ['Use pandaswift', 'phpython?', 'pythonumpy'],
+            'consolidated_answers': ['```def f(self)```', 'import os', 'class A: pass'],
+        })
+
+        classified_df = DataConsolidationService(consolidated_df)._classify_relevant_sentences(consolidated_df)
+
+        self.assertEqual(list(classified_df['python_signal_count']), [3, 2, 2])
+        self.assertEqual(list(classified_df['is_other_lang']), [True, True, False])
+        self.assertEqual(list(classified_df['has_code_block']), [True, False, False])
+
+
+class GroupQuestionAnswerTest(SimpleTestCase):
+    '''Tests that the columnar grouping matches the previous groupby with a Python join per qid.'''
+
+    def test_matches_reference_implementation(self):
+        batch_df = pd.DataFrame({
+            'qid': [3, 1, 3, 2, 1, 3, 2, 4],
+            'question': [None, 'q1', 'q3', 'q2', 'q1 again', 'q3 again', None, 'q4'],
+            'metadata': ['m3', None, 'm3b', 'm2', 'm1', 'm3c', 'm2b', 'm4'],
+            'response_j': ['a', 'b', 'a', None, 'c', 'd', None, 'e'],
+            'response_k': ['x', 'y', 'z', 'w', 'y', 'x', 'w', None],
+        })
+
+        expected_df = reference_group_question_answer(batch_df)
+        consolidated_df = DataConsolidationService(batch_df)._group_question_answer()
+
+        pd.testing.assert_frame_equal(consolidated_df, expected_df)
+        self.assertEqual(consolidated_df.loc[consolidated_df['qid'] == 2, 'consolidated_answers'].iloc[0], '\n\n---\n\nw')
+
+
+class DocumentBulkLoaderTest(TestCase):
+    '''Tests for the COPY and bulk_create document loading paths.'''
+
+    def setUp(self):
+        self.documents_df = pd.DataFrame({
+            'parent_index': [0, 1, 2],
+            'qid': [10, 11, 12],
+            'question': ['How to "quote"?', '', 'multi\nline, with comma'],
+            'metadata': ['https://stackoverflow.com/questions/10', 'm11', 'm12'],
+            'consolidated_answers': ['```python\nprint(1)\n```', 'a', 'b'],
+            'content_hash': ['h10', 'h11', 'h12'],
+        })
+
+    def test_bulk_create_fallback_saves_every_row(self):
+        loader = DocumentBulkLoader(chunk_rows = 2)
+
+        self.assertEqual(loader.load(self.documents_df), 3)
+        self.assertEqual(
+            list(Document.objects.order_by('parent_index').values_list('question', flat = True)),
+            list(self.documents_df['question'])
+        )
+        self.assertGreater(loader.rows_per_second, 0)
+
+    def test_copy_chunks_write_csv_rows(self):
+        copied = []
+
+        class FakeCursor:
+            cursor = type('RawCursor', (), {'copy_expert': None})()
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                return False
+
+            def copy_expert(self, sql, buffer):
+                copied.append((sql, buffer.read()))
+
+        class FakeConnection:
+            ops = type('Ops', (), {'quote_name': staticmethod(lambda name: f'"{name}"')})()
+
+            def cursor(self):
+                return FakeCursor()
+
+        DocumentBulkLoader(chunk_rows = 2)._copy_chunks(self.documents_df, FakeConnection())
+
+        self.assertEqual(len(copied), 2)
+        self.assertTrue(copied[0][0].startswith('COPY "app_model_document" ("parent_index", "qid", "question"'))
+
+        rows = list(csv.reader(io.StringIO(''.join(data for _, data in copied))))
+
+        self.assertEqual([row[2] for row in rows], list(self.documents_df['question']))
+        self.assertIn('""', copied[0][1])
+
+
+class TrainingCheckpointTest(TestCase):
+    '''Tests for resuming an interrupted training run from its checkpoint.'''
+
+    def setUp(self):
+        self.build_root = tempfile.mkdtemp()
+        self.work_dir = os.path.join(self.build_root, 'faiss_index_work')
+
+    def tearDown(self):
+        shutil.rmtree(self.build_root)
+
+    def _start_task(self, task_id: str) -> TrainingCheckpoint:
+        TaskStatus.objects.create(task_id = task_id, status = states.PENDING)
+
+        return TrainingCheckpoint.resume(task_id)
+
+    def _stop_task(self, task_id: str) -> None:
+        '''Age the heartbeat of task_id past the timeout, as if its worker had died.'''
+
+        stopped_at = timezone.now() - timedelta(seconds = settings.TRAINING_HEARTBEAT_TIMEOUT + 1)
+        TaskStatus.objects.filter(task_id = task_id).update(updated_at = stopped_at)
+
+    def test_consolidation_resumes_after_saved_batches(self):
+        batch_dfs = [make_python_answers_df(5), make_python_answers_df(3, 6), make_python_answers_df(4, 9)]
+
+        checkpoint = self._start_task('first')
+        checkpoint.start('fingerprint', self.work_dir)
+
+        first_run = ParallelConsolidationService(on_batch_saved = checkpoint.mark_batch_saved)
+        self.assertEqual(next(first_run.consolidate_batches(iter(batch_dfs))), (0, 5))
+
+        self._stop_task('first')
+        checkpoint = self._start_task('second')
+
+        self.assertTrue(checkpoint.matches('fingerprint'))
+        self.assertEqual(checkpoint.completed_batches, {0})
+
+        second_run = ParallelConsolidationService(on_batch_saved = checkpoint.mark_batch_saved)
+        resumed = list(second_run.consolidate_batches(iter(batch_dfs), skip_batches = checkpoint.completed_batches))
+
+        self.assertEqual(resumed, [(1, 3), (2, 4)])
+        self.assertEqual(Document.objects.count(), 12)
+        self.assertEqual(TrainingCheckpoint.resume('second').documents_saved, 12)
+        self.assertEqual(sorted(checkpoint.consolidated_qids()), list(range(1, 13)))
+
+        first_status = TaskStatus.objects.get(task_id = 'first')
+        self.assertEqual(first_status.status, states.FAILURE)
+        self.assertIsNone(first_status.checkpoint)
+
+    def test_live_run_is_not_taken_over(self):
+        checkpoint = self._start_task('first')
+        checkpoint.start('fingerprint', self.work_dir)
+
+        with self.assertRaises(TrainingInProgressError) as raised:
+            self._start_task('second')
+
+        self.assertEqual(raised.exception.task_id, 'first')
+
+        first_status = TaskStatus.objects.get(task_id = 'first')
+        self.assertEqual(first_status.status, states.PENDING)
+        self.assertEqual(first_status.checkpoint['fingerprint'], 'fingerprint')
+        self.assertTrue(os.path.isdir(self.work_dir))
+
+        self._stop_task('first')
+
+        self.assertTrue(TrainingCheckpoint.resume('second').matches('fingerprint'))
+        self.assertEqual(TaskStatus.objects.get(task_id = 'first').status, states.FAILURE)
+
+    def test_heartbeat_refreshes_a_pending_run(self):
+        TaskStatus.objects.create(task_id = 'first', status = states.PENDING)
+        self._stop_task('first')
+        TrainingHeartbeat('first').beat()
+
+        self.assertTrue(TrainingCheckpoint.live_runs().filter(task_id = 'first').exists())
+
+        TaskStatus.objects.filter(task_id = 'first').update(status = states.FAILURE)
+        self._stop_task('first')
+        TrainingHeartbeat('first').beat()
+
+        self.assertFalse(TaskStatus.objects.filter(task_id = 'first', updated_at__gt = timezone.now() - timedelta(seconds = 60)).exists())
+
+    def test_heartbeat_beats_in_the_background_until_stopped(self):
+        with mock.patch.object(TrainingHeartbeat, 'beat') as beat:
+            heartbeat = TrainingHeartbeat('first', interval = 0.01).start()
+            time.sleep(0.1)
+            heartbeat.stop()
+            beats = beat.call_count
+            time.sleep(0.05)
+
+        self.assertGreater(beats, 1)
+        self.assertEqual(beat.call_count, beats)
+
+    def test_failed_run_is_taken_over_at_once(self):
+        checkpoint = self._start_task('first')
+        checkpoint.start('fingerprint', self.work_dir)
+        TaskStatus.objects.filter(task_id = 'first').update(status = states.FAILURE)
+
+        self.assertTrue(self._start_task('second').matches('fingerprint'))
+
+    @mock.patch('app_model.services.HuggingFaceEmbeddings', lambda **kwargs: FakeEmbeddings(size = 8))
+    def test_embedding_resumes_from_saved_shards(self):
+        DataConsolidationService.persist_documents(DataConsolidationService(make_python_answers_df(5)).consolidate())
+        faiss_dir = os.path.join(self.build_root, 'faiss_index')
+
+        checkpoint = self._start_task('first')
+        checkpoint.start('fingerprint', self.work_dir)
+        checkpoint.start_embedding()
+
+        service = CreateFaissTreeService(documents_batch_size = 2)
+
+        with mock.patch.object(service, '_merge_shards', side_effect = RuntimeError('worker lost')):
+            with self.assertRaises(RuntimeError):
+                service.create_faiss_index(faiss_save_path = faiss_dir, checkpoint = checkpoint)
+
+        self.assertEqual(len(checkpoint.shards), 3)
+
+        # Forget the last shard, as if the run had stopped before saving it
+        checkpoint.state['shards'] = checkpoint.state['shards'][:2]
+        checkpoint._save()
+
+        checkpoint = TrainingCheckpoint.resume('first')
+
+        with mock.patch.object(service, '_create_chunks_batch', wraps = service._create_chunks_batch) as create_chunks:
+            service.create_faiss_index(faiss_save_path = faiss_dir, checkpoint = checkpoint)
+
+        self.assertEqual(create_chunks.call_count, 1)
+        self.assertEqual(len(create_chunks.call_args.args[0]), 1)
+
+        vectorstore = FAISS.load_local(faiss_dir, FakeEmbeddings(size = 8), allow_dangerous_deserialization = True)
+        parent_indexes = sorted(document.metadata['parent_index'] for document in vectorstore.docstore._dict.values())
+
+        self.assertEqual(parent_indexes, [1, 2, 3, 4, 5])
+        self.assertEqual(service.mark_indexed(), 5)
+
+        checkpoint.finish()
+
+        self.assertFalse(os.path.exists(self.work_dir))
+        self.assertIsNone(TaskStatus.objects.get(task_id = 'first').checkpoint)
+
+
+class SendDatabaseAndTrainModelTest(TestCase):
+    '''Tests for starting a training run from the API.'''
+
+    def _post(self):
+        request = APIRequestFactory().post('/train/model/')
+        force_authenticate(request, user = mock.Mock(is_authenticated = True))
+
+        return SendDatabaseAndTrainModel.as_view()(request)
+
+    @mock.patch('app_model.views.set_database_and_train_data')
+    def test_second_request_returns_the_running_task(self, train_task):
+        train_task.apply_async.side_effect = lambda args, task_id: mock.Mock(id = task_id)
+
+        first_response = self._post()
+        second_response = self._post()
+
+        self.assertEqual(first_response.status_code, 201)
+        self.assertEqual(second_response.status_code, 409)
+        self.assertEqual(second_response.data['task_id'], first_response.data['task_id'])
+        self.assertEqual(train_task.apply_async.call_count, 1)
+
+    @mock.patch('app_model.views.set_database_and_train_data')
+    def test_dead_run_does_not_block_a_new_one(self, train_task):
+        train_task.apply_async.side_effect = lambda args, task_id: mock.Mock(id = task_id)
+        stopped_at = timezone.now() - timedelta(seconds = settings.TRAINING_HEARTBEAT_TIMEOUT + 1)
+        TaskStatus.objects.create(task_id = 'dead', status = states.PENDING)
+        TaskStatus.objects.filter(task_id = 'dead').update(updated_at = stopped_at)
+
+        self.assertEqual(self._post().status_code, 201)
+
+
+class DeltaIngestionTest(TestCase):
+    '''Tests for saving only new or changed documents and deleting the ones gone from the dataset.'''
+
+    def _consolidate(self, batch_df: pd.DataFrame) -> pd.DataFrame:
+        return DataConsolidationService(batch_df).consolidate()
+
+    def test_upsert_writes_only_new_or_changed_documents(self):
+        loader = DocumentBulkLoader()
+        first_df = self._consolidate(make_python_answers_df(4))
+
+        self.assertEqual(loader.upsert(first_df), 4)
+        Document.objects.update(is_indexed = True)
+        unchanged_ids = dict(Document.objects.values_list('qid', 'id'))
+
+        second_batch = make_python_answers_df(5)
+        second_batch.loc[second_batch['qid'] == 2, 'response_k'] = 'Use numpy differently'
+
+        self.assertEqual(loader.upsert(self._consolidate(second_batch)), 2)
+
+        pending = dict(Document.objects.filter(is_indexed = False).values_list('qid', 'consolidated_answers'))
+
+        self.assertEqual(sorted(pending), [2, 5])
+        self.assertIn('Use numpy differently', pending[2])
+        self.assertEqual(Document.objects.count(), 5)
+        self.assertEqual(Document.objects.get(qid = 3).id, unchanged_ids[3])
+        self.assertEqual(list(Document.objects.filter(qid = 4).values_list('parent_index', flat = True)), [4])
+
+    def test_delete_missing_removes_vanished_qids(self):
+        loader = DocumentBulkLoader()
+        loader.upsert(self._consolidate(make_python_answers_df(5)))
+
+        removed_qids = loader.delete_missing(np.array([1, 3, 5]))
+
+        self.assertEqual(list(removed_qids), [2, 4])
+        self.assertEqual(sorted(Document.objects.values_list('qid', flat = True)), [1, 3, 5])
+
+
+class CreateFaissTreeServiceTest(TestCase):
+    '''Tests for reading the documents and building the index.'''
+
+    def setUp(self):
+        DocumentBulkLoader().upsert(DataConsolidationService(make_python_answers_df(7)).consolidate())
+
+    def test_document_batches_use_keyset_pagination(self):
+        service = CreateFaissTreeService(documents_batch_size = 3)
+
+        with CaptureQueriesContext(connection) as queries:
+            batches = list(service.iter_document_batches())
+
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 1])
+        self.assertEqual(list(pd.concat(batches)['parent_index']), list(range(1, 8)))
+        self.assertEqual(list(batches[0].columns), CreateFaissTreeService.DOCUMENT_COLUMNS)
+        self.assertFalse(any('OFFSET' in query['sql'] for query in queries.captured_queries))
+
+        after_id = int(batches[0]['id'].iloc[-1])
+
+        self.assertEqual(sum(len(batch) for batch in service.iter_document_batches(after_id)), 4)
+
+    @mock.patch('app_model.services.HuggingFaceEmbeddings', lambda **kwargs: FakeEmbeddings(size = 8))
+    def test_pipeline_indexes_every_document_with_chunk_workers(self):
+        faiss_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, faiss_dir)
+
+        service = CreateFaissTreeService(documents_batch_size = 2, chunk_workers = 2, queue_size = 1)
+        service.create_faiss_index(faiss_save_path = faiss_dir)
+
+        vectorstore = FAISS.load_local(faiss_dir, FakeEmbeddings(size = 8), allow_dangerous_deserialization = True)
+        parent_indexes = sorted(document.metadata['parent_index'] for document in vectorstore.docstore._dict.values())
+
+        self.assertEqual(parent_indexes, list(range(1, 8)))
+        self.assertEqual(list(service.stats.throughput()), ['leitura', 'limpeza', 'embeddings', 'índice'])
+
+    def test_embedding_matrix_matches_stacked_batches(self):
+        embedding_model = DeterministicFakeEmbedding(size = 8)
+        texts = ['a much longer chunk of text', 'short', 'mid sized chunk', 'x', 'another long chunk here', 'tiny', 'last']
+        chunks_df = pd.DataFrame({
+            'cleaned_text_chunk': texts,
+            'raw_text_chunk': [f'raw {text}' for text in texts],
+            'parent_index': range(len(texts)),
+            'metadata': [f'link {i}' for i in range(len(texts))]
+        })
+
+        # The previous path embedded the chunks in order, 3 at a time, and stacked the batches
+        stacked = np.vstack([
+            np.array(embedding_model.embed_documents(texts[i:i + 3]), dtype = np.float32) for i in range(0, len(texts), 3)
+        ])
+
+        embeddings, chunk_columns = CreateFaissTreeService()._process_embeddings_batch(chunks_df, embedding_model, batch_size = 3)
+        vectorstore = CreateFaissTreeService._add_embeddings(None, embedding_model, embeddings, chunk_columns)
+        indexed = faiss.downcast_index(vectorstore.index.index).reconstruct_n(0, vectorstore.index.ntotal)
+
+        self.assertEqual(embeddings.dtype, np.float32)
+        np.testing.assert_array_equal(embeddings, stacked)
+        np.testing.assert_array_equal(indexed, stacked)
+        self.assertEqual(
+            [vectorstore.docstore.search(vectorstore.index_to_docstore_id[row]).page_content for row in range(len(texts))],
+            list(chunks_df['raw_text_chunk'])
+        )
+
+    @mock.patch('app_model.services.HuggingFaceEmbeddings', lambda **kwargs: FakeEmbeddings(size = 8))
+    def test_documents_written_during_the_build_stay_pending(self):
+        faiss_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, faiss_dir)
+
+        service = CreateFaissTreeService(documents_batch_size = 3)
+        service.create_faiss_index(faiss_save_path = faiss_dir)
+
+        self.assertEqual(Document.objects.filter(is_indexed = False).count(), 7)
+
+        DocumentBulkLoader().upsert(DataConsolidationService(make_python_answers_df(2, 8)).consolidate())
+
+        self.assertEqual(service.mark_indexed(), 7)
+        self.assertEqual(sorted(Document.objects.filter(is_indexed = False).values_list('qid', flat = True)), [8, 9])
+
+    @mock.patch('app_model.services.HuggingFaceEmbeddings', lambda **kwargs: FakeEmbeddings(size = 8))
+    def test_pipeline_raises_embedding_errors(self):
+        service = CreateFaissTreeService(documents_batch_size = 2)
+
+        with mock.patch.object(service, '_process_embeddings_batch', side_effect = RuntimeError('out of memory')):
+            with self.assertRaisesMessage(RuntimeError, 'out of memory'):
+                service.create_faiss_index(faiss_save_path = os.path.join(tempfile.gettempdir(), 'unused_faiss_index'))
+
+
+class TextCleanerTest(SimpleTestCase):
+    '''Tests for the chunk text cleaner and the chunks of a document cleaned once.'''
+
+    TEXTS = [
+        'How?\n\n```python\nprint(`x`)\n```\nsee [the docs](http://docs.python.org) and  www.python.org  ok',
+        '<p>Use &amp; and &lt;b&gt;</p>\n<pre><code>for i in x:\n    a &lt; b\n</code></pre>',
+        'if a < b and c>d: pass',
+        '  \t lead\u00a0and trail  ',
+        'a &amp; b',
+        'x &gt; y',
+        'if a &gt; b: pass',
+        '&nbsp;x &copy; 2024 R&D',
+        '',
+    ]
+
+    def test_clean_matches_previous_cleaner(self):
+        cleaner = TextCleaner()
+
+        for text in self.TEXTS:
+            cleaned_text, offsets = cleaner.clean_with_offsets(text)
+
+            self.assertEqual(cleaner.clean(text), reference_clean_text(text))
+            self.assertEqual(cleaned_text, reference_clean_text(text))
+            self.assertEqual(len(offsets), len(cleaned_text))
+
+    def test_text_without_tags_skips_the_parser(self):
+        with mock.patch('app_model.services.BeautifulSoup') as parser:
+            TextCleaner().clean_with_offsets(self.TEXTS[0])
+
+        parser.assert_not_called()
+
+    def test_entities_are_decoded_and_map_to_their_ampersand(self):
+        cleaned_text, offsets = TextCleaner().clean_with_offsets('if a &gt; b: pass')
+
+        self.assertEqual(cleaned_text, 'if a > b: pass')
+        self.assertEqual(list(offsets[:6]), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(list(offsets[6:]), list(range(9, 17)))
+
+    def test_chunks_map_back_to_raw_text(self):
+        service = CreateFaissTreeService()
+        text = '<p>' + ' '.join(f'word&amp;{i}\n' for i in range(900)) + '</p>'
+        chunks = service._chunk_document(text, service._text_splitter())
+
+        self.assertGreater(len(chunks), 1)
+
+        for raw_chunk, cleaned_chunk in chunks:
+            self.assertLessEqual(len(cleaned_chunk), CreateFaissTreeService.CHUNK_SIZE)
+            self.assertIn(raw_chunk, text)
+            self.assertEqual(TextCleaner().clean(raw_chunk), cleaned_chunk)
+
+        self.assertTrue(chunks[0][0].startswith('word&amp;0'))
+        self.assertTrue(chunks[-1][0].endswith('word&amp;899'))
+
+
+class ShardedIndexBuildTest(TestCase):
+    '''Tests for building the index as a chord of shard tasks and a merge task.'''
+
+    def setUp(self):
+        DocumentBulkLoader().upsert(DataConsolidationService(make_python_answers_df(7)).consolidate())
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.faiss_dir = os.path.join(self.temp_dir, 'faiss_index')
+
+        TaskStatus.objects.create(task_id = 'parent', status = states.PENDING)
+        checkpoint = TrainingCheckpoint('parent')
+        checkpoint.start('fingerprint', os.path.join(self.temp_dir, 'work'))
+        checkpoint.start_embedding()
+        checkpoint.plan_index_shards(CreateFaissTreeService.plan_id_ranges(3))
+
+        embeddings_patcher = mock.patch('app_model.services.HuggingFaceEmbeddings', lambda **kwargs: FakeEmbeddings(size = 8))
+        embeddings_patcher.start()
+        self.addCleanup(embeddings_patcher.stop)
+
+        settings_override = override_settings(
+            EMBEDDING_CACHE_DIR = os.path.join(self.temp_dir, 'cache'), INDEXING_CHUNK_WORKERS = 0
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        always_eager = celery_app.conf.task_always_eager
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', always_eager)
+
+    def _run_chord(self):
+        return chord(build_index_shard.s('parent', shard) for shard in range(3))(merge_index_shards.s('parent', self.faiss_dir))
+
+    def test_id_ranges_split_the_documents(self):
+        id_ranges = CreateFaissTreeService.plan_id_ranges(3)
+        ids = list(Document.objects.order_by('id').values_list('id', flat = True))
+
+        self.assertEqual(id_ranges[0][0], 0)
+        self.assertEqual(id_ranges[-1][1], ids[-1])
+        self.assertEqual([sum(after_id < id_ <= up_to_id for id_ in ids) for after_id, up_to_id in id_ranges], [2, 2, 3])
+
+    def test_chord_merges_every_shard(self):
+        self._run_chord()
+
+        version_store = IndexVersionStore(self.faiss_dir)
+        vectorstore = FAISS.load_local(version_store.current_path(), FakeEmbeddings(size = 8), allow_dangerous_deserialization = True)
+        parent_indexes = sorted(document.metadata['parent_index'] for document in vectorstore.docstore._dict.values())
+        task_status = TaskStatus.objects.get(task_id = 'parent')
+
+        self.assertEqual(parent_indexes, list(range(1, 8)))
+        self.assertEqual(task_status.status, states.SUCCESS)
+        self.assertIn('3 partes', task_status.result)
+        self.assertIn(version_store.current(), task_status.result)
+        self.assertIsNone(task_status.checkpoint)
+        self.assertFalse(Document.objects.filter(is_indexed = False).exists())
+
+    def test_failed_shard_is_retried_alone(self):
+        create_index_shard = CreateFaissTreeService.create_index_shard
+        calls = []
+
+        def flaky_create_index_shard(indexer, shard_path, *args, **kwargs):
+            calls.append(os.path.basename(shard_path))
+
+            if calls.count('range_00001') == 1 and shard_path.endswith('range_00001'):
+                raise RuntimeError('worker lost')
+
+            return create_index_shard(indexer, shard_path, *args, **kwargs)
+
+        with mock.patch.object(CreateFaissTreeService, 'create_index_shard', flaky_create_index_shard):
+            self._run_chord()
+
+        self.assertEqual(sorted(calls), ['range_00000', 'range_00001', 'range_00001', 'range_00002'])
+        self.assertEqual(TaskStatus.objects.get(task_id = 'parent').status, states.SUCCESS)
+
+
+class EmbeddingCacheTest(SimpleTestCase):
+    '''Tests for the on-disk cache of chunk embeddings.'''
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.embedding_model = mock.Mock(wraps = FakeEmbeddings(size = 4))
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_only_missing_texts_are_embedded(self):
+        embedding_cache = EmbeddingCache(self.cache_dir, 'fake/model')
+        first = embedding_cache.embed(['a', 'b', 'a'], self.embedding_model)
+        embedding_cache.close()
+
+        self.assertEqual(self.embedding_model.embed_documents.call_args.args[0], ['a', 'b'])
+        self.assertTrue((first[0] == first[2]).all())
+
+        embedding_cache = EmbeddingCache(self.cache_dir, 'fake/model')
+        second = embedding_cache.embed(['b', 'c', 'a'], self.embedding_model)
+
+        self.assertEqual(self.embedding_model.embed_documents.call_args.args[0], ['c'])
+        self.assertTrue((second[0] == first[1]).all())
+        self.assertTrue((second[2] == first[0]).all())
+        self.assertAlmostEqual(embedding_cache.hit_rate, 2 / 3)
+
+        with self.assertRaises(RuntimeError):
+            EmbeddingCache(self.cache_dir, 'fake/model')
+
+        embedding_cache.close()
+
+    def test_compact_keeps_recently_used_rows(self):
+        embedding_cache = EmbeddingCache(self.cache_dir, 'fake/model')
+        vectors = embedding_cache.embed(['old', 'kept'], self.embedding_model)
+        embedding_cache.close()
+
+        embedding_cache = EmbeddingCache(self.cache_dir, 'fake/model')
+        embedding_cache.embed(['kept', 'new'], self.embedding_model)
+
+        row_bytes = 4 * 4 + 8 + 4
+        self.assertEqual(embedding_cache.compact(2 * row_bytes), 1)
+        embedding_cache.close()
+
+        embedding_cache = EmbeddingCache(self.cache_dir, 'fake/model')
+
+        self.assertEqual(embedding_cache.rows, 2)
+        self.assertEqual(list(embedding_cache.lookup(EmbeddingCache.text_keys(['old', 'kept', 'new'])) >= 0), [False, True, True])
+        self.assertTrue((embedding_cache.embed(['kept'], self.embedding_model)[0] == vectors[1]).all())
+
+        embedding_cache.close()
+
+
+class EmbeddingBackendTest(SimpleTestCase):
+    '''Tests for the ONNX Runtime embedding backend against the torch one.'''
+
+    TEXTS = ['how to use pandas', 'a', 'merge two dataframes on a column ' * 4, 'numpy', 'sort a list of tuples by the second item']
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.model_dir = tempfile.mkdtemp()
+        cls.onnx_dir = tempfile.mkdtemp()
+        make_sentence_transformer(cls.model_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.model_dir)
+        shutil.rmtree(cls.onnx_dir)
+        super().tearDownClass()
+
+    def _embed(self, embedding_model, texts: list[str]) -> np.ndarray:
+        embeddings = np.asarray(embedding_model.embed_documents(texts), dtype = np.float32)
+
+        return embeddings / np.linalg.norm(embeddings, axis = 1, keepdims = True)
+
+    def test_onnx_embeddings_agree_with_torch(self):
+        torch_embeddings = self._embed(EmbeddingBackend(EmbeddingBackend.TORCH, self.model_dir).load(device = 'cpu'), self.TEXTS)
+
+        onnx_backend = EmbeddingBackend(EmbeddingBackend.ONNX, self.model_dir, self.onnx_dir, batch_size = 2)
+        int8_backend = EmbeddingBackend(EmbeddingBackend.ONNX, self.model_dir, self.onnx_dir, quantized = True)
+
+        onnx_cosine = (self._embed(onnx_backend.load(), self.TEXTS) * torch_embeddings).sum(axis = 1)
+        int8_cosine = (self._embed(int8_backend.load(), self.TEXTS) * torch_embeddings).sum(axis = 1)
+
+        self.assertGreater(onnx_cosine.min(), 0.9999)
+        self.assertGreater(int8_cosine.min(), 0.95)
+        self.assertEqual(onnx_backend.cache_name, self.model_dir)
+        self.assertNotEqual(int8_backend.cache_name, self.model_dir)
+
+    def test_length_buckets_do_not_change_embeddings(self):
+        embedding_model = EmbeddingBackend(
+            EmbeddingBackend.ONNX, self.model_dir, self.onnx_dir, batch_size = 2, max_batch_tokens = 40
+        ).load()
+
+        together = np.asarray(embedding_model.embed_documents(self.TEXTS))
+        alone = np.asarray([embedding_model.embed_query(text) for text in self.TEXTS])
+        lengths = np.array([3, 1, 40, 2, 20])
+
+        self.assertTrue(np.allclose(together, alone, atol = 1e-5))
+
+        for rows in embedding_model._batches(lengths):
+            self.assertLessEqual(len(rows), 2)
+            self.assertTrue(len(rows) == 1 or len(rows) * lengths[rows].max() <= 40)
+
+        self.assertEqual(sorted(np.concatenate(list(embedding_model._batches(lengths)))), list(range(5)))
+
+    def test_indexing_batches_keep_chunk_order(self):
+        texts = ['ccc', 'a', 'bbbbb', 'dd']
+        chunks_df = pd.DataFrame({'cleaned_text_chunk': texts, 'raw_text_chunk': texts, 'parent_index': 1, 'metadata': ''})
+        embedding_model = mock.Mock()
+        embedding_model.embed_documents.side_effect = lambda batch: [[len(text), 0.0] for text in batch]
+
+        embeddings, _ = CreateFaissTreeService()._process_embeddings_batch(chunks_df, embedding_model, batch_size = 2)
+
+        self.assertEqual(embedding_model.embed_documents.call_args_list[0].args[0], ['a', 'dd'])
+        self.assertEqual(list(embeddings[:, 0]), [3, 1, 5, 2])
+
+
+class FaissIndexBuilderTest(SimpleTestCase):
+    '''Tests for converting the exact index to an approximate index type.'''
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size = (20, 16))
+        self.vectors = (centers[rng.integers(0, 20, 2000)] + rng.normal(scale = 0.1, size = (2000, 16))).astype(np.float32)
+
+        self.flat_index = faiss.IndexFlatL2(16)
+        self.flat_index.add(self.vectors)
+
+    def test_presets_keep_vector_order_and_report_recall(self):
+        for spec in ('ivf-flat', 'hnsw', 'sq8'):
+            index, params = FaissIndexBuilder(spec = spec, report_queries = 50, k = 5).build(self.flat_index)
+
+            self.assertEqual(index.ntotal, 2000)
+            self.assertEqual(index.search(self.vectors[7:8], 1)[1][0][0], 7)
+            self.assertGreater(params['report']['recall_at_k'], 0.8)
+            self.assertEqual(params['report']['queries'], 50)
+
+    def test_factory_strings_are_sized_to_the_corpus(self):
+        self.assertEqual(FaissIndexBuilder(spec = 'ivf-pq').factory_string(384, 1000000), 'IVF4000,PQ48')
+        self.assertEqual(FaissIndexBuilder(spec = 'ivf-flat').factory_string(16, 100), 'IVF2,Flat')
+        self.assertEqual(FaissIndexBuilder(spec = 'OPQ8,IVF64,PQ8').factory_string(64, 10000), 'OPQ8,IVF64,PQ8')
+        self.assertTrue(FaissIndexBuilder(spec = 'flat').is_exact)
+
+    def test_search_parameters_are_applied_on_load(self):
+        faiss_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, faiss_dir)
+
+        index, params = FaissIndexBuilder(spec = 'ivf-flat', nprobe = 3, report_queries = 10).build(self.flat_index)
+        vectorstore = FAISS(FakeEmbeddings(size = 16), index, InMemoryDocstore(), {})
+        vectorstore.save_local(faiss_dir)
+        FaissIndexBuilder.save_params(faiss_dir, params)
+
+        SearchResourcesRegistry.clear()
+        SearchResourcesRegistry._embedding_model = FakeEmbeddings(size = 16)
+        self.addCleanup(SearchResourcesRegistry.clear)
+
+        loaded = SearchResourcesRegistry.get_vectorstore(faiss_dir)
+
+        self.assertEqual(faiss.extract_index_ivf(loaded.index).nprobe, 3)
+
+
+@mock.patch('app_model.services.HuggingFaceEmbeddings', lambda **kwargs: FakeEmbeddings(size = 8))
+class IncrementalIndexServiceTest(TestCase):
+    '''Tests for updating a saved index with the changed documents.'''
+
+    def setUp(self):
+        self.faiss_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.faiss_dir)
+
+        self.loader = DocumentBulkLoader()
+        self.loader.upsert(DataConsolidationService(make_python_answers_df(5)).consolidate())
+
+    def _build(self, index_builder: FaissIndexBuilder = None) -> None:
+        service = CreateFaissTreeService(index_builder = index_builder)
+        service.create_faiss_index(faiss_save_path = self.faiss_dir)
+        service.mark_indexed()
+
+    def _change_documents(self) -> None:
+        batch_df = make_python_answers_df(6)
+        batch_df = batch_df[batch_df['qid'] != 3]
+        batch_df.loc[batch_df['qid'] == 2, 'response_k'] = 'Use numpy differently'
+
+        self.loader.upsert(DataConsolidationService(batch_df).consolidate())
+
+        return self.loader.delete_missing(np.array([1, 2, 4, 5, 6]))
+
+    def _live_parent_indexes(self, vectorstore) -> list:
+        return sorted(
+            document.metadata['parent_index'] for document in vectorstore.docstore._dict.values()
+            if IncrementalIndexService.is_live(document.metadata)
+        )
+
+    def test_update_tombstones_changed_documents_and_appends_new_versions(self):
+        self._build()
+        removed_qids = self._change_documents()
+
+        index_update = IncrementalIndexService(self.faiss_dir, compact_ratio = 1.0).update(removed_qids)
+
+        self.assertEqual(index_update, {'appended_documents': 2, 'tombstoned_chunks': 2, 'compacted_chunks': 0})
+        self.assertFalse(Document.objects.filter(is_indexed = False).exists())
+
+        index_service = IncrementalIndexService(self.faiss_dir)
+        vectorstore = index_service.load(FakeEmbeddings(size = 8))
+
+        self.assertIsInstance(vectorstore.index, faiss.IndexIDMap2)
+        self.assertEqual(vectorstore.index.ntotal, 7)
+        self.assertEqual(self._live_parent_indexes(vectorstore), [1, 2, 4, 5, 6])
+
+        results = vectorstore.similarity_search_with_score('pandas', k = 7, filter = IncrementalIndexService.is_live, fetch_k = 7)
+        self.assertEqual(sorted(document.metadata['parent_index'] for document, _ in results), [1, 2, 4, 5, 6])
+
+        surviving_ids = {vector_id for vector_id in vectorstore.index_to_docstore_id if vector_id not in index_service.tombstoned_ids(vectorstore)}
+
+        self.assertEqual(index_service.compact(vectorstore), 2)
+        self.assertEqual(vectorstore.index.ntotal, 5)
+        self.assertEqual(set(vectorstore.index_to_docstore_id), surviving_ids)
+        self.assertEqual(len(vectorstore.docstore._dict), 5)
+
+    def test_run_in_an_incremental_update_is_not_stale(self):
+        self._build()
+        removed_qids = self._change_documents()
+        stopped_at = timezone.now() - timedelta(seconds = settings.TRAINING_HEARTBEAT_TIMEOUT + 1)
+        TaskStatus.objects.create(task_id = 'update', status = states.PENDING)
+        TaskStatus.objects.filter(task_id = 'update').update(updated_at = stopped_at)
+        index_service = IncrementalIndexService(self.faiss_dir, compact_ratio = 1.0)
+        append_pending = index_service.append_pending
+        live_while_appending = []
+
+        def appending(*args):
+            live_while_appending.append(TrainingCheckpoint.live_runs().filter(task_id = 'update').exists())
+            return append_pending(*args)
+
+        with mock.patch.object(index_service, 'append_pending', side_effect = appending):
+            index_service.update(removed_qids, 'update')
+
+        self.assertEqual(live_while_appending, [True])
+
+    def test_compaction_rebuilds_indexes_without_removal(self):
+        self._build(FaissIndexBuilder(spec = 'hnsw', report_queries = 2, k = 1))
+        removed_qids = self._change_documents()
+
+        index_update = IncrementalIndexService(self.faiss_dir, compact_ratio = 0.0).update(removed_qids)
+        vectorstore = IncrementalIndexService(self.faiss_dir).load(FakeEmbeddings(size = 8))
+
+        self.assertEqual(index_update['compacted_chunks'], 2)
+        self.assertEqual(vectorstore.index.ntotal, 5)
+        self.assertEqual(self._live_parent_indexes(vectorstore), [1, 2, 4, 5, 6])
+        self.assertIsInstance(faiss.downcast_index(vectorstore.index.index), faiss.IndexHNSWFlat)
+
+    def test_index_saved_without_ids_is_not_updated(self):
+        vectorstore = FAISS.from_embeddings([('a', [0.1] * 8), ('b', [0.2] * 8)], FakeEmbeddings(size = 8))
+        vectorstore.save_local(self.faiss_dir)
+
+        with self.assertRaisesMessage(ValueError, 'recrie o índice'):
+            IncrementalIndexService(self.faiss_dir).load(FakeEmbeddings(size = 8))
+
+    def test_index_built_before_versions_is_rebuilt(self):
+        # Indexes built before this format keyed the chunks by their row in a consolidated batch, not by qid
+        legacy = FAISS.from_embeddings(
+            [(f'legacy {row}', [0.1 * row] * 8) for row in range(3)], FakeEmbeddings(size = 8),
+            metadatas = [{'parent_index': row, 'metadata_link': ''} for row in range(3)]
+        )
+        legacy.save_local(self.faiss_dir)
+        version_store = IndexVersionStore(self.faiss_dir)
+
+        # A checkpoint past consolidation, so the run goes straight to the index
+        TaskStatus.objects.create(task_id = 'rebuild', status = states.PENDING)
+        checkpoint = TrainingCheckpoint.resume('rebuild')
+        checkpoint.start('fingerprint', os.path.join(self.faiss_dir, 'work'))
+        checkpoint.start_embedding()
+
+        self.assertFalse(version_store.accepts_updates())
+
+        with override_settings(EMBEDDING_CACHE_DIR = os.path.join(self.faiss_dir, 'cache'), INDEXING_CHUNK_WORKERS = 0), \
+                mock.patch('app_model.tasks.IncrementalIndexService') as incremental_index:
+            set_database_and_train_data.apply(args = (self.faiss_dir,), task_id = 'rebuild')
+
+        incremental_index.assert_not_called()
+        self.assertEqual(TaskStatus.objects.get(task_id = 'rebuild').status, states.SUCCESS)
+        self.assertTrue(version_store.accepts_updates())
+        self.assertFalse(os.path.exists(os.path.join(self.faiss_dir, 'index.faiss')))
+
+        rebuilt = IncrementalIndexService(version_store.current_path()).load(FakeEmbeddings(size = 8))
+
+        self.assertEqual(self._live_parent_indexes(rebuilt), [1, 2, 3, 4, 5])
+        self.assertFalse(Document.objects.filter(is_indexed = False).exists())
@@ -1,11 +1,12 @@
 from django.urls import path
-from .views import SendDatabaseAndTrainModel, TrainTaskStatusView, SearchInformationView, CreateChatView, ListChatView, DeleteChatView, CreateMessageView, ListMessagesView
+from .views import SendDatabaseAndTrainModel, TrainTaskStatusView, SearchResourcesStatsView, SearchInformationView, CreateChatView, ListChatView, DeleteChatView, CreateMessageView, ListMessagesView
 
 app_name = 'app_model'
 
 urlpatterns = [
     path('train/model/', SendDatabaseAndTrainModel.as_view(), name = 'send-database'),
     path('monitor/training/', TrainTaskStatusView.as_view(), name = 'task-status'),
+    path('monitor/search/', SearchResourcesStatsView.as_view(), name = 'search-stats'),
     path('search/information/', SearchInformationView.as_view(), name = 'search-information'),
     path('chat/create/', CreateChatView.as_view(), name = 'create-chat'),
     path('chat/list/', ListChatView.as_view(), name = 'list-chat'),
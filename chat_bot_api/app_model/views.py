@@ -1,9 +1,10 @@
 import os
+import uuid
 import traceback
-import shutil
 
 from django.conf import settings
 from django.http import Http404
+from celery import states
 
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
@@ -18,7 +19,7 @@ from rest_framework_simplejwt.authentication import JWTAuthentication
 from core.models import LogSystem
 from .models import TaskStatus
 from .tasks import set_database_and_train_data, get_response_from_vector_base
-from .services import ChatService, MessageService
+from .services import ChatService, MessageService, TrainingCheckpoint, IndexVersionStore, SearchResourcesRegistry
 
 
 class SendDatabaseAndTrainModel(APIView):
@@ -33,12 +34,31 @@ class SendDatabaseAndTrainModel(APIView):
         faiss_save_dir = os.path.join(settings.MEDIA_ROOT, 'faiss_index')
         
         try:
-            if not os.path.exists(faiss_save_dir):
-                task = set_database_and_train_data.delay(faiss_save_dir)
-                
-                return Response({"message": "Training started successfully.", "task_id": task.id}, status = status.HTTP_201_CREATED)
-            
-            return Response({"message": "Model already trained"}, status = status.HTTP_200_OK)
+            running_task = TrainingCheckpoint.live_runs().order_by('-created_at').first()
+
+            if running_task is not None:
+                return Response(
+                    {"error": "Training already in progress.", "task_id": running_task.task_id},
+                    status = status.HTTP_409_CONFLICT
+                )
+
+            index_exists = IndexVersionStore(faiss_save_dir).accepts_updates()
+
+            # The status is saved before the task is queued, so a second request sees the run at once
+            task_id = str(uuid.uuid4())
+            TaskStatus.objects.create(task_id = task_id, status = states.PENDING, result = 'Na fila de processamento')
+
+            try:
+                task = set_database_and_train_data.apply_async((faiss_save_dir,), task_id = task_id)
+
+            except Exception:
+                TaskStatus.objects.filter(task_id = task_id).delete()
+                raise
+
+            if index_exists:
+                return Response({"message": "Index update started successfully.", "task_id": task.id}, status = status.HTTP_201_CREATED)
+
+            return Response({"message": "Training started successfully.", "task_id": task.id}, status = status.HTTP_201_CREATED)
 
         except AuthenticationFailed:
             return Response({'error': 'Authentication failed.'}, status = status.HTTP_401_UNAUTHORIZED)
@@ -52,9 +72,6 @@ class SendDatabaseAndTrainModel(APIView):
             return Response({'error': 'Bad request'}, status = status.HTTP_400_BAD_REQUEST)
 
         except Exception as e:
-            if os.path.exists(faiss_save_dir):
-                shutil.rmtree(faiss_save_dir)
-
             LogSystem.objects.create(error = str(e), stacktrace = traceback.format_exc())
 
             return Response({"error": str(e)}, status = status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -112,6 +129,33 @@ class TrainTaskStatusView(APIView):
             return Response({'error': str(e)}, status = status.HTTP_500_INTERNAL_SERVER_ERROR)
         
 
+class SearchResourcesStatsView(APIView):
+    '''View to query the search resources of the answering worker process and its answer cache metrics.'''
+
+    permission_classes = (IsAuthenticated,)
+    authentication_classes = (JWTAuthentication,)
+
+    def get(self, _: Request) -> Response:
+        '''
+        Call get HTTP verb and return the load times, memory, greeting decisions and answer cache hits and misses of
+        this worker process.
+
+        Return:
+            A response object with the search resources statistics.
+        '''
+
+        try:
+            return Response(SearchResourcesRegistry.stats(), status = status.HTTP_200_OK)
+
+        except AuthenticationFailed:
+            return Response({'error': 'Authentication failed.'}, status = status.HTTP_401_UNAUTHORIZED)
+
+        except Exception as e:
+            LogSystem.objects.create(error = str(e), stacktrace = traceback.format_exc())
+
+            return Response({'error': str(e)}, status = status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 class SearchInformationView(APIView):
     '''View for sendind an question or sentence and getting an answer based on Sentece Similarity.'''
 
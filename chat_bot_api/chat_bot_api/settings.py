@@ -45,6 +45,100 @@ CELERY_WORKER_MAX_MEMORY_PER_CHILD = 3000000
 CELERY_WORKER_PREFETCH_MULTIPLIER = 2
 
 
+# Training pipeline
+
+# Stream the dataset shard by shard instead of loading it whole in memory
+INGESTION_STREAMING = config('INGESTION_STREAMING', default = True, cast = bool)
+
+# Local cache of the HuggingFace parquet shards; offline mode reads only from it or from the mirror directory
+DATASET_CACHE_DIR = config('DATASET_CACHE_DIR', default = os.path.join(MEDIA_ROOT, 'dataset_cache'))
+DATASET_MIRROR_DIR = config('DATASET_MIRROR_DIR', default = None)
+DATASET_OFFLINE = config('DATASET_OFFLINE', default = False, cast = bool)
+DATASET_DOWNLOAD_WORKERS = config('DATASET_DOWNLOAD_WORKERS', default = 4, cast = int)
+
+# Processes used to consolidate qid batches (0 = one per CPU), capped so each fits its memory budget
+CONSOLIDATION_WORKERS = config('CONSOLIDATION_WORKERS', default = 1, cast = int)
+CONSOLIDATION_WORKER_MEMORY_MB = config('CONSOLIDATION_WORKER_MEMORY_MB', default = 2048, cast = int)
+CONSOLIDATION_BATCHES_PER_CHILD = config('CONSOLIDATION_BATCHES_PER_CHILD', default = 10, cast = int)
+
+# Index build pipeline: processes that chunk and clean documents while embeddings run (0 = chunk inline) and the
+# document batches allowed to wait between chunking and embedding
+INDEXING_CHUNK_WORKERS = config('INDEXING_CHUNK_WORKERS', default = 2, cast = int)
+INDEXING_QUEUE_SIZE = config('INDEXING_QUEUE_SIZE', default = 2, cast = int)
+
+# Chunk embeddings kept between trainings, keyed by chunk text; compact_embedding_cache trims it to the size limit
+EMBEDDING_CACHE_DIR = config('EMBEDDING_CACHE_DIR', default = os.path.join(MEDIA_ROOT, 'embedding_cache'))
+EMBEDDING_CACHE_MAX_MB = config('EMBEDDING_CACHE_MAX_MB', default = 4096, cast = int)
+
+# Embedding backend of indexing and queries: torch, or onnx to run the model with ONNX Runtime on CPU (exported to
+# EMBEDDING_ONNX_DIR on first use, with int8 weights when EMBEDDING_ONNX_INT8). Batches hold texts of similar length,
+# up to EMBEDDING_ONNX_BATCH_SIZE texts and EMBEDDING_ONNX_MAX_BATCH_TOKENS padded tokens; EMBEDDING_ONNX_THREADS = 0
+# lets ONNX Runtime pick
+EMBEDDING_BACKEND = config('EMBEDDING_BACKEND', default = 'torch')
+EMBEDDING_ONNX_DIR = config('EMBEDDING_ONNX_DIR', default = os.path.join(MEDIA_ROOT, 'onnx_embeddings'))
+EMBEDDING_ONNX_INT8 = config('EMBEDDING_ONNX_INT8', default = False, cast = bool)
+EMBEDDING_ONNX_BATCH_SIZE = config('EMBEDDING_ONNX_BATCH_SIZE', default = 32, cast = int)
+EMBEDDING_ONNX_MAX_BATCH_TOKENS = config('EMBEDDING_ONNX_MAX_BATCH_TOKENS', default = 4096, cast = int)
+EMBEDDING_ONNX_THREADS = config('EMBEDDING_ONNX_THREADS', default = 0, cast = int)
+
+# FAISS index type: a preset (flat, ivf-flat, ivf-pq, hnsw, sq8) or an index_factory string; flat is exact search.
+# Quantizers are trained on up to FAISS_INDEX_TRAIN_SIZE vectors, and nprobe / efSearch are used at query time
+FAISS_INDEX_SPEC = config('FAISS_INDEX_SPEC', default = 'flat')
+FAISS_INDEX_TRAIN_SIZE = config('FAISS_INDEX_TRAIN_SIZE', default = 100000, cast = int)
+FAISS_INDEX_NPROBE = config('FAISS_INDEX_NPROBE', default = 16, cast = int)
+FAISS_INDEX_EF_SEARCH = config('FAISS_INDEX_EF_SEARCH', default = 64, cast = int)
+
+# Greetings are recognized locally, by a lexicon and then by the embedding similarity to greeting phrases: at least
+# GREETING_MATCH_SIMILARITY is a greeting, below GREETING_REJECT_SIMILARITY is a question, and the LLM decides in between
+GREETING_LOCAL_CLASSIFIER = config('GREETING_LOCAL_CLASSIFIER', default = True, cast = bool)
+GREETING_MATCH_SIMILARITY = config('GREETING_MATCH_SIMILARITY', default = 0.8, cast = float)
+GREETING_REJECT_SIMILARITY = config('GREETING_REJECT_SIMILARITY', default = 0.5, cast = float)
+
+# A message the local greeting classifier cannot settle is searched and answered on a pool of QUESTION_PIPELINE_WORKERS
+# threads per web worker while the LLM classifies it, and the answer is dropped when it was a greeting; False classifies
+# first and answers after. Messages settled locally never use the pool
+QUESTION_PIPELINE_CONCURRENT = config('QUESTION_PIPELINE_CONCURRENT', default = True, cast = bool)
+QUESTION_PIPELINE_WORKERS = config('QUESTION_PIPELINE_WORKERS', default = 4, cast = int)
+
+# Answers are cached per process by question embedding: a question within SEMANTIC_CACHE_MAX_DISTANCE (1 - cosine
+# similarity) of a cached one gets its answer, for SEMANTIC_CACHE_TTL seconds and the SEMANTIC_CACHE_MAX_ENTRIES most
+# recently used questions; publishing a new index version empties the cache
+SEMANTIC_CACHE_ENABLED = config('SEMANTIC_CACHE_ENABLED', default = True, cast = bool)
+SEMANTIC_CACHE_MAX_DISTANCE = config('SEMANTIC_CACHE_MAX_DISTANCE', default = 0.05, cast = float)
+SEMANTIC_CACHE_TTL = config('SEMANTIC_CACHE_TTL', default = 6 * 3600, cast = int)
+SEMANTIC_CACHE_MAX_ENTRIES = config('SEMANTIC_CACHE_MAX_ENTRIES', default = 5000, cast = int)
+
+# Answers are also shared by the web workers through Redis, by exact question, index version and prompt version. The
+# cache uses its own database so that evicting answers past ANSWER_CACHE_MAX_MB never touches the Celery broker; a miss
+# is computed by one worker while the others wait up to ANSWER_CACHE_LOCK_TIMEOUT seconds for its answer
+ANSWER_CACHE_ENABLED = config('ANSWER_CACHE_ENABLED', default = True, cast = bool)
+ANSWER_CACHE_REDIS_URL = config('ANSWER_CACHE_REDIS_URL', default = 'redis://localhost:6379/1')
+ANSWER_CACHE_TTL = config('ANSWER_CACHE_TTL', default = 24 * 3600, cast = int)
+ANSWER_CACHE_MAX_MB = config('ANSWER_CACHE_MAX_MB', default = 256, cast = int)
+ANSWER_CACHE_LOCK_TIMEOUT = config('ANSWER_CACHE_LOCK_TIMEOUT', default = 60, cast = float)
+
+# Each build or update of the index is published as a new version; FAISS_INDEX_KEEP_VERSIONS published versions,
+# the served one included, are kept to roll back to and the older ones are removed
+FAISS_INDEX_KEEP_VERSIONS = config('FAISS_INDEX_KEEP_VERSIONS', default = 3, cast = int)
+# A version replaced as the served one is kept at least FAISS_INDEX_RETIRED_GRACE_SECONDS more, so the web workers still
+# reading it (their docstore connections are opened lazily) move to the new one before its files are removed
+FAISS_INDEX_RETIRED_GRACE_SECONDS = config('FAISS_INDEX_RETIRED_GRACE_SECONDS', default = 600, cast = int)
+
+# A first index build is split into INDEX_BUILD_SHARDS Celery tasks over disjoint document id ranges, merged by a final
+# task, so it scales with the worker processes and nodes (sharing MEDIA_ROOT); 1 builds it inside the training task.
+# A failed shard is retried on its own up to INDEX_SHARD_MAX_RETRIES times
+INDEX_BUILD_SHARDS = config('INDEX_BUILD_SHARDS', default = 1, cast = int)
+INDEX_SHARD_MAX_RETRIES = config('INDEX_SHARD_MAX_RETRIES', default = 3, cast = int)
+
+# A training run refreshes its heartbeat (TaskStatus.updated_at) with every checkpoint or progress write and from a
+# background thread every TRAINING_HEARTBEAT_TIMEOUT / 4 seconds; a new run only takes over the checkpoint of an
+# unfinished run whose heartbeat is older than TRAINING_HEARTBEAT_TIMEOUT seconds
+TRAINING_HEARTBEAT_TIMEOUT = config('TRAINING_HEARTBEAT_TIMEOUT', default = 3600, cast = int)
+
+# Retraining over an existing index updates it into a new version; removed chunks are compacted away once they pass this share
+FAISS_COMPACT_TOMBSTONE_RATIO = config('FAISS_COMPACT_TOMBSTONE_RATIO', default = 0.2, cast = float)
+
+
 # Application definition
 
 INSTALLED_APPS = [